@@ -1,9 +1,15 @@
-from appointments.models import Calendar
+from appointments.models import Calendar, Occurrence
 from django.contrib.syndication.feeds import FeedDoesNotExist
 from django.core.exceptions import ObjectDoesNotExist
 from django.conf import settings
 from appointments.feeds.atom import Feed
 from appointments.feeds.icalendar import ICalendarFeed
+from appointments.freebusy import FreeBusy
+from appointments.recurrence import to_rrule_string
+from appointments.utils import calendar_etag
+from django.contrib.syndication.views import feed
+from django.db.models import F
+from django.views.decorators.http import condition
 from django.http import HttpResponse
 import datetime, itertools
 
@@ -24,7 +30,7 @@ class UpcomingEventsFeed(Feed):
         return obj.get_absolute_url()
     
     def items(self, obj):
-        return itertools.islice(obj.occurrences_after(datetime.datetime.now()), 
+        return obj.occurrences_after(datetime.datetime.now(),
             getattr(settings, "FEED_LIST_LENGTH", 10))
     
     def item_id(self, item):
@@ -39,21 +45,53 @@ class UpcomingEventsFeed(Feed):
         return [{"name": item.event.creator.username}]
     
     def item_updated(self, item):
-        return item.event.created_on
+        return item.event.updated_on
     
     def item_content(self, item):
         return "%s \n %s" % (item.event.title, item.event.description)
 
 
 class CalendarICalendar(ICalendarFeed):
-    def items(self):
-        cal_id = self.args[1]
+    """
+    The events of a calendar.  Recurring events are exported once with their
+    RRULE: their cancelled occurrences are listed as EXDATE, and each moved
+    occurrence follows as a VEVENT overriding its RECURRENCE-ID.
+    """
+    streaming = True
+
+    def etag(self, cal_id):
+        updated_on = Calendar.objects.get_updated_on(pk=cal_id)
+        if updated_on is not None:
+            return calendar_etag(updated_on, 'ical')
+
+    def last_modified(self, cal_id):
+        return Calendar.objects.get_updated_on(pk=cal_id)
+
+    def items(self, cal_id):
         cal = Calendar.objects.get(pk=cal_id)
-        
-        return cal.events.all()
+
+        occurrences = Occurrence.objects.with_events().filter(event__calendar=cal,
+            event__rule__isnull=False)
+        exdates = {}
+        for event_id, original_start in occurrences.filter(cancelled=True) \
+                .values_list('event', 'original_start'):
+            exdates.setdefault(event_id, []).append(original_start)
+        moved = occurrences.filter(cancelled=False).exclude(
+            start=F('original_start'), end=F('original_end'))
+
+        def events():
+            # the feed is shared by the requests: the EXDATEs of this one go
+            # with its events
+            for event in self.iterate_items(cal.events.select_related('rule')):
+                event._exdates = sorted(exdates.get(event.pk, []))
+                yield event
+        return itertools.chain(events(), self.iterate_items(moved))
 
     def item_uid(self, item):
-        return str(item.id)
+        if isinstance(item, Occurrence):
+            item = item.event
+        # imported events keep their UID
+        return item.uid or str(item.id)
 
     def item_start(self, item):
         return item.start
@@ -63,6 +101,82 @@ class CalendarICalendar(ICalendarFeed):
 
     def item_summary(self, item):
         return item.title
-        
+
     def item_created(self, item):
-        return item.created_on
\ No newline at end of file
+        if isinstance(item, Occurrence):
+            return item.event.created_on
+        return item.created_on
+
+    def item_last_modified(self, item):
+        return item.updated_on
+
+    def item_recurrence_id(self, item):
+        if isinstance(item, Occurrence):
+            return item.original_start
+
+    def item_rrule(self, item):
+        if not isinstance(item, Occurrence) and item.rule is not None:
+            return to_rrule_string(item.rule, item.start, item.end_recurring_period)
+
+    def item_exdate(self, item):
+        if not isinstance(item, Occurrence) and item.rule is not None:
+            return getattr(item, '_exdates', None)
+
+
+class CalendarFreeBusy(ICalendarFeed):
+    """
+    The busy time of a calendar from today on, as a VFREEBUSY component.  The
+    number of days published is the ``days`` query parameter (30 by default).
+    The object of a request is the calendar id and that number of days.
+    """
+    def get_object(self, request, cal_id):
+        try:
+            days = int(request.GET.get('days', 30))
+        except ValueError:
+            days = 30
+        return cal_id, days
+
+    def etag(self, obj):
+        cal_id, days = obj
+        updated_on = Calendar.objects.get_updated_on(pk=cal_id)
+        if updated_on is not None:
+            return calendar_etag(updated_on, 'freebusy', days,
+                                 datetime.date.today())
+
+    def freebusy(self, obj):
+        cal_id, days = obj
+        calendar = Calendar.objects.get(pk=cal_id)
+        start = datetime.datetime.combine(datetime.date.today(), datetime.time.min)
+        return FreeBusy.for_calendar(calendar, start,
+            start + datetime.timedelta(days=days))
+
+    def freebusy_uid(self, obj, freebusy):
+        return 'freebusy-%s' % obj[0]
+
+
+# The upcoming events change as time goes by: their conditional GETs are
+# answered for this many seconds at most.
+UPCOMING_EVENTS_INTERVAL = 5 * 60
+
+def _upcoming_calendar_updated_on(url):
+    bits = url.strip('/').split('/')
+    if len(bits) == 2 and bits[0] == 'upcoming' and bits[1].isdigit():
+        return Calendar.objects.get_updated_on(pk=bits[1])
+
+def _upcoming_interval_start():
+    now = datetime.datetime.now().replace(microsecond=0)
+    seconds = now.hour * 3600 + now.minute * 60 + now.second
+    return now - datetime.timedelta(seconds=seconds % UPCOMING_EVENTS_INTERVAL)
+
+def _upcoming_etag(request, url, feed_dict=None):
+    updated_on = _upcoming_calendar_updated_on(url)
+    if updated_on is not None:
+        return calendar_etag(updated_on, url, _upcoming_interval_start())
+
+def _upcoming_last_modified(request, url, feed_dict=None):
+    updated_on = _upcoming_calendar_updated_on(url)
+    if updated_on is not None:
+        return max(updated_on, _upcoming_interval_start())
+
+upcoming_events_feed = condition(etag_func=_upcoming_etag,
+    last_modified_func=_upcoming_last_modified)(feed)
@@ -1,42 +1,174 @@
+import datetime
+
 import vobject
 
+from django.db.models.query import QuerySet
 from django.http import HttpResponse
+from django.views.decorators.http import condition
+
+try:
+    from django.http import StreamingHttpResponse
+except ImportError:
+    # older Django versions stream iterators given to HttpResponse
+    StreamingHttpResponse = HttpResponse
 
+# iCalendar properties of an event and the ``item_`` hooks giving them.  The
+# names are vobject's: LAST-MODIFIED used to be given as ``last_modified``,
+# which vobject can't serialize, so a feed returning it failed.
 EVENT_ITEMS = (
     ('uid', 'uid'),
     ('dtstart', 'start'),
     ('dtend', 'end'),
     ('summary', 'summary'),
     ('location', 'location'),
-    ('last_modified', 'last_modified'),
+    ('last-modified', 'last_modified'),
     ('created', 'created'),
+    ('recurrence-id', 'recurrence_id'),
+    ('rrule', 'rrule'),
+    ('exdate', 'exdate'),
 )
 
 class ICalendarFeed(object):
+    """
+    If ``streaming`` is True the calendar is written one VEVENT at a time
+    while the items are read from the database ``chunk_size`` at a time, so
+    that the memory used doesn't grow with the number of items.  The output
+    is the same as when the whole calendar is serialized at once, as long as
+    no VTIMEZONE is needed (the dates are naive or in UTC).
+
+    A feed instance serves all the requests of its URL, so nothing specific
+    to a request is stored on it: ``get_object`` returns what the request is
+    about, and it is given to the other hooks.
+    """
+    streaming = False
+    chunk_size = 500
+
+    def __call__(self, request, *args, **kwargs):
+        obj = self.get_object(request, *args, **kwargs)
+        # answer conditional GETs before computing the items
+        view = condition(etag_func=lambda *args, **kwargs: self.etag(obj),
+            last_modified_func=lambda *args, **kwargs: self.last_modified(obj))
+        return view(lambda *args, **kwargs: self.render(obj))(request, *args, **kwargs)
+
+    def get_object(self, request, *args, **kwargs):
+        """
+        Returns the object of the feed for this request, given to the other
+        hooks: by default the first argument captured from the URL.
+        """
+        if args:
+            return args[0]
+
+    def render(self, obj):
+        if self.streaming:
+            # the items are read while the response is sent
+            response = StreamingHttpResponse(
+                self.serialize_items(self.items(obj), self.freebusy(obj), obj))
+            response['Content-Type'] = 'text/calendar'
+            return response
 
-    def __call__(self, *args, **kwargs):
-        self.args = args
-        self.kwargs = kwargs
-        
         cal = vobject.iCalendar()
 
-        for item in self.items():
+        for item in self.items(obj):
 
             event = cal.add('vevent')
+            self.add_item(event, item)
 
-            for vkey, key in EVENT_ITEMS:
-                value = getattr(self, 'item_' + key)(item)
-                if value:
-                    event.add(vkey).value = value
+        freebusy = self.freebusy(obj)
+        if freebusy is not None:
+            self.add_freebusy(cal, freebusy, obj)
 
         response = HttpResponse(cal.serialize())
         response['Content-Type'] = 'text/calendar'
 
         return response
 
-    def items(self):
+    def add_item(self, event, item):
+        for vkey, key in EVENT_ITEMS:
+            value = getattr(self, 'item_' + key)(item)
+            if value:
+                event.add(vkey).value = value
+
+    def serialize_items(self, items, freebusy=None, obj=None):
+        """
+        Yields the serialized calendar piece by piece: the VCALENDAR header,
+        the VEVENT of every item, the VFREEBUSY of ``freebusy`` and the end of
+        the VCALENDAR.
+        """
+        # VERSION and PRODID, as serialized for an empty calendar
+        empty = vobject.iCalendar().serialize()
+        footer = 'END:VCALENDAR\r\n'
+        yield empty[:-len(footer)]
+
+        for item in self.iterate_items(items):
+            event = vobject.newFromBehavior('vevent')
+            self.add_item(event, item)
+            yield event.serialize()
+
+        if freebusy is not None:
+            vfreebusy = self.add_freebusy(vobject.iCalendar(), freebusy, obj)
+            yield vfreebusy.serialize()
+
+        yield footer
+
+    def iterate_items(self, items):
+        """
+        Iterates over ``items`` without loading them all at once.  Querysets
+        without an explicit ordering are read in chunks ordered by primary
+        key, the others through QuerySet.iterator().
+        """
+        if not isinstance(items, QuerySet):
+            for item in items:
+                yield item
+            return
+        if items.ordered:
+            for item in items.iterator():
+                yield item
+            return
+        items = items.order_by('pk')
+        chunk = list(items[:self.chunk_size])
+        while chunk:
+            for item in chunk:
+                yield item
+            if len(chunk) < self.chunk_size:
+                return
+            chunk = list(items.filter(pk__gt=chunk[-1].pk)[:self.chunk_size])
+
+    def items(self, obj):
         return []
 
+    def etag(self, obj):
+        """
+        Returns the ETag of the feed, or None.
+        """
+        return None
+
+    def last_modified(self, obj):
+        """
+        Returns the date the feed last changed, or None.
+        """
+        return None
+
+    def freebusy(self, obj):
+        """
+        Returns the appointments.freebusy.FreeBusy to publish as a VFREEBUSY
+        component, or None.
+        """
+        return None
+
+    def freebusy_uid(self, obj, freebusy):
+        return 'freebusy-%s-%s' % (freebusy.start.strftime('%Y%m%dT%H%M%S'),
+                                   freebusy.end.strftime('%Y%m%dT%H%M%S'))
+
+    def add_freebusy(self, cal, freebusy, obj=None):
+        vfreebusy = cal.add('vfreebusy')
+        vfreebusy.add('uid').value = self.freebusy_uid(obj, freebusy)
+        vfreebusy.add('dtstamp').value = datetime.datetime.utcnow()
+        vfreebusy.add('dtstart').value = freebusy.start
+        vfreebusy.add('dtend').value = freebusy.end
+        if freebusy.busy:
+            vfreebusy.add('freebusy').value = freebusy.busy
+        return vfreebusy
+
     def item_uid(self, item):
         pass
 
@@ -56,4 +188,13 @@ class ICalendarFeed(object):
         pass
 
     def item_created(self, item):
+        pass
+
+    def item_recurrence_id(self, item):
+        pass
+
+    def item_rrule(self, item):
+        pass
+
+    def item_exdate(self, item):
         pass
\ No newline at end of file
@@ -0,0 +1,370 @@
+import codecs
+import datetime
+import time
+from hashlib import md5
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from appointments.utils import bulk_create
+
+
+def read_components(lines):
+    """
+    Yields the (name, text) of the VEVENT and VTIMEZONE components of an
+    iCalendar stream, one at a time, so that the file is never read whole.
+    """
+    name = block = None
+    for line in lines:
+        line = line.rstrip('\r\n')
+        if block is None:
+            if line.upper() in ('BEGIN:VEVENT', 'BEGIN:VTIMEZONE'):
+                name, block = line.upper()[6:], [line]
+            continue
+        block.append(line)
+        if line.upper() == 'END:' + name:
+            yield name, '\r\n'.join(block) + '\r\n'
+            name = block = None
+
+
+def naive_datetime(value):
+    """
+    Returns ``value`` as a naive datetime in the local time zone, the dates
+    of all day events at midnight.
+    """
+    from dateutil import tz
+    if not isinstance(value, datetime.datetime):
+        return datetime.datetime.combine(value, datetime.time.min)
+    if value.tzinfo is not None:
+        value = value.astimezone(tz.tzlocal()).replace(tzinfo=None)
+    return value
+
+
+def _value(component, name, default=None):
+    line = getattr(component, name, None)
+    if line is None:
+        return default
+    return line.value
+
+
+def _chunks(items, size):
+    for index in range(0, len(items), size):
+        yield items[index:index + size]
+
+
+class Command(BaseCommand):
+    args = "<calendar_slug> <file.ics> [<file.ics> ...]"
+    help = "Import the events of iCalendar files into a calendar"
+
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int', dest='batch_size', default=500,
+            help='Number of rows inserted by each query'),
+        make_option('--transaction-size', type='int', dest='transaction_size', default=5000,
+            help='Number of events imported in each transaction'),
+        make_option('--create', action='store_true', dest='create', default=False,
+            help='Create the calendar if it does not exist'),
+    )
+
+    def handle(self, *args, **options):
+        """
+        Events are inserted with bulk_create, so the signals of appointments
+        are not sent for each of them (double bookings are not checked):
+        the calendar, its change log and the occurrence index are updated by
+        the command instead.  Django versions without bulk_create save them
+        one by one, which is slower and sends the signals, but still doesn't
+        check double bookings.  Events whose UID is already in the calendar are skipped, which
+        makes importing a file again harmless.
+        """
+        from appointments.models import Calendar
+
+        if len(args) < 2:
+            raise CommandError("Usage: import_ics %s" % self.args)
+        self.batch_size = max(options.get('batch_size') or 500, 1)
+        self.transaction_size = max(options.get('transaction_size') or 5000, 1)
+        self.verbosity = int(options.get('verbosity', 1))
+        try:
+            self.calendar = Calendar.objects.get(slug=args[0])
+        except Calendar.DoesNotExist:
+            if not options.get('create'):
+                raise CommandError("Calendar %r does not exist, use --create to create it" % args[0])
+            self.calendar = Calendar.objects.create(name=args[0], slug=args[0])
+
+        self.rules = {}
+        self.overrides = []
+        self.imported = self.skipped = self.occurrences = 0
+        self.unsupported = self.invalid = 0
+        started = time.time()
+        for filename in args[1:]:
+            if self.verbosity > 0:
+                print "Importing %s ..." % filename
+            ics = codecs.open(filename, 'r', 'utf-8')
+            try:
+                self.import_stream(ics)
+            finally:
+                ics.close()
+        # the overrides left have no event in the calendar
+        self.overrides = []
+        self.calendar_imported()
+
+        elapsed = max(time.time() - started, 0.001)
+        if self.verbosity > 0:
+            print "%d events imported, %d already imported, %d occurrences." % (
+                self.imported, self.skipped, self.occurrences)
+            if self.invalid:
+                print "%d invalid events were ignored." % self.invalid
+            if self.unsupported:
+                print "%d recurrence rules could not be imported, their events only occur once." % self.unsupported
+            print "%.1f seconds, %.0f events/sec." % (elapsed, self.imported / elapsed)
+
+    def import_stream(self, lines):
+        import vobject
+
+        pending = []
+        for name, text in read_components(lines):
+            # parsing a VTIMEZONE registers it for the TZIDs of the events
+            try:
+                component = vobject.readOne(text)
+            except vobject.base.ParseError:
+                self.invalid += 1
+                continue
+            if name != 'VEVENT':
+                continue
+            if _value(component, 'dtstart') is None:
+                self.invalid += 1
+                continue
+            if _value(component, 'recurrence_id') is not None:
+                self.overrides.append(self.parse_override(component, text))
+                continue
+            pending.append(self.parse_event(component, text))
+            if len(pending) >= self.transaction_size:
+                self.import_events(pending)
+                self.import_overrides()
+                pending = []
+        if pending:
+            self.import_events(pending)
+        self.import_overrides()
+
+    def event_uid(self, vevent, text):
+        uid = _value(vevent, 'uid')
+        if not uid:
+            # imported again with the same UID as long as it doesn't change
+            uid = md5(text.encode('utf-8')).hexdigest()
+        return uid[:255]
+
+    def parse_event(self, vevent, text):
+        """
+        Returns the unsaved Event of ``vevent`` and the original starts of
+        its excluded occurrences.
+        """
+        from appointments.models import Event
+
+        now = datetime.datetime.now()
+        dtstart = _value(vevent, 'dtstart')
+        start = naive_datetime(dtstart)
+        end = self.parse_end(vevent, dtstart, start)
+        event = Event(
+            uid=self.event_uid(vevent, text),
+            calendar=self.calendar,
+            title=(_value(vevent, 'summary') or '')[:255],
+            description=_value(vevent, 'description'),
+            start=start,
+            end=end,
+            created_on=naive_datetime(_value(vevent, 'created', now)),
+            updated_on=now,
+        )
+        # not checked for double bookings when saved one by one either
+        event._conflicts_checked = True
+        exdates = []
+        rrules = getattr(vevent, 'rrule_list', [])
+        if len(rrules) == 1:
+            try:
+                event.rule, event.end_recurring_period = self.get_rule(rrules[0].value)
+            except ValueError:
+                self.unsupported += 1
+            else:
+                for exdate in getattr(vevent, 'exdate_list', []):
+                    exdates.extend([naive_datetime(value) for value in exdate.value])
+        elif rrules:
+            self.unsupported += 1
+        return event, exdates
+
+    def parse_end(self, vevent, dtstart, start):
+        dtend = _value(vevent, 'dtend')
+        if dtend is not None:
+            return naive_datetime(dtend)
+        duration = _value(vevent, 'duration')
+        if duration is not None:
+            return start + duration
+        if not isinstance(dtstart, datetime.datetime):
+            # all day event
+            return start + datetime.timedelta(days=1)
+        return start
+
+    def parse_override(self, vevent, text):
+        dtstart = _value(vevent, 'dtstart')
+        start = naive_datetime(dtstart)
+        return {
+            'uid': self.event_uid(vevent, text),
+            'original_start': naive_datetime(_value(vevent, 'recurrence_id')),
+            'start': start,
+            'end': self.parse_end(vevent, dtstart, start),
+            'title': _value(vevent, 'summary'),
+            'description': _value(vevent, 'description'),
+            'cancelled': (_value(vevent, 'status') or '').upper() == 'CANCELLED',
+        }
+
+    def get_rule(self, value):
+        """
+        Returns the Rule for the RRULE ``value``, shared by every event with
+        the same recurrence, and the end of the recurrence.
+        """
+        from appointments.models import Rule
+        from appointments.recurrence import from_rrule_string
+
+        frequency, params, until = from_rrule_string(value)
+        key = (frequency, params)
+        rule = self.rules.get(key)
+        if rule is None:
+            rules = Rule.objects.filter(frequency=frequency)
+            if params is None:
+                rules = rules.filter(params__isnull=True)
+            else:
+                rules = rules.filter(params=params)
+            try:
+                rule = rules[0]
+            except IndexError:
+                name = frequency.capitalize()
+                if params is not None:
+                    name = '%s %s' % (name, params)
+                rule = Rule.objects.create(name=name[:32], frequency=frequency,
+                    params=params, description=value)
+            self.rules[key] = rule
+        return rule, until
+
+    def import_events(self, parsed):
+        """
+        Inserts the events ``parsed`` which aren't in the calendar yet, and
+        their excluded occurrences, in a single transaction.
+        """
+        from appointments.models import Event
+
+        with transaction.commit_on_success():
+            existing = set()
+            for chunk in _chunks(parsed, self.batch_size):
+                existing.update(Event.objects.filter(calendar=self.calendar,
+                    uid__in=[event.uid for event, exdates in chunk]).values_list('uid', flat=True))
+            new = []
+            for event, exdates in parsed:
+                if event.uid not in existing:
+                    # the first of the events of the file with the same UID
+                    existing.add(event.uid)
+                    new.append((event, exdates))
+            self.skipped += len(parsed) - len(new)
+
+            for chunk in _chunks(new, self.batch_size):
+                bulk_create(Event, [event for event, exdates in chunk])
+                pks = dict(Event.objects.filter(calendar=self.calendar,
+                    uid__in=[event.uid for event, exdates in chunk]).values_list('uid', 'pk'))
+                for event, exdates in chunk:
+                    event.pk = pks[event.uid]
+
+            occurrences = []
+            for event, exdates in new:
+                for exdate in sorted(set(exdates)):
+                    occurrences.append(self.make_occurrence(event, exdate,
+                        exdate + (event.end - event.start), cancelled=True))
+            self.insert_occurrences(occurrences)
+            self.log_changes([event.pk for event, exdates in new], events=True)
+        self.imported += len(new)
+        self.index_events([event for event, exdates in new])
+        if self.verbosity > 1:
+            print "%d events imported ..." % self.imported
+
+    def import_overrides(self):
+        """
+        Inserts an Occurrence for each pending VEVENT overriding an occurrence
+        (RECURRENCE-ID) of an event of the calendar.  The overrides of events
+        which aren't imported yet are kept until the next call.
+        """
+        from appointments.models import Event, Occurrence
+
+        unmatched = []
+        for chunk in _chunks(self.overrides, self.batch_size):
+            with transaction.commit_on_success():
+                events = Event.objects.filter(calendar=self.calendar,
+                    uid__in=set([override['uid'] for override in chunk]))
+                events = dict([(event.uid, event) for event in events])
+                existing = set(Occurrence.objects.filter(event__in=events.values())
+                    .values_list('event', 'original_start'))
+                occurrences = []
+                for override in chunk:
+                    event = events.get(override['uid'])
+                    if event is None:
+                        unmatched.append(override)
+                        continue
+                    if (event.pk, override['original_start']) in existing:
+                        continue
+                    existing.add((event.pk, override['original_start']))
+                    occurrences.append(self.make_occurrence(event,
+                        override['start'], override['end'],
+                        override['original_start'], override['cancelled'],
+                        override['title'], override['description']))
+                self.insert_occurrences(occurrences)
+                self.log_changes(set([occurrence.event.pk for occurrence in occurrences]))
+            self.index_events(set([occurrence.event for occurrence in occurrences]))
+        self.overrides = unmatched
+
+    def make_occurrence(self, event, start, end, original_start=None,
+                        cancelled=False, title=None, description=None):
+        from appointments.models import Occurrence
+
+        if original_start is None:
+            original_start = start
+        occurrence = Occurrence(event=event, start=start, end=end,
+            original_start=original_start,
+            original_end=original_start + (event.end - event.start),
+            cancelled=cancelled,
+            # None reads the title and description of the event
+            title=title,
+            description=description,
+            updated_on=datetime.datetime.now())
+        occurrence._conflicts_checked = True
+        return occurrence
+
+    def insert_occurrences(self, occurrences):
+        from appointments.models import Occurrence
+
+        for chunk in _chunks(occurrences, self.batch_size):
+            bulk_create(Occurrence, chunk)
+        self.occurrences += len(occurrences)
+
+    def log_changes(self, event_ids, events=False):
+        """
+        Logs the occurrences of the events ``event_ids``, and the events
+        themselves if ``events`` is True, as changes of the calendar.
+        """
+        from appointments.models import CalendarChange, Occurrence
+
+        changes = []
+        if events:
+            changes += [CalendarChange(calendar=self.calendar, kind='event', object_id=pk)
+                        for pk in event_ids]
+        for chunk in _chunks(list(event_ids), self.batch_size):
+            changes += [CalendarChange(calendar=self.calendar, kind='occurrence', object_id=pk)
+                        for pk in Occurrence.objects.filter(event__in=chunk).values_list('pk', flat=True)]
+        for chunk in _chunks(changes, self.batch_size):
+            bulk_create(CalendarChange, chunk)
+
+    def index_events(self, events):
+        from appointments.conf.settings import OCCURRENCE_INDEX
+        from appointments.models import OccurrenceIndex
+
+        if OCCURRENCE_INDEX:
+            for event in events:
+                OccurrenceIndex.objects.index_event(event)
+
+    def calendar_imported(self):
+        from appointments.signals import calendar_changed
+
+        calendar_changed(self.calendar.pk)
@@ -0,0 +1,40 @@
+import datetime
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = "Rebuild the occurrence index, or roll its horizon forward with --extend"
+
+    option_list = BaseCommand.option_list + (
+        make_option('--past', type='int', dest='past',
+            help='Number of days before today covered by the index'),
+        make_option('--future', type='int', dest='future',
+            help='Number of days after today covered by the index'),
+        make_option('--extend', action='store_true', dest='extend', default=False,
+            help='Only index what the previous horizon did not cover'),
+    )
+
+    def handle(self, **options):
+        from appointments.conf.settings import OCCURRENCE_INDEX_PAST_DAYS, OCCURRENCE_INDEX_FUTURE_DAYS
+        from appointments.models import OccurrenceIndex
+
+        past = options.get('past')
+        if past is None:
+            past = OCCURRENCE_INDEX_PAST_DAYS
+        future = options.get('future')
+        if future is None:
+            future = OCCURRENCE_INDEX_FUTURE_DAYS
+
+        today = datetime.datetime.combine(datetime.date.today(), datetime.time.min)
+        start = today - datetime.timedelta(days=past)
+        end = today + datetime.timedelta(days=future)
+
+        if options.get('extend'):
+            print "Extending the occurrence index to %s - %s ..." % (start, end)
+            OccurrenceIndex.objects.extend(start, end)
+        else:
+            print "Rebuilding the occurrence index for %s - %s ..." % (start, end)
+            OccurrenceIndex.objects.rebuild(start, end)
+        print "%d occurrences indexed." % OccurrenceIndex.objects.count()
@@ -2,15 +2,22 @@ import datetime
 
 from django import template
 from django.conf import settings
-from django.core.urlresolvers import reverse
+from django.core.urlresolvers import reverse, get_script_prefix
 from django.utils.dateformat import format
+from django.utils.translation import get_language
 
-from appointments.conf.settings import CHECK_PERMISSION_FUNC
+from appointments import cache
+from appointments.conf.settings import CHECK_PERMISSION_FUNC, CALENDAR_CACHE
+from appointments.layout import layout_period
 from appointments.models import Calendar
 from appointments.periods import weekday_names, weekday_abbrs,  Month
+from appointments.utils import LRUCache
 
 register = template.Library()
 
+_slot_geometry_cache = LRUCache(64)
+_url_prefix_cache = LRUCache(1000)
+
 
 @register.inclusion_tag("schedule/_month_table.html",  takes_context=True)
 def month_table(context,  calendar, month, size="regular", shift=None):
@@ -26,19 +33,51 @@ def month_table(context,  calendar, month, size="regular", shift=None):
     context['calendar'] = calendar
     context['month'] = month
     context['size'] = size
+    # counted once for the whole month, when the first day_cell needs them
+    context['day_counts'] = DayCounts(month)
     return context
 
 @register.inclusion_tag("schedule/_day_cell.html",  takes_context=True)
 def day_cell(context,  calendar, day, month, size="regular" ):
+    day_counts = context.get('day_counts')
+    occurrence_count = None
+    if day.start.month != month.start.month:
+        # not displayed
+        occurrence_count = 0
+    elif day_counts is not None:
+        occurrence_count = day_counts.count(day, month)
+    if occurrence_count is None:
+        occurrence_count = day.occurrence_counts()[0]
     context.update({
         'calendar' : calendar,
         'day' : day,
         'month' : month,
-        'size' : size
+        'size' : size,
+        'occurrence_count' : occurrence_count,
     })
     return context
 
 
+class DayCounts(object):
+    """
+    The occurrence counts of the days of a month, computed on first use.
+    """
+    def __init__(self, month):
+        self.month = month
+        self.counts = None
+
+    def count(self, day, month):
+        """
+        Returns the number of occurrences of ``day``, or None if it isn't in
+        this month.
+        """
+        index = (day.start - self.month.start).days
+        if month.start != self.month.start or not 0 <= index < (self.month.end - self.month.start).days:
+            return None
+        if self.counts is None:
+            self.counts = self.month.occurrence_counts()
+        return self.counts[index]
+
 @register.inclusion_tag("schedule/_daily_table.html", takes_context=True)
 def daily_table( context, day, width, width_slot, height, start=8, end=20, increment=30):
     """
@@ -55,10 +94,9 @@ def daily_table( context, day, width, width_slot, height, start=8, end=20, incre
     context['addable'] = CHECK_PERMISSION_FUNC(None, user)
     width_occ = width - width_slot
     day_part = day.get_time_slot(day.start  + datetime.timedelta(hours=start), day.start  + datetime.timedelta(hours=end))
-    occurrences = day_part.get_occurrences()
-    occurrences = _cook_occurrences(day_part, occurrences, width_occ, height)
+    occurrences = layout_period(day_part, width_occ, height)
     # get slots to display on the left
-    slots = _cook_slots(day_part, increment, width, height)
+    slots = _cook_slots(day, start, end, increment, height)
     context['occurrences'] = occurrences
     context['slots'] = slots
     context['width'] = width
@@ -98,14 +136,20 @@ def create_event_url(context, calendar, slot ):
         'calendar' : calendar,
         'MEDIA_URL' : getattr(settings, "MEDIA_URL"),
     })
-    lookup_context = {
-        'calendar_slug': calendar.slug,
-    }
     context['create_event_url'] ="%s%s" % (
-        reverse( "calendar_create_event", kwargs=lookup_context),
+        _create_event_url_prefix(calendar.slug),
         querystring_for_date(slot))
     return context
 
+def _create_event_url_prefix(calendar_slug):
+    # reversed once per calendar (and script prefix) rather than per slot
+    key = (calendar_slug, get_script_prefix())
+    url = _url_prefix_cache.get(key)
+    if url is None:
+        url = reverse("calendar_create_event", kwargs={'calendar_slug': calendar_slug})
+        _url_prefix_cache.set(key, url)
+    return url
+
 class CalendarNode(template.Node):
     def __init__(self, content_object, distinction, context_var, create=False):
         self.content_object = template.Variable(content_object)
@@ -165,6 +209,42 @@ def do_get_or_create_calendar_for_object(parser, token):
         raise template.TemplateSyntaxError, "%r tag follows form %r <content_object> [named <calendar name>] [by <distinction>] as <context_var>" % (token.split_contents()[0], token.split_contents()[0])
     return CreateCalendarNode(obj, distinction, context_var, name)
 
+class CalendarCacheNode(template.Node):
+    def __init__(self, nodelist, calendar, period, vary_on):
+        self.nodelist = nodelist
+        self.calendar = template.Variable(calendar)
+        self.period = template.Variable(period)
+        self.vary_on = [template.Variable(var) for var in vary_on]
+
+    def render(self, context):
+        if not CALENDAR_CACHE:
+            return self.nodelist.render(context)
+        calendar = self.calendar.resolve(context)
+        period = self.period.resolve(context)
+        calendar_ids, event_ids = cache.events_parts(period.events)
+        parts = ('fragment', calendar.slug, get_language(), period.start.isoformat(),
+                 period.end.isoformat()) + tuple([var.resolve(context) for var in self.vary_on])
+        return cache.get_or_set([calendar.pk] + calendar_ids, parts + event_ids,
+            lambda: self.nodelist.render(context))
+
+def do_calendarcache(parser, token):
+    """
+    Caches the contents of the block until one of the events of the period
+    or the calendar changes, when CALENDAR_CACHE is set.  The fragment is
+    cached for each value of the optional vary on arguments.
+
+    {% calendarcache <calendar> <period> [vary on ...] %}
+        ...
+    {% endcalendarcache %}
+    """
+    contents = token.split_contents()
+    if len(contents) < 3:
+        raise template.TemplateSyntaxError, "%r tag follows form %r <calendar> <period> [vary on ...]" % (contents[0], contents[0])
+    nodelist = parser.parse(('endcalendarcache',))
+    parser.delete_first_token()
+    return CalendarCacheNode(nodelist, contents[1], contents[2], contents[3:])
+
+register.tag('calendarcache', do_calendarcache)
 register.tag('get_calendar', do_get_calendar_for_object)
 register.tag('get_or_create_calendar', do_get_or_create_calendar_for_object)
 
@@ -207,80 +287,37 @@ def detail( occurrence ):
     }
     return context
 
-def _cook_occurrences(period, occs, width, height):
-    """ Prepare occurrences to be displayed.
-        Calculate dimensions and position (in px) for each occurrence.
-        The algorithm tries to fit overlapping occurrences so that they require a minimum
-        number of "columns".
+def _slot_geometry(start, end, increment, height):
+    """
+        Returns the (offset from midnight, top, height) of the slots of a
+        daily table, which only depend on the arguments.
         Arguments:
-        period - time period for the whole series
-        occs - occurrences to be displayed
+        start - hour at which the day starts
+        end - hour at which the day ends
         increment - slot size in minutes
-        width - width of the occurrences column (px)
         height - height of the table (px)
     """
-    last = {}
-    # find out which occurrences overlap
-    for o in occs:
-        o.data = period.classify_occurrence(o)
-        if not o.data:
-            occs.remove(o)
-            continue
-        o.level = -1
-        o.max = 0
-        if not last:
-            last[0] = o
-            o.level = 0
-        else:
-            for k in sorted(last.keys()):
-                if last[k].end <= o.start:
-                    o.level = k
-                    last[k] = o
-                    break
-            if o.level == -1:
-                k = k + 1
-                last[k] = o
-                o.level = k
-    # calculate position and dimensions
-    for o in occs:
-        # number of overlapping occurrences
-        o.max = len([n for n in occs if not(n.end<=o.start or n.start>=o.end)])
-    for o in occs:
-        o.cls = o.data['class']
-        o.real_start = max(o.start, period.start)
-        o.real_end = min(o.end, period.end)
-        # number of "columns" is a minimum number of overlaps for each overlapping group
-        o.max = min([n.max for n in occs if not(n.end<=o.start or n.start>=o.end)] or [1])
-        w = int(width / (o.max))
-        o.width = w - 2
-        o.left = w * o.level
-        o.top = int(height * (float((o.real_start - period.start).seconds) / (period.end - period.start).seconds))
-        o.height = int(height * (float((o.real_end - o.real_start).seconds) / (period.end - period.start).seconds))
-        o.height = min(o.height, height - o.top) # trim what extends beyond the area
-    return occs
-
-
-def _cook_slots(period, increment, width, height):
+    key = (start, end, increment, height)
+    geometry = _slot_geometry_cache.get(key)
+    if geometry is None:
+        tdiff = datetime.timedelta(minutes=increment)
+        num = ((end - start) * 3600) / tdiff.seconds
+        slot_height = int(height / float(num))
+        geometry = tuple([(datetime.timedelta(hours=start) + tdiff * i, slot_height * i, slot_height)
+                          for i in range(num)])
+        _slot_geometry_cache.set(key, geometry)
+    return geometry
+
+def _cook_slots(day, start, end, increment, height):
     """
-        Prepare slots to be displayed on the left hand side
-        calculate dimensions (in px) for each slot.
+        Prepare slots to be displayed on the left hand side: their start
+        and their dimensions (in px).
         Arguments:
-        period - time period for the whole series
-        increment - slot size in minutes
-        width - width of the slot column (px)
-        height - height of the table (px)
+        day - the day displayed
+        start, end, increment, height - see _slot_geometry
     """
-    tdiff = datetime.timedelta(minutes=increment)
-    num = (period.end - period.start).seconds/tdiff.seconds
-    s = period.start
-    slots = []
-    for i in range(num):
-        sl = period.get_time_slot(s, s + tdiff)
-        sl.top = int(height / float(num)) * i
-        sl.height = int(height / float(num))
-        slots.append(sl)
-        s = s + tdiff
-    return slots
+    return [{'start': day.start + offset, 'top': top, 'height': slot_height}
+            for offset, top, slot_height in _slot_geometry(start, end, increment, height)]
 
 @register.simple_tag
 def hash_occurrence(occ):
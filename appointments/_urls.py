@@ -2,8 +2,8 @@ from django.conf.urls.defaults import *
 from django.views.generic.list_detail import object_list
 
 from .models import Calendar
-from .feeds import UpcomingEventsFeed
-from .feeds import CalendarICalendar
+from .feeds import UpcomingEventsFeed, upcoming_events_feed
+from .feeds import CalendarICalendar, CalendarFreeBusy
 from .periods import Year, Month, Week, Day
 
 info_dict = {
@@ -48,6 +48,14 @@ url(r'^calendar/daily/(?P<calendar_slug>[-\w]+)/$',
     name = "day_calendar",
     kwargs={'periods': [Day], 'template_name': 'schedule/calendar_day.html'}),
 
+url(r'^calendar/occurrences/(?P<calendar_slug>[-\w]+)/$',
+    'schedule.views.calendar_occurrences',
+    name = "calendar_occurrences"),
+
+url(r'^calendar/changes/(?P<calendar_slug>[-\w]+)/$',
+    'schedule.views.calendar_changes',
+    name = "calendar_changes"),
+
 url(r'^calendar/(?P<calendar_slug>[-\w]+)/$',
     'schedule.views.calendar',
     name = "calendar_home",
@@ -92,10 +100,11 @@ url(r'^occurrence/edit/(?P<event_id>\d+)/(?P<year>\d+)/(?P<month>\d+)/(?P<day>\d
 
 #feed urls 
 url(r'^feed/calendar/(.*)/$',
-    'django.contrib.syndication.views.feed', 
+    upcoming_events_feed,
     { "feed_dict": { "upcoming": UpcomingEventsFeed } }),
  
 (r'^ical/calendar/(.*)/$', CalendarICalendar()),
+(r'^ical/freebusy/(.*)/$', CalendarFreeBusy()),
 
  url(r'$', object_list, info_dict, name='schedule'), 
 )
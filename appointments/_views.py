@@ -1,19 +1,25 @@
 from urllib import quote
 from django.shortcuts import render_to_response, get_object_or_404
 from django.views.generic.create_update import delete_object
-from django.http import HttpResponseRedirect, Http404, HttpResponse
+from django.http import HttpResponseRedirect, Http404, HttpResponse, HttpResponseBadRequest
 from django.template import RequestContext
 from django.core.urlresolvers import reverse
 from django.contrib.auth.models import User
 from django.contrib.auth.decorators import login_required
 from django.views.generic.create_update import delete_object
+from django.views.decorators.http import condition
+from django.utils.translation import get_language
 import datetime
+import inspect
+import json
 
 from .conf.settings import GET_EVENTS_FUNC, OCCURRENCE_CANCEL_REDIRECT
+from .conf.settings import OCCURRENCE_PAGE_SIZE, OCCURRENCE_MAX_PAGE_SIZE
 from .forms import EventForm, OccurrenceForm
 from .models import *
-from .periods import weekday_names
-from .utils import check_event_permissions, coerce_date_dict
+from .periods import Period, weekday_names
+from .recurrence import to_rrule_string
+from .utils import calendar_etag, check_event_permissions, coerce_date_dict
 
 
 def calendar(request, calendar_slug, template='schedule/calendar.html'):
@@ -34,6 +40,36 @@ def calendar(request, calendar_slug, template='schedule/calendar.html'):
     }, context_instance=RequestContext(request))
 
 
+def _calendar_updated_on(request, calendar_slug):
+    # read once for both the ETag and the Last-Modified of a request
+    if not hasattr(request, '_calendar_updated_on'):
+        request._calendar_updated_on = Calendar.objects.get_updated_on(slug=calendar_slug)
+    return request._calendar_updated_on
+
+
+def _calendar_by_periods_etag(request, calendar_slug, periods=None, template_name=None):
+    updated_on = _calendar_updated_on(request, calendar_slug)
+    if updated_on is None:
+        return None
+    # without a date in the query string the periods of today are displayed
+    return calendar_etag(updated_on, request.get_full_path(), template_name,
+        request.user.id, get_language(), datetime.date.today())
+
+
+def _calendar_by_periods_last_modified(request, calendar_slug, periods=None, template_name=None):
+    updated_on = _calendar_updated_on(request, calendar_slug)
+    if updated_on is None:
+        return None
+    dates = [updated_on]
+    if not coerce_date_dict(request.GET):
+        dates.append(datetime.datetime.combine(datetime.date.today(), datetime.time.min))
+    if request.user.is_authenticated():
+        dates.append(request.user.last_login)
+    return max(dates)
+
+
+@condition(etag_func=_calendar_by_periods_etag,
+           last_modified_func=_calendar_by_periods_last_modified)
 def calendar_by_periods(request, calendar_slug, periods=None, template_name="schedule/calendar_by_period.html"):
     """
     This view is for getting a calendar, but also getting periods with that
@@ -66,6 +102,8 @@ def calendar_by_periods(request, calendar_slug, periods=None, template_name="sch
         This is for convenience. It returns the local names of weekedays for
         internationalization.
 
+    Conditional GETs are answered from the ``updated_on`` of the calendar
+    (see Calendar.objects.get_updated_on) before any event is loaded.
     """
     calendar = get_object_or_404(Calendar, slug=calendar_slug)
     date = coerce_date_dict(request.GET)
@@ -76,7 +114,12 @@ def calendar_by_periods(request, calendar_slug, periods=None, template_name="sch
             raise Http404
     else:
         date = datetime.datetime.now()
-    event_list = GET_EVENTS_FUNC(request, calendar)
+    # the templates also display the periods right before and after the
+    # requested ones, so fetch the events of that whole range
+    bounds = [period([], date) for period in periods]
+    start = min([period.prev().start for period in bounds])
+    end = max([period.next().end for period in bounds])
+    event_list = get_events(request, calendar, start, end)
     period_objects = dict([(period.__name__.lower(), period(event_list, date)) for period in periods])
     return render_to_response(template_name,{
             'date': date,
@@ -87,6 +130,281 @@ def calendar_by_periods(request, calendar_slug, periods=None, template_name="sch
         },context_instance=RequestContext(request),)
 
 
+# what each of the ``fields`` of calendar_occurrences gives for an occurrence
+OCCURRENCE_FIELDS = {
+    'id': lambda occurrence: occurrence.pk,
+    'event': lambda occurrence: occurrence.event.pk,
+    'title': lambda occurrence: occurrence.title,
+    'description': lambda occurrence: occurrence.description,
+    'start': lambda occurrence: occurrence.start.isoformat(),
+    'end': lambda occurrence: occurrence.end.isoformat(),
+    'original_start': lambda occurrence: occurrence.original_start.isoformat(),
+    'original_end': lambda occurrence: occurrence.original_end.isoformat(),
+    'cancelled': lambda occurrence: occurrence.cancelled,
+}
+DEFAULT_OCCURRENCE_FIELDS = ('id', 'event', 'title', 'start', 'end', 'cancelled')
+CURSOR_FORMAT = '%Y%m%d%H%M%S%f'
+# the first window of time calendar_occurrences expands for a page, doubled
+# until the page is full
+OCCURRENCE_WINDOW = datetime.timedelta(days=7)
+
+
+def _parse_datetime(value):
+    for format in ('%Y-%m-%dT%H:%M:%S', '%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M', '%Y-%m-%d'):
+        try:
+            return datetime.datetime.strptime(value, format)
+        except ValueError:
+            pass
+    raise ValueError("Invalid date %r" % value)
+
+
+def _occurrence_key(occurrence):
+    # occurrences compare by start and end only, this orders them totally
+    return (occurrence.start, occurrence.end, occurrence.event.pk, occurrence.original_start)
+
+
+def _encode_cursor(key):
+    start, end, event_id, original_start = key
+    return '.'.join([start.strftime(CURSOR_FORMAT), end.strftime(CURSOR_FORMAT),
+                     str(event_id), original_start.strftime(CURSOR_FORMAT)])
+
+
+def _decode_cursor(cursor):
+    start, end, event_id, original_start = cursor.split('.')
+    return (datetime.datetime.strptime(start, CURSOR_FORMAT),
+            datetime.datetime.strptime(end, CURSOR_FORMAT), int(event_id),
+            datetime.datetime.strptime(original_start, CURSOR_FORMAT))
+
+
+def _occurrences_page(events, start, end, cursor, size):
+    """
+    Returns the first ``size`` occurrences of ``events`` between start and
+    end which come after ``cursor``, sorted.  They are expanded over windows
+    of time growing from the cursor until there are enough, rather than over
+    the whole range for every page.
+    """
+    events = list(events)
+    if cursor:
+        # what comes after the cursor starts after it
+        start = max(start, cursor[0])
+    page = []
+    window_start, window = start, OCCURRENCE_WINDOW
+    while True:
+        window_end = min(window_start + window, end)
+        for occurrence in sorted(Period(events, window_start, window_end).occurrences,
+                                 key=_occurrence_key):
+            # those running into the window were in the previous one, and
+            # those starting at its end are in the next one
+            if window_start > start and occurrence.start < window_start:
+                continue
+            if window_end < end and occurrence.start >= window_end:
+                continue
+            if cursor and _occurrence_key(occurrence) <= cursor:
+                continue
+            page.append(occurrence)
+        if len(page) >= size or window_end >= end:
+            return page[:size]
+        window_start, window = window_end, window * 2
+
+
+def _calendar_occurrences_etag(request, calendar_slug):
+    updated_on = _calendar_updated_on(request, calendar_slug)
+    if updated_on is not None:
+        return calendar_etag(updated_on, request.get_full_path(), request.user.id)
+
+
+def _calendar_occurrences_last_modified(request, calendar_slug):
+    updated_on = _calendar_updated_on(request, calendar_slug)
+    if updated_on is None:
+        return None
+    if request.user.is_authenticated():
+        return max(updated_on, request.user.last_login)
+    return updated_on
+
+
+@condition(etag_func=_calendar_occurrences_etag,
+           last_modified_func=_calendar_occurrences_last_modified)
+def calendar_occurrences(request, calendar_slug):
+    """
+    Returns the occurrences of a calendar between the ``start`` and ``end``
+    of the query string as JSON, for calendars rendered by JavaScript.
+
+    ``fields`` is a comma separated list of the fields returned (see
+    OCCURRENCE_FIELDS), ``limit`` the number of occurrences per page
+    (OCCURRENCE_PAGE_SIZE by default) and ``cursor`` the ``next`` cursor of
+    the previous page.
+
+    By default the occurrences are returned as columns:
+
+        {"fields": ["start", "title"],
+         "occurrences": {"start": [...], "title": [...]},
+         "count": 2, "next": "..."}
+
+    With ``format=ndjson`` every occurrence is a JSON object on its own line,
+    and the cursor of the next page is in the X-Next-Cursor header.
+    ``next`` is null on the last page.
+    """
+    calendar = get_object_or_404(Calendar, slug=calendar_slug)
+    try:
+        start = _parse_datetime(request.GET['start'])
+        end = _parse_datetime(request.GET['end'])
+        limit = min(int(request.GET.get('limit', OCCURRENCE_PAGE_SIZE)), OCCURRENCE_MAX_PAGE_SIZE)
+        if limit < 1:
+            raise ValueError("limit must be positive")
+        cursor = request.GET.get('cursor')
+        if cursor:
+            cursor = _decode_cursor(cursor)
+    except (KeyError, ValueError):
+        return HttpResponseBadRequest("start and end are required dates, limit a number and cursor a cursor from a previous page")
+    fields = request.GET.get('fields')
+    fields = fields and fields.split(',') or DEFAULT_OCCURRENCE_FIELDS
+    unknown = [field for field in fields if field not in OCCURRENCE_FIELDS]
+    if unknown:
+        return HttpResponseBadRequest("Unknown fields: %s" % ', '.join(unknown))
+
+    event_list = get_events(request, calendar, start, end)
+    # one more tells whether there is a next page
+    page = _occurrences_page(event_list, start, end, cursor, limit + 1)
+    next = None
+    if len(page) > limit:
+        page = page[:limit]
+        next = _encode_cursor(_occurrence_key(page[-1]))
+
+    getters = [OCCURRENCE_FIELDS[field] for field in fields]
+    if request.GET.get('format') == 'ndjson':
+        lines = [json.dumps(dict([(field, getter(occurrence)) for field, getter in zip(fields, getters)]))
+                 for occurrence in page]
+        response = HttpResponse(''.join([line + '\n' for line in lines]),
+                                content_type='application/x-ndjson')
+        if next:
+            response['X-Next-Cursor'] = next
+        return response
+    columns = dict([(field, [getter(occurrence) for occurrence in page])
+                    for field, getter in zip(fields, getters)])
+    return HttpResponse(json.dumps({
+        'fields': fields,
+        'occurrences': columns,
+        'count': len(page),
+        'next': next,
+    }), content_type='application/json')
+
+
+# the fields of the events and relations returned by calendar_changes
+EVENT_FIELDS = {
+    'id': lambda event: event.pk,
+    'uid': lambda event: event.uid,
+    'title': lambda event: event.title,
+    'description': lambda event: event.description,
+    'start': lambda event: event.start.isoformat(),
+    'end': lambda event: event.end.isoformat(),
+    'rrule': lambda event: event.rule and to_rrule_string(event.rule, event.start,
+                                                          event.end_recurring_period),
+    'updated_on': lambda event: event.updated_on.isoformat(),
+}
+RELATION_FIELDS = {
+    'id': lambda relation: relation.pk,
+    'content_type': lambda relation: '%s.%s' % (relation.content_type.app_label,
+                                                relation.content_type.model),
+    'object_id': lambda relation: relation.object_id,
+    'distinction': lambda relation: relation.distinction,
+    'inheritable': lambda relation: relation.inheritable,
+}
+EVENT_RELATION_FIELDS = {
+    'id': lambda relation: relation.pk,
+    'event': lambda relation: relation.event_id,
+    'content_type': lambda relation: '%s.%s' % (relation.content_type.app_label,
+                                                relation.content_type.model),
+    'object_id': lambda relation: relation.object_id,
+    'distinction': lambda relation: relation.distinction,
+}
+
+
+def _serialize(objects, fields):
+    return [dict([(name, getter(obj)) for name, getter in fields.items()])
+            for obj in objects]
+
+
+def calendar_changes(request, calendar_slug):
+    """
+    Returns the events, persisted occurrences, relations and event relations
+    of a calendar which changed since the ``since`` token of the query
+    string, as JSON:
+
+        {"token": "42", "full": false,
+         "events": [...], "occurrences": [...], "relations": [...],
+         "event_relations": [...],
+         "deleted": {"events": [...], "occurrences": [...], "relations": [...],
+                     "event_relations": [...]}}
+
+    ``deleted`` holds the ids of the objects deleted or moved to another
+    calendar; the occurrences and event relations of a deleted event are
+    deleted with it.  The
+    ``token`` is given back as ``since`` at the next synchronization.  Without
+    ``since`` everything is returned and ``full`` is true.
+    """
+    calendar = get_object_or_404(Calendar, slug=calendar_slug)
+    events = calendar.events.select_related('rule')
+    occurrences = Occurrence.objects.with_events().filter(event__calendar=calendar)
+    relations = CalendarRelation.objects.filter(calendar=calendar).select_related('content_type')
+    event_relations = EventRelation.objects.filter(event__calendar=calendar).select_related('content_type')
+    since = request.GET.get('since')
+    full = not since
+    deleted = {'events': [], 'occurrences': [], 'relations': [], 'event_relations': []}
+    if not full:
+        try:
+            since = int(since)
+        except ValueError:
+            return HttpResponseBadRequest("since must be a token returned by this view")
+        token, changed = CalendarChange.objects.changes_since(calendar.pk, since)
+        if changed['rule']:
+            # the RRULE is part of the events
+            for pk in events.filter(rule__in=changed['rule'].keys()).values_list('pk', flat=True):
+                changed['event'].setdefault(pk, False)
+        changes = []
+        for name, kind, queryset in (('events', 'event', events),
+                                     ('occurrences', 'occurrence', occurrences),
+                                     ('relations', 'relation', relations),
+                                     ('event_relations', 'event_relation', event_relations)):
+            saved = [pk for pk, is_deleted in changed[kind].items() if not is_deleted]
+            found = list(queryset.filter(pk__in=saved))
+            found_ids = set([obj.pk for obj in found])
+            deleted[name] = sorted([pk for pk, is_deleted in changed[kind].items()
+                                    if is_deleted or pk not in found_ids])
+            changes.append(found)
+        events, occurrences, relations, event_relations = changes
+    else:
+        # read before the objects, so that what changes meanwhile is sent again
+        token = CalendarChange.objects.get_token(calendar.pk)
+    return HttpResponse(json.dumps({
+        'token': str(token),
+        'full': full,
+        'events': _serialize(events, EVENT_FIELDS),
+        'occurrences': _serialize(occurrences, OCCURRENCE_FIELDS),
+        'relations': _serialize(relations, RELATION_FIELDS),
+        'event_relations': _serialize(event_relations, EVENT_RELATION_FIELDS),
+        'deleted': deleted,
+    }), content_type='application/json')
+
+
+def get_events(request, calendar, start, end):
+    """
+    Calls GET_EVENTS_FUNC, passing it the range to display only if it takes
+    more than the request and the calendar.  Callables which can't be
+    inspected (functools.partial objects, callable instances...) are given
+    ``start`` and ``end`` as keyword arguments if they accept them.
+    """
+    try:
+        args, varargs, varkw, defaults = inspect.getargspec(GET_EVENTS_FUNC)
+    except TypeError:
+        try:
+            return GET_EVENTS_FUNC(request, calendar, start=start, end=end)
+        except TypeError:
+            return GET_EVENTS_FUNC(request, calendar)
+    if len(args) < 4 and varargs is None:
+        return GET_EVENTS_FUNC(request, calendar)
+    return GET_EVENTS_FUNC(request, calendar, start, end)
+
+
 def event(request, event_id, template_name="schedule/event.html"):
     """
     This view is for showing an event. It is important to remember that an
@@ -142,12 +460,13 @@ def occurrence(request, event_id, template_name="schedule/occurrence.html", *arg
 def edit_occurrence(request, event_id,
     template_name="schedule/edit_occurrence.html", *args, **kwargs):
     event, occurrence = get_occurrence(event_id, *args, **kwargs)
+    if isinstance(occurrence, VirtualOccurrence):
+        occurrence = occurrence.persist()
     next = kwargs.get('next', None)
     form = OccurrenceForm(data=request.POST or None, instance=occurrence)
     if form.is_valid():
-        occurrence = form.save(commit=False)
-        occurrence.event = event
-        occurrence.save()
+        form.instance.event = event
+        occurrence = form.save()
         next = next or get_next_url(request, occurrence.get_absolute_url())
         return HttpResponseRedirect(next)
     next = next or get_next_url(request, occurrence.get_absolute_url())
@@ -167,6 +486,8 @@ def cancel_occurrence(request, event_id,
     conformation to cancel.
     """
     event, occurrence = get_occurrence(event_id, *args, **kwargs)
+    if isinstance(occurrence, VirtualOccurrence):
+        occurrence = occurrence.persist()
     next = kwargs.get('next',None) or get_next_url(request, event.get_absolute_url())
     if request.method != "POST":
         return render_to_response(template_name, {
@@ -187,7 +508,7 @@ def get_occurrence(event_id, occurrence_id=None, year=None, month=None,
     which method is used.
     """
     if(occurrence_id):
-        occurrence = get_object_or_404(Occurrence, id=occurrence_id)
+        occurrence = get_object_or_404(Occurrence.objects.with_events(), id=occurrence_id)
         event = occurrence.event
     elif(all((year, month, day, hour, minute, second))):
         event = get_object_or_404(Event, id=event_id)
@@ -256,14 +577,13 @@ def create_or_edit_event(request, calendar_slug, event_id=None, next=None,
     calendar = get_object_or_404(Calendar, slug=calendar_slug)
 
     form = form_class(data=request.POST or None, instance=instance,
-        hour24=True, initial=initial_data)
+        hour24=True, calendar=calendar, initial=initial_data)
 
     if form.is_valid():
-        event = form.save(commit=False)
         if instance is None:
-            event.creator = request.user
-            event.calendar = calendar
-        event.save()
+            form.instance.creator = request.user
+            form.instance.calendar = calendar
+        event = form.save()
         next = next or reverse('event', args=[event.id])
         next = get_next_url(request, next)
         return HttpResponseRedirect(next)
@@ -1,15 +1,153 @@
-from tastypie import fields
-from tastypie.resources import ModelResource, ALL
+from django.db import transaction
+from django.http import HttpResponse
 
-from ..models import Event
+from tastypie import fields, http
+from tastypie.authorization import Authorization
+from tastypie.resources import ModelResource, ALL, ALL_WITH_RELATIONS
+from tastypie.utils import dict_strip_unicode_keys
 
+from .. import cache
+from ..conf.settings import CALENDAR_CACHE, CHECK_PERMISSION_FUNC
+from ..models import Calendar, Event, Occurrence, Rule
+
+
+class CheckPermissionAuthorization(Authorization):
+    """
+    Anyone can read, writing requires CHECK_PERMISSION_FUNC to allow it.
+    """
+    def is_authorized(self, request, object=None):
+        if request.method == 'GET':
+            return True
+        if isinstance(object, Occurrence):
+            object = object.event
+        return CHECK_PERMISSION_FUNC(object, request.user)
+
+
+class BulkResource(ModelResource):
+    """
+    A PATCH on a list creates and updates all the objects given (see
+    tastypie's patch_list), and a POST on a list accepts several objects as
+    {"objects": [...]}.  Either way the objects are saved in a single
+    transaction.
+
+    When CALENDAR_CACHE is set, the GET lists filtered by one of the
+    ``calendar_filters`` are cached until the calendar changes.
+    """
+    calendar_filters = ('calendar',)
+
+    def patch_list(self, request, **kwargs):
+        with transaction.commit_on_success():
+            return super(BulkResource, self).patch_list(request, **kwargs)
+
+    def post_list(self, request, **kwargs):
+        deserialized = self.deserialize(request, request.raw_post_data,
+            format=request.META.get('CONTENT_TYPE', 'application/json'))
+        if not isinstance(deserialized, dict) or 'objects' not in deserialized:
+            return super(BulkResource, self).post_list(request, **kwargs)
+        with transaction.commit_on_success():
+            for data in deserialized['objects']:
+                data = self.alter_deserialized_detail_data(request, data)
+                bundle = self.build_bundle(data=dict_strip_unicode_keys(data), request=request)
+                self.is_valid(bundle, request)
+                self.obj_create(bundle, request=request, **self.remove_api_resource_names(kwargs))
+        return http.HttpCreated()
+
+    def get_calendar_id(self, request):
+        for name in self.calendar_filters:
+            value = request.GET.get(name, '')
+            if value.isdigit():
+                return int(value)
+
+    def get_list(self, request, **kwargs):
+        calendar_id = self.get_calendar_id(request)
+        if not CALENDAR_CACHE or calendar_id is None:
+            return super(BulkResource, self).get_list(request, **kwargs)
+        parts = ('api', self._meta.resource_name, request.user.id,
+                 self.determine_format(request)) + tuple(sorted(request.GET.lists()))
+        cached = cache.get_cached(calendar_id, parts)
+        if cached is None:
+            response = super(BulkResource, self).get_list(request, **kwargs)
+            if response.status_code != 200:
+                return response
+            cached = (response['Content-Type'], response.content)
+            cache.set_cached(calendar_id, parts, cached)
+        content_type, content = cached
+        return HttpResponse(content, content_type=content_type)
+
+
+class CalendarResource(ModelResource):
+    class Meta:
+        queryset = Calendar.objects.all()
+        resource_name = 'calendar'
+        filtering = {
+            'slug': ('exact',),
+        }
+
+
+class RuleResource(ModelResource):
+    class Meta:
+        queryset = Rule.objects.all()
+        resource_name = 'rule'
+
+
+class EventResource(BulkResource):
+    calendar = fields.ForeignKey(CalendarResource, 'calendar')
+    rule = fields.ForeignKey(RuleResource, 'rule', null=True, blank=True)
+    creator = fields.CharField(attribute='creator__username', null=True, readonly=True)
 
-class EventResource(ModelResource):
     class Meta:
-        queryset = Event.objects.all()
+        queryset = Event.objects.select_related('rule', 'calendar', 'creator')
         resource_name = 'event'
+        list_allowed_methods = ('get', 'post', 'patch')
+        detail_allowed_methods = ('get', 'put', 'patch', 'delete')
+        authorization = CheckPermissionAuthorization()
+        filtering = {
+            'calendar': ALL_WITH_RELATIONS,
+            'start': ALL,
+            'end': ALL,
+            'end_recurring_period': ALL,
+            'updated_on': ALL,
+            'uid': ('exact',),
+        }
+        ordering = ('start', 'end', 'updated_on')
+
+
+class OccurrenceResource(BulkResource):
+    """
+    The persisted occurrences.  ``calendar`` filters them by the calendar of
+    their event.
+    """
+    event = fields.ForeignKey(EventResource, 'event')
+    calendar_filters = ('calendar', 'event__calendar')
+
+    class Meta:
+        queryset = Occurrence.objects.with_events()
+        resource_name = 'occurrence'
+        list_allowed_methods = ('get', 'post', 'patch')
+        detail_allowed_methods = ('get', 'put', 'patch', 'delete')
+        authorization = CheckPermissionAuthorization()
+        filtering = {
+            'event': ALL_WITH_RELATIONS,
+            'start': ALL,
+            'end': ALL,
+            'original_start': ALL,
+            'updated_on': ALL,
+            'cancelled': ('exact',),
+        }
+        ordering = ('start', 'end', 'updated_on')
+
+    def build_filters(self, filters=None):
+        if filters is None:
+            filters = {}
+        orm_filters = super(OccurrenceResource, self).build_filters(filters)
+        if 'calendar' in filters:
+            orm_filters['event__calendar__exact'] = filters['calendar']
+        return orm_filters
 
 
 EnabledResources = (
+    CalendarResource,
+    RuleResource,
     EventResource,
+    OccurrenceResource,
 )
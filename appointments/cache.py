@@ -0,0 +1,161 @@
+"""
+Per calendar versions, to cache values computed from the events of a
+calendar.
+
+Every calendar has a version number which is bumped whenever one of its
+events, occurrences, rules or relations changes (see appointments.signals).
+Cache keys built with ``calendar_key`` include the versions of the calendars
+they depend on, so they are invalidated without having to know which keys
+were set.
+
+Values are stored in Django's cache and, in front of it, in a process local
+LRU cache of CALENDAR_CACHE_SIZE entries.  Both expire after
+CALENDAR_CACHE_TIMEOUT seconds.  The local cache keeps the values pickled, so
+that, as with Django's cache, every caller gets its own copy to modify.  ``get_stats`` returns the hits, misses and
+sizes of the entries for monitoring.
+"""
+import threading
+import time
+from cPickle import dumps, loads, HIGHEST_PROTOCOL
+from hashlib import md5
+
+from django.core.cache import cache
+
+from .conf.settings import CALENDAR_CACHE_TIMEOUT, CALENDAR_CACHE_SIZE
+from .utils import LRUCache
+
+
+VERSION_KEY = 'appointments:calendar_version:%s'
+
+# versions never expire by themselves
+VERSION_TIMEOUT = 60 * 60 * 24 * 365
+
+_local = LRUCache(CALENDAR_CACHE_SIZE)
+_missing = object()
+
+_stats_lock = threading.Lock()
+_stats = {
+    'hits': 0,
+    'local_hits': 0,
+    'misses': 0,
+    'sets': 0,
+    'bytes': 0,
+    'largest': 0,
+}
+
+
+def _initial_version():
+    # if a version is evicted from the cache it must not start over from a
+    # value it had before, as the keys built with that value may still be
+    # cached
+    return int(time.time() * 1000)
+
+
+def get_calendar_version(calendar_id):
+    key = VERSION_KEY % calendar_id
+    version = cache.get(key)
+    if version is None:
+        version = _initial_version()
+        cache.add(key, version, VERSION_TIMEOUT)
+        version = cache.get(key, version)
+    return version
+
+
+def bump_calendar_version(calendar_id):
+    key = VERSION_KEY % calendar_id
+    try:
+        return cache.incr(key)
+    except ValueError:
+        version = _initial_version()
+        cache.set(key, version, VERSION_TIMEOUT)
+        return version
+
+
+def _calendar_ids(calendar_ids):
+    if isinstance(calendar_ids, (int, long)):
+        return [calendar_ids]
+    return sorted(set(calendar_ids))
+
+
+def calendar_key(calendar_ids, *parts):
+    """
+    Returns a cache key for ``parts`` which changes with the version of the
+    calendar, or of any of the calendars, given as ``calendar_ids``.
+    """
+    versions = ['%s.%s' % (calendar_id, get_calendar_version(calendar_id))
+                for calendar_id in _calendar_ids(calendar_ids)]
+    digest = md5(':'.join([unicode(part) for part in parts]).encode('utf-8')).hexdigest()
+    return 'appointments:%s:%s' % (md5(','.join(versions)).hexdigest(), digest)
+
+
+def events_parts(events):
+    """
+    Returns the ids of the calendars of ``events`` and the key parts
+    identifying them, for values computed from a list of events.
+    """
+    ids = sorted([(event.calendar_id, event.pk) for event in events])
+    return [calendar_id for calendar_id, event_id in ids], \
+        tuple([event_id for calendar_id, event_id in ids])
+
+
+def _count(name, value=1):
+    with _stats_lock:
+        _stats[name] += value
+
+
+def get_cached(calendar_ids, parts, default=None):
+    key = calendar_key(calendar_ids, *parts)
+    entry = _local.get(key)
+    if entry is not None and entry[0] > time.time():
+        _count('local_hits')
+        _count('hits')
+        return loads(entry[1])
+    value = cache.get(key, _missing)
+    if value is _missing:
+        _count('misses')
+        return default
+    _count('hits')
+    _local.set(key, (time.time() + CALENDAR_CACHE_TIMEOUT, dumps(value, HIGHEST_PROTOCOL)))
+    return value
+
+
+def set_cached(calendar_ids, parts, value, timeout=CALENDAR_CACHE_TIMEOUT):
+    key = calendar_key(calendar_ids, *parts)
+    pickled = dumps(value, HIGHEST_PROTOCOL)
+    with _stats_lock:
+        _stats['sets'] += 1
+        _stats['bytes'] += len(pickled)
+        _stats['largest'] = max(_stats['largest'], len(pickled))
+    _local.set(key, (time.time() + timeout, pickled))
+    cache.set(key, value, timeout)
+
+
+def get_or_set(calendar_ids, parts, compute, timeout=CALENDAR_CACHE_TIMEOUT):
+    """
+    Returns the cached value for ``parts``, computing and caching it with
+    ``compute()`` on a miss.
+    """
+    value = get_cached(calendar_ids, parts, _missing)
+    if value is _missing:
+        value = compute()
+        set_cached(calendar_ids, parts, value, timeout)
+    return value
+
+
+def get_stats():
+    """
+    Returns the statistics of this process: the number of ``hits`` (of which
+    ``local_hits`` were served by the local cache), ``misses`` and ``sets``,
+    the total and ``largest`` size in bytes of the values set, and the
+    number of ``local_entries``.
+    """
+    with _stats_lock:
+        stats = dict(_stats)
+    stats['local_entries'] = len(_local)
+    return stats
+
+
+def reset_stats():
+    with _stats_lock:
+        for name in _stats:
+            _stats[name] = 0
@@ -1,3 +1,5 @@
+import datetime
+
 from django.utils.translation import ugettext, ugettext_lazy as _
 from django.conf import settings
 from django.core.exceptions import ImproperlyConfigured
@@ -35,13 +37,62 @@ if not CHECK_PERMISSION_FUNC:
 # Callable used to customize the event list given for a calendar and user
 # (e.g. all events on that calendar, those events plus another calendar's events,
 # or the events filtered based on user permissions)
+# If it accepts them, it also gets the start and end of the range being
+# displayed so it can leave out the events without occurrences in it.
 # Imports have to be placed within the function body to avoid circular imports
 GET_EVENTS_FUNC = getattr(settings, 'GET_EVENTS_FUNC', None)
 if not GET_EVENTS_FUNC:
-    def get_events(request, calendar):
-        return calendar.event_set.all()
+    def get_events(request, calendar, start=None, end=None):
+        if start is None or end is None:
+            return calendar.event_set.select_related('rule')
+        return calendar.event_set.get_for_range(start, end)
 
     GET_EVENTS_FUNC = get_events
 
+# The longest an occurrence of a recurring event lasts: the recurring events
+# whose recurrence ended up to this long before a range are still loaded for
+# it, as their last occurrence may be running in it
+OCCURRENCE_MAX_DURATION = getattr(settings, 'OCCURRENCE_MAX_DURATION', datetime.timedelta(days=7))
+
 # URL to redirect to to after an occurrence is canceled
 OCCURRENCE_CANCEL_REDIRECT = getattr(settings, 'OCCURRENCE_CANCEL_REDIRECT', None)
+
+# Number of compiled recurrence rules (one per rule and event start) kept in
+# memory by appointments.recurrence
+RULE_CACHE_SIZE = getattr(settings, 'RULE_CACHE_SIZE', 1000)
+
+# Whether occurrences are materialized in the OccurrenceIndex table. When
+# enabled the index is kept up to date by signals and read by Period and
+# EventListManager for any range inside the indexed horizon, which is set
+# (and rolled forward) by the rebuild_occurrence_index command.
+OCCURRENCE_INDEX = getattr(settings, 'OCCURRENCE_INDEX', False)
+
+# Default number of days before and after today covered by the index
+OCCURRENCE_INDEX_PAST_DAYS = getattr(settings, 'OCCURRENCE_INDEX_PAST_DAYS', 31)
+OCCURRENCE_INDEX_FUTURE_DAYS = getattr(settings, 'OCCURRENCE_INDEX_FUTURE_DAYS', 365)
+
+# Number of seconds values computed for a calendar (free/busy time for
+# example) are cached for. They are also invalidated as soon as one of the
+# events of the calendar changes.
+CALENDAR_CACHE_TIMEOUT = getattr(settings, 'CALENDAR_CACHE_TIMEOUT', 60 * 60)
+
+# If True, the occurrences of periods and the fragments of the calendar
+# templates are cached too
+CALENDAR_CACHE = getattr(settings, 'CALENDAR_CACHE', False)
+
+# Number of cached values also kept in the memory of each process
+CALENDAR_CACHE_SIZE = getattr(settings, 'CALENDAR_CACHE_SIZE', 1000)
+
+# If True, saving an event or an occurrence which overlaps another occurrence
+# of its calendar raises a ValidationError, and EventForm and OccurrenceForm
+# report it.
+PREVENT_DOUBLE_BOOKING = getattr(settings, 'PREVENT_DOUBLE_BOOKING', False)
+
+# Number of days ahead (from now, or their start if later) the occurrences of
+# recurring events are checked for conflicts
+CONFLICT_HORIZON_DAYS = getattr(settings, 'CONFLICT_HORIZON_DAYS', 365)
+
+# Default and maximum number of occurrences per page of the
+# calendar_occurrences JSON view
+OCCURRENCE_PAGE_SIZE = getattr(settings, 'OCCURRENCE_PAGE_SIZE', 500)
+OCCURRENCE_MAX_PAGE_SIZE = getattr(settings, 'OCCURRENCE_MAX_PAGE_SIZE', 5000)
@@ -0,0 +1,187 @@
+"""
+Detection of overlapping occurrences (double bookings) within a calendar.
+
+The occurrences of the event being booked are expanded over a bounded window
+(from now on for recurring events, until their end of recurring period, at
+most CONFLICT_HORIZON_DAYS ahead).  The
+other occurrences of the calendar are only looked for during the spans of
+those occurrences: read from the occurrence index where it covers them, and
+otherwise expanded for the events which can occur then (see
+EventManager.get_for_range).  Both sorted lists are then compared in a single
+sweep.
+"""
+import datetime
+
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+from django.utils.translation import ugettext
+
+from .conf.settings import CONFLICT_HORIZON_DAYS, OCCURRENCE_INDEX
+from .freebusy import merge_intervals
+from .models import OccurrenceIndex
+from .periods import Period
+
+# spans looked up in the occurrence index per query
+INDEX_SPANS_PER_QUERY = 100
+
+
+def _overlapping(occurrences, others):
+    """
+    Returns the (occurrence, other) pairs which overlap.  Both lists must be
+    sorted by start; occurrences which only touch don't overlap.
+    """
+    conflicts = []
+    active = []
+    position = 0
+    for occurrence in occurrences:
+        while position < len(others) and others[position].start < occurrence.end:
+            active.append(others[position])
+            position += 1
+        active = [other for other in active if other.end > occurrence.start]
+        for other in active:
+            if other.start < occurrence.end:
+                conflicts.append((occurrence, other))
+    return conflicts
+
+
+def _spans_q(spans):
+    # one flat OR of the spans rather than a nested one
+    q = Q(*[Q(start__lt=end, end__gt=start) for start, end in spans])
+    q.connector = Q.OR
+    return q
+
+
+def _indexed_occurrences(calendar, spans, exclude_event=None):
+    occurrences = []
+    for i in range(0, len(spans), INDEX_SPANS_PER_QUERY):
+        rows = OccurrenceIndex.objects.filter(_spans_q(spans[i:i + INDEX_SPANS_PER_QUERY]),
+                                              calendar=calendar, cancelled=False)
+        if exclude_event is not None:
+            rows = rows.exclude(event=exclude_event)
+        rows = rows.select_related('event', 'event__rule', 'persisted_occurrence')
+        occurrences += [row.get_occurrence() for row in rows]
+    return occurrences
+
+
+def _expanded_occurrences(calendar, spans, exclude_event=None):
+    events = calendar.event_set.get_for_range(spans[0][0], spans[-1][1])
+    if exclude_event is not None:
+        events = events.exclude(pk=exclude_event)
+    events = list(events)
+    if not events:
+        return []
+    # the persisted occurrences of the whole window are loaded at once, the
+    # events are only expanded over the spans
+    persisted_occurrences = list(Period(events, spans[0][0], spans[-1][1])
+                                 .get_persisted_occurrences())
+    occurrences = []
+    for start, end in spans:
+        occurrences += [occurrence for occurrence in
+                        Period(events, start, end, persisted_occurrences).occurrences
+                        if not occurrence.cancelled]
+    return occurrences
+
+
+def _calendar_occurrences(calendar, spans, exclude_event=None):
+    """
+    Returns the occurrences of the events of ``calendar`` (except
+    ``exclude_event``) which aren't cancelled and overlap one of ``spans``,
+    sorted by start.
+    """
+    spans = merge_intervals(spans)
+    horizon = OCCURRENCE_INDEX and OccurrenceIndex.objects.get_horizon()
+    indexed = []
+    expanded = []
+    for start, end in spans:
+        if horizon and horizon.start <= start and end <= horizon.end:
+            indexed.append((start, end))
+        else:
+            expanded.append((start, end))
+    occurrences = []
+    if indexed:
+        occurrences += _indexed_occurrences(calendar, indexed, exclude_event)
+    if expanded:
+        occurrences += _expanded_occurrences(calendar, expanded, exclude_event)
+    # an occurrence overlapping several spans is found for each of them
+    unique = {}
+    for occurrence in occurrences:
+        unique[(occurrence.event_id, occurrence.original_start)] = occurrence
+    return sorted(unique.values(), key=lambda occurrence: (occurrence.start, occurrence.end))
+
+
+def get_event_conflicts(event, calendar=None, after=None):
+    """
+    Returns the (occurrence, other occurrence) pairs in which an occurrence
+    of ``event``, which doesn't need to be saved, overlaps an occurrence of
+    another event of ``calendar`` (the calendar of the event by default).
+    The occurrences of a recurring event are checked from ``after`` (now by
+    default) on.
+    """
+    calendar = calendar or event.calendar
+    start, end = event.start, event.end
+    if event.rule is not None:
+        # an old series being edited still collides with the future
+        start = max(start, after or datetime.datetime.now())
+        end = start + datetime.timedelta(days=CONFLICT_HORIZON_DAYS)
+        if event.end_recurring_period is not None:
+            end = min(end, event.end_recurring_period)
+    persisted_occurrences = None
+    if event.pk is None:
+        persisted_occurrences = []
+    occurrences = [occurrence for occurrence in
+                   event.get_occurrences(start, end, persisted_occurrences)
+                   if not occurrence.cancelled]
+    if not occurrences:
+        return []
+    occurrences.sort(key=lambda occurrence: (occurrence.start, occurrence.end))
+    others = _calendar_occurrences(calendar,
+        [(occurrence.start, occurrence.end) for occurrence in occurrences], event.pk)
+    return _overlapping(occurrences, others)
+
+
+def get_occurrence_conflicts(occurrence, calendar=None):
+    """
+    Returns the occurrences of ``calendar`` (the calendar of the event of
+    ``occurrence`` by default) which overlap ``occurrence``.
+    """
+    if occurrence.cancelled:
+        return []
+    calendar = calendar or occurrence.event.calendar
+    others = [other for other in
+              _calendar_occurrences(calendar, [(occurrence.start, occurrence.end)])
+              if not (other.event_id == occurrence.event.pk and
+                      other.original_start == occurrence.original_start)]
+    return [other for other, checked in _overlapping(others, [occurrence])]
+
+
+def conflict_error(occurrences):
+    """
+    Returns the ValidationError reporting that ``occurrences`` are already
+    booked.
+    """
+    first = min(occurrences)
+    return ValidationError(ugettext(
+        "This overlaps %(title)s on %(start)s.") % {
+        'title': first.title,
+        'start': first.start.strftime('%Y-%m-%d %H:%M'),
+    })
+
+
+def check_event(event, calendar=None):
+    """
+    Raises a ValidationError if ``event`` overlaps another event of its
+    calendar.
+    """
+    conflicts = get_event_conflicts(event, calendar)
+    if conflicts:
+        raise conflict_error([other for checked, other in conflicts])
+
+
+def check_occurrence(occurrence, calendar=None):
+    """
+    Raises a ValidationError if ``occurrence`` overlaps another occurrence of
+    its calendar.
+    """
+    conflicts = get_occurrence_conflicts(occurrence, calendar)
+    if conflicts:
+        raise conflict_error(conflicts)
@@ -3,10 +3,19 @@ import time
 
 from django import forms
 from django.utils.translation import ugettext_lazy as _
+from appointments.conf.settings import PREVENT_DOUBLE_BOOKING
+from appointments.conflicts import check_event, check_occurrence
 from appointments.models import Event, Occurrence
 
 
 class SpanForm(forms.ModelForm):
+    """
+    If ``check_conflicts`` is True (PREVENT_DOUBLE_BOOKING by default) the
+    form is invalid when the span overlaps another occurrence of the calendar.
+    The pre_save signal doesn't check again when the form saves the instance
+    itself, so set the fields the form doesn't have on ``form.instance``
+    before calling ``save()`` rather than saving with ``commit=False``.
+    """
 
     start = forms.DateTimeField(widget=forms.SplitDateTimeWidget)
     end = forms.DateTimeField(widget=forms.SplitDateTimeWidget, help_text=_("The end time must be later than start time."))
@@ -16,6 +25,29 @@ class SpanForm(forms.ModelForm):
             raise forms.ValidationError(_("The end time must be later than start time."))
         return self.cleaned_data['end']
 
+    def __init__(self, *args, **kwargs):
+        self.check_conflicts = kwargs.pop('check_conflicts', PREVENT_DOUBLE_BOOKING)
+        super(SpanForm, self).__init__(*args, **kwargs)
+
+    def clean(self):
+        cleaned_data = super(SpanForm, self).clean()
+        self._conflicts_checked = False
+        if self.check_conflicts and not self._errors:
+            self.check_conflict(cleaned_data)
+            self._conflicts_checked = True
+        return cleaned_data
+
+    def save(self, commit=True):
+        # spare the pre_save signal the check clean() made, for this save only
+        self.instance._conflicts_checked = commit and getattr(self, '_conflicts_checked', False)
+        try:
+            return super(SpanForm, self).save(commit)
+        finally:
+            self.instance._conflicts_checked = False
+
+    def check_conflict(self, cleaned_data):
+        pass
+
 
 class EventForm(SpanForm):
     end_recurring_period = forms.DateTimeField(help_text=_("This date is ignored for one time only events."), required=False)
@@ -25,11 +57,32 @@ class EventForm(SpanForm):
         exclude = ('creator', 'created_on', 'calendar')
 
     def __init__(self, hour24=False, *args, **kwargs):
+        self.calendar = kwargs.pop('calendar', None)
         super(EventForm, self).__init__(*args, **kwargs)
 
+    def check_conflict(self, cleaned_data):
+        calendar = self.calendar
+        if calendar is None and self.instance.calendar_id is not None:
+            calendar = self.instance.calendar
+        if calendar is None:
+            return
+        event = Event(pk=self.instance.pk, calendar=calendar,
+            start=cleaned_data['start'], end=cleaned_data['end'],
+            rule=cleaned_data.get('rule'),
+            end_recurring_period=cleaned_data.get('end_recurring_period'))
+        check_event(event, calendar)
+
 
 class OccurrenceForm(SpanForm):
 
     class Meta:
         model = Occurrence
         exclude = ('original_start', 'original_end', 'event', 'cancelled')
+
+    def check_conflict(self, cleaned_data):
+        occurrence = self.instance
+        check_occurrence(Occurrence(pk=occurrence.pk, event=occurrence.event,
+            start=cleaned_data['start'], end=cleaned_data['end'],
+            cancelled=occurrence.cancelled,
+            original_start=occurrence.original_start,
+            original_end=occurrence.original_end))
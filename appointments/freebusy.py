@@ -0,0 +1,201 @@
+"""
+Free/busy time of calendars and of the objects related to events.
+"""
+import datetime
+
+from . import cache
+from .models import Event, EventRelation
+from .periods import Period
+
+
+def merge_intervals(intervals):
+    """
+    Merges overlapping or adjacent (start, end) intervals, and returns them
+    sorted.
+
+    >>> merge_intervals([(3, 5), (1, 2), (2, 3), (7, 8)])
+    [(1, 5), (7, 8)]
+    """
+    merged = []
+    for start, end in sorted(intervals):
+        if merged and start <= merged[-1][1]:
+            if end > merged[-1][1]:
+                merged[-1] = (merged[-1][0], end)
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def busy_intervals(occurrences, start, end):
+    """
+    Returns the merged busy intervals of ``occurrences`` between start and
+    end.  Cancelled occurrences are free time.
+    """
+    intervals = []
+    for occurrence in occurrences:
+        if occurrence.cancelled:
+            continue
+        busy_start = max(occurrence.start, start)
+        busy_end = min(occurrence.end, end)
+        if busy_start < busy_end:
+            intervals.append((busy_start, busy_end))
+    return merge_intervals(intervals)
+
+
+class FreeBusy(object):
+    '''
+    The busy time of a set of events between start and end.
+
+    ``busy`` is the sorted list of (start, end) tuples during which at least
+    one occurrence that was not cancelled takes place (moved occurrences count
+    at their new time), ``free`` is the rest of the range.
+
+    >>> freebusy = FreeBusy.for_calendar(calendar, start, end)
+    >>> freebusy.busy
+    [(datetime.datetime(2008, 1, 5, 8, 0), datetime.datetime(2008, 1, 5, 9, 0))]
+    '''
+    def __init__(self, events, start, end, busy=None):
+        self.events = events
+        self.start = start
+        self.end = end
+        if busy is None:
+            busy = busy_intervals(Period(events, start, end).occurrences, start, end)
+        self.busy = busy
+
+    def for_calendar(cls, calendar, start, end):
+        """
+        Returns the FreeBusy of ``calendar``.  It is cached until an event of
+        the calendar changes.
+        """
+        parts = ('freebusy', start.isoformat(), end.isoformat())
+        busy = cache.get_cached(calendar.pk, parts)
+        freebusy = cls(calendar.event_set.get_for_range(start, end), start, end, busy)
+        if busy is None:
+            cache.set_cached(calendar.pk, parts, freebusy.busy)
+        return freebusy
+    for_calendar = classmethod(for_calendar)
+
+    def for_object(cls, content_object, start, end, distinction=None, inherit=True):
+        """
+        Returns the FreeBusy of the events related to ``content_object``,
+        directly or through the calendars they belong to (see
+        EventRelationManager.get_events_for_object).
+        """
+        related = EventRelation.objects.get_events_for_object(content_object,
+            distinction, inherit)
+        events = Event.objects.get_for_range(start, end).filter(
+            pk__in=related.values('pk'))
+        return cls(events, start, end)
+    for_object = classmethod(for_object)
+
+    def free(self):
+        free = []
+        start = self.start
+        for busy_start, busy_end in self.busy:
+            if busy_start > start:
+                free.append((start, busy_start))
+            start = max(start, busy_end)
+        if start < self.end:
+            free.append((start, self.end))
+        return free
+    free = property(free)
+
+    def is_free(self, start, end):
+        """
+        True if no busy interval overlaps start to end.
+        """
+        for busy_start, busy_end in self.busy:
+            if busy_start >= end:
+                break
+            if busy_end > start:
+                return False
+        return True
+
+
+def _seconds(delta):
+    return delta.days * 86400 + delta.seconds
+
+
+def _align(date, granularity):
+    """
+    Rounds ``date`` up to the next multiple of ``granularity`` since midnight.
+    """
+    midnight = datetime.datetime.combine(date.date(), datetime.time.min)
+    step = _seconds(granularity)
+    offset = _seconds(date - midnight)
+    steps = -(-offset // step)
+    aligned = midnight + datetime.timedelta(seconds=steps * step)
+    if aligned < date:
+        # date had microseconds
+        aligned += granularity
+    return aligned
+
+
+def _working_windows(start, end, working_hours=None, weekdays=None):
+    """
+    Yields the parts of start to end within the working hours of the
+    working days.
+    """
+    if working_hours is None and weekdays is None:
+        yield start, end
+        return
+    opening, closing = working_hours or (datetime.time.min, datetime.time.min)
+    day = start.date() - datetime.timedelta(days=1)
+    while True:
+        window_start = datetime.datetime.combine(day, opening)
+        window_end = datetime.datetime.combine(day, closing)
+        if window_end <= window_start:
+            # closes the next day (or never, for 0:00 to 0:00)
+            window_end += datetime.timedelta(days=1)
+        if window_start >= end:
+            return
+        if weekdays is None or day.weekday() in weekdays:
+            window_start = max(window_start, start)
+            window_end = min(window_end, end)
+            if window_start < window_end:
+                yield window_start, window_end
+        day += datetime.timedelta(days=1)
+
+
+def find_free_slots(calendars, duration, start, end, working_hours=None,
+                    weekdays=None, granularity=None, buffer=None):
+    """
+    Yields the (start, end) tuples of the free slots of ``duration`` between
+    start and end, during which none of ``calendars`` is busy.
+
+    ``working_hours`` is an (opening, closing) tuple of datetime.time, and
+    ``weekdays`` a collection of the days of the week (Monday is 0) slots may
+    be on.  Slots start on multiples of ``granularity`` since midnight
+    (``duration`` by default), so that there can be several overlapping
+    candidates in a long free period.  ``buffer`` is the time to keep free
+    before and after busy periods.
+
+    The events of each calendar are expanded once, and the slots are computed
+    as they are consumed:
+
+    >>> slots = find_free_slots(calendars, datetime.timedelta(minutes=30),
+    ...     start, end, working_hours=(datetime.time(9), datetime.time(17)))
+    >>> list(itertools.islice(slots, 2))
+    [(datetime.datetime(2008, 1, 7, 9, 0), datetime.datetime(2008, 1, 7, 9, 30)),
+     (datetime.datetime(2008, 1, 7, 9, 30), datetime.datetime(2008, 1, 7, 10, 0))]
+    """
+    granularity = granularity or duration
+    if _seconds(granularity) <= 0:
+        raise ValueError("granularity must be positive")
+    buffer = buffer or datetime.timedelta(0)
+    intervals = []
+    for calendar in calendars:
+        freebusy = FreeBusy.for_calendar(calendar, start - buffer, end + buffer)
+        intervals += [(busy_start - buffer, busy_end + buffer)
+                      for busy_start, busy_end in freebusy.busy]
+    free_start = start
+    for busy_start, busy_end in merge_intervals(intervals) + [(end, end)]:
+        for window_start, window_end in _working_windows(free_start,
+                min(busy_start, end), working_hours, weekdays):
+            slot_start = _align(window_start, granularity)
+            while slot_start + duration <= window_end:
+                yield slot_start, slot_start + duration
+                slot_start += granularity
+        free_start = max(free_start, busy_end)
+        if free_start >= end:
+            return
@@ -0,0 +1,116 @@
+"""
+Layout of the occurrences of periods in columns, as displayed by the
+daily_table template tag.
+
+Overlapping occurrences are put side by side: a single sweep over the
+occurrences sorted by start gives each one the lowest column free at its
+start, and every group of transitively overlapping occurrences is as many
+columns wide as it needed.
+"""
+import heapq
+
+
+class OccurrenceLayout(object):
+    '''
+    The position of an occurrence in the table of a period.
+
+    ``start`` and ``end`` are those of the occurrence, limited to the period.
+    ``column`` is the column of the occurrence within its group of
+    ``columns`` overlapping occurrences.  ``top``, ``height``, ``left`` and
+    ``width`` are in px, ``cls`` is the class given by
+    Period.classify_occurrence.
+    '''
+    __slots__ = ('occurrence', 'cls', 'start', 'end', 'column', 'columns',
+                 'top', 'height', 'left', 'width')
+
+    def __init__(self, occurrence, cls, start, end):
+        self.occurrence = occurrence
+        self.cls = cls
+        self.start = start
+        self.end = end
+        self.column = 0
+        self.columns = 1
+        self.top = self.height = self.left = self.width = 0
+
+    def cancelled(self):
+        return self.occurrence.cancelled
+    cancelled = property(cancelled)
+
+    def __repr__(self):
+        return '<OccurrenceLayout: %r column %s/%s>' % (self.occurrence,
+            self.column, self.columns)
+
+
+def assign_columns(layouts):
+    """
+    Sets the ``column`` and ``columns`` of ``layouts``, which must be sorted
+    by start.  Layouts which only touch don't overlap.
+    """
+    # (end, column) of the layouts still running, and the columns they freed
+    active = []
+    free = []
+    group = []
+    columns = 0
+    for layout in layouts:
+        while active and active[0][0] <= layout.start:
+            heapq.heappush(free, heapq.heappop(active)[1])
+        if not active:
+            # nothing overlaps this layout: the previous group is complete
+            for member in group:
+                member.columns = columns
+            group, free, columns = [], [], 0
+        if free:
+            layout.column = heapq.heappop(free)
+        else:
+            layout.column = columns
+            columns += 1
+        heapq.heappush(active, (layout.end, layout.column))
+        group.append(layout)
+    for member in group:
+        member.columns = columns
+    return layouts
+
+
+def _seconds(delta):
+    return delta.days * 86400 + delta.seconds
+
+
+def layout_period(period, width, height, left=0):
+    """
+    Returns the OccurrenceLayouts of the occurrences of ``period`` displayed
+    in a ``width`` by ``height`` px box, ``left`` px from the left of the
+    table.  The occurrences which Period.classify_occurrence leaves out (the
+    cancelled ones, unless SHOW_CANCELLED_OCCURRENCES is set) are skipped.
+    """
+    layouts = []
+    for occurrence in period.occurrences:
+        data = period.classify_occurrence(occurrence)
+        if not data:
+            continue
+        layouts.append(OccurrenceLayout(occurrence, data['class'],
+            max(occurrence.start, period.start), min(occurrence.end, period.end)))
+    layouts.sort(key=lambda layout: layout.start)
+    assign_columns(layouts)
+    duration = float(_seconds(period.end - period.start))
+    for layout in layouts:
+        column_width = int(width / layout.columns)
+        layout.width = column_width - 2
+        layout.left = left + column_width * layout.column
+        layout.top = int(height * (_seconds(layout.start - period.start) / duration))
+        layout.height = int(height * (_seconds(layout.end - layout.start) / duration))
+        # trim what extends beyond the area
+        layout.height = min(layout.height, height - layout.top)
+    return layouts
+
+
+def layout_periods(periods, width, height):
+    """
+    Lays out ``periods`` (the days of a week for example) side by side in a
+    ``width`` by ``height`` px table, and returns the list of the
+    OccurrenceLayouts of each period.
+    """
+    if not periods:
+        return []
+    period_width = int(width / len(periods))
+    return [layout_period(period, period_width, height, period_width * index)
+            for index, period in enumerate(periods)]
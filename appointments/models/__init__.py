@@ -1,5 +1,7 @@
 from appointments.models.calendars import Calendar, CalendarRelation
-from appointments.models.events import Event, EventRelation, Occurrence
+from appointments.models.events import Event, EventRelation, Occurrence, VirtualOccurrence
+from appointments.models.index import OccurrenceIndex, OccurrenceIndexHorizon
+from appointments.models.changes import CalendarChange
 from appointments.models.rules import *
 
 from appointments.signals import optionnal_calendar
@@ -19,6 +19,23 @@ class CalendarManager(models.Manager):
     >>> user1 = User(username='tony')
     >>> user1.save()
     """
+    def get_updated_on(self, **lookup):
+        """
+        Returns the ``updated_on`` of the calendar matching ``lookup``, or None.
+        It changes whenever the calendar, one of its events or one of their
+        occurrences changes, so it is a cheap fingerprint of the calendar:
+        only that column is loaded.
+        """
+        updated_on = list(self.filter(**lookup).values_list('updated_on', flat=True)[:1])
+        if updated_on:
+            return updated_on[0]
+
+    def touch(self, calendar_id):
+        """
+        Sets the ``updated_on`` of a calendar to now, without sending signals.
+        """
+        self.filter(pk=calendar_id).update(updated_on=datetime.datetime.now())
+
     def get_calendar_for_object(self, obj, distinction=None):
         """
         This function gets a calendar for an object.  It should only return one
@@ -138,6 +155,7 @@ class Calendar(models.Model):
 
     name = models.CharField(_("name"), max_length = 200)
     slug = models.SlugField(_("slug"),max_length = 200)
+    updated_on = models.DateTimeField(_("updated on"), auto_now=True)
     objects = CalendarManager()
 
     class Meta:
@@ -174,8 +192,8 @@ class Calendar(models.Model):
         """
         return self.events.order_by('-start').filter(start__lt=datetime.datetime.now())[:amount]
 
-    def occurrences_after(self, date=None):
-        return EventListManager(self.events.all()).occurrences_after(date)
+    def occurrences_after(self, date=None, limit=None):
+        return EventListManager(self.events.all()).occurrences_after(date, limit)
 
     def add_event_url(self):
         return reverse('s_create_event_in_calendar', args=[self.slug])
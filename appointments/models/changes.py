@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+import datetime
+
+from django.db import models
+from django.utils.translation import ugettext, ugettext_lazy as _
+
+from .calendars import Calendar
+
+
+kinds = (("event", _("Event")),
+         ("occurrence", _("Occurrence")),
+         ("rule", _("Rule")),
+         ("relation", _("Calendar relation")),
+         ("event_relation", _("Event relation")))
+
+
+class CalendarChangeManager(models.Manager):
+
+    def record(self, calendar_id, kind, object_id, deleted=False):
+        return self.create(calendar_id=calendar_id, kind=kind,
+                           object_id=object_id, deleted=deleted)
+
+    def get_token(self, calendar_id):
+        """
+        Returns the sequence number of the last change of the calendar, 0 if
+        it never changed.
+        """
+        token = list(self.filter(calendar=calendar_id).order_by('-pk')
+                     .values_list('pk', flat=True)[:1])
+        return token and token[0] or 0
+
+    def changes_since(self, calendar_id, token):
+        """
+        Returns the new token of the calendar and a dictionary of the
+        changes after ``token`` by kind: for each object changed, whether the
+        last change deleted it.
+        """
+        changed = {}
+        for kind, label in kinds:
+            changed[kind] = {}
+        for pk, kind, object_id, deleted in self.filter(calendar=calendar_id, pk__gt=token) \
+                .order_by('pk').values_list('pk', 'kind', 'object_id', 'deleted'):
+            changed[kind][object_id] = deleted
+            token = pk
+        return token, changed
+
+
+class CalendarChange(models.Model):
+    '''
+    An append only log of the changes of the events, occurrences, rules and
+    relations of the calendars, written by appointments.signals.  Its primary
+    key is the sequence number of the change, which clients give back as the
+    ``since`` token of the calendar_changes view to only fetch what changed.
+
+    A rule change is logged for every calendar whose events use the rule, and
+    an event moved to another calendar is logged as deleted from the previous
+    one.
+    '''
+    calendar = models.ForeignKey(Calendar, verbose_name=_("calendar"))
+    kind = models.CharField(_("kind"), choices=kinds, max_length=20)
+    object_id = models.IntegerField(_("object id"))
+    deleted = models.BooleanField(_("deleted"), default=False)
+    created_on = models.DateTimeField(_("created on"), default=datetime.datetime.now)
+
+    objects = CalendarChangeManager()
+
+    class Meta:
+        verbose_name = _('calendar change')
+        verbose_name_plural = _('calendar changes')
+        app_label = 'schedule'
+
+    def __unicode__(self):
+        return ugettext("%(kind)s %(object_id)s of %(calendar)s") % {
+            'kind': self.get_kind_display(),
+            'object_id': self.object_id,
+            'calendar': self.calendar_id,
+        }
@@ -1,6 +1,5 @@
 # -*- coding: utf-8 -*-
 import datetime
-from dateutil import rrule
 
 from django.contrib.contenttypes import generic
 from django.db import models
@@ -13,6 +12,8 @@ from django.utils.translation import ugettext, ugettext_lazy as _
 
 from .rules import Rule
 from .calendars import Calendar
+from ..conf.settings import OCCURRENCE_MAX_DURATION
+from ..recurrence import get_rrule
 from ..utils import OccurrenceReplacer
 
 
@@ -21,27 +22,55 @@ class EventManager(models.Manager):
     def get_for_object(self, content_object, distinction=None, inherit=True):
         return EventRelation.objects.get_events_for_object(content_object, distinction, inherit)
 
+    def get_for_range(self, start, end):
+        """
+        Returns the events which may have occurrences between start and end:
+        one time events overlapping the range, and recurring events starting
+        before its end whose recurrence doesn't end before its start, less
+        OCCURRENCE_MAX_DURATION for the last occurrence to end.
+        """
+        return self.filter(range_q(start, end)).select_related('rule')
+
+
+def range_q(start, end=None):
+    """
+    Returns the Q object selecting the events which may have occurrences
+    between start and end, or after start if there's no end (see
+    EventManager.get_for_range).  It can filter any queryset of events.
+    """
+    single_q = Q(rule__isnull=True, end__gte=start)
+    recurring_q = Q(rule__isnull=False) & (
+        Q(end_recurring_period__isnull=True) |
+        Q(end_recurring_period__gte=start - OCCURRENCE_MAX_DURATION))
+    if end is not None:
+        single_q &= Q(start__lt=end)
+        recurring_q &= Q(start__lt=end)
+    return single_q | recurring_q
+
 
 class Event(models.Model):
     '''
     This model stores meta data for a date.  You can relate this data to many
     other models.
     '''
-    start = models.DateTimeField(_("start"))
-    end = models.DateTimeField(_("end"), help_text=_("The end time must be later than the start time."))
+    start = models.DateTimeField(_("start"), db_index=True)
+    end = models.DateTimeField(_("end"), db_index=True, help_text=_("The end time must be later than the start time."))
     title = models.CharField(_("title"), max_length=255)
     description = models.TextField(_("description"), null=True, blank=True)
     creator = models.ForeignKey(User, null=True, verbose_name=_("creator"))
     created_on = models.DateTimeField(_("created on"), default=datetime.datetime.now)
+    updated_on = models.DateTimeField(_("updated on"), auto_now=True, db_index=True)
     rule = models.ForeignKey(Rule, null=True, blank=True, verbose_name=_("rule"), help_text=_("Select '----' for a one time only event."))
     end_recurring_period = models.DateTimeField(_("end recurring period"), null=True, blank=True, help_text=_("This date is ignored for one time only events."))
     calendar = models.ForeignKey(Calendar, blank=True)
+    uid = models.CharField(_("uid"), max_length=255, null=True, blank=True, editable=False, help_text=_("The iCalendar UID of an imported event."))
     objects = EventManager()
 
     class Meta:
         verbose_name = _('event')
         verbose_name_plural = _('events')
         app_label = 'schedule'
+        unique_together = (('calendar', 'uid'),)
 
     def __unicode__(self):
         date_format = u'l, %s' % ugettext("DATE_FORMAT")
@@ -60,7 +89,7 @@ class Event(models.Model):
         """
         EventRelation.objects.create_relation(self, obj, distinction)
 
-    def get_occurrences(self, start, end):
+    def get_occurrences(self, start, end, persisted_occurrences=None):
         """
         >>> rule = Rule(frequency = "MONTHLY", name = "Monthly")
         >>> rule.save()
@@ -78,9 +107,17 @@ class Event(models.Model):
         >>> ["%s to %s" %(o.start, o.end) for o in occurrences]
         []
 
+        ``persisted_occurrences`` can be given when the persisted Occurrences
+        of this event were already loaded, e.g. by a Period fetching them for
+        all of its events at once, as a list or as an OccurrenceReplacer.
+        Otherwise they are queried here.
         """
-        persisted_occurrences = self.occurrence_set.all()
-        occ_replacer = OccurrenceReplacer(persisted_occurrences)
+        if persisted_occurrences is None:
+            persisted_occurrences = self.occurrence_set.with_events()
+        if isinstance(persisted_occurrences, OccurrenceReplacer):
+            occ_replacer = persisted_occurrences
+        else:
+            occ_replacer = OccurrenceReplacer(persisted_occurrences)
         occurrences = self._get_occurrence_list(start, end)
         final_occurrences = []
         for occ in occurrences:
@@ -94,29 +131,32 @@ class Event(models.Model):
                 final_occurrences.append(occ)
         # then add persisted occurrences which originated outside of this period but now
         # fall within it
-        final_occurrences += occ_replacer.get_additional_occurrences(start, end)
+        final_occurrences += occ_replacer.get_additional_occurrences(start, end, self.id)
         return final_occurrences
 
-    def get_rrule_object(self):
+    def get_rrule_object(self, seek=None):
+        """
+        Returns the rrule of this event, or None for one time events.  When
+        ``seek`` is given the rrule may start at any occurrence up to that
+        date, see appointments.recurrence.get_rrule.
+        """
         if self.rule is not None:
-            params = self.rule.get_params()
-            frequency = 'rrule.%s' % self.rule.frequency
-            return rrule.rrule(eval(frequency), dtstart=self.start, **params)
+            return get_rrule(self.rule, self.start, seek)
 
     def _create_occurrence(self, start, end=None):
         if end is None:
             end = start + (self.end - self.start)
-        return Occurrence(event=self, start=start, end=end, original_start=start, original_end=end)
+        return VirtualOccurrence(self, start, end)
 
     def get_occurrence(self, date):
-        rule = self.get_rrule_object()
+        rule = self.get_rrule_object(date)
         if rule:
             next_occurrence = rule.after(date, inc=True)
         else:
             next_occurrence = self.start
         if next_occurrence == date:
             try:
-                return Occurrence.objects.get(event=self, original_start=date)
+                return Occurrence.objects.with_events().get(event=self, original_start=date)
             except Occurrence.DoesNotExist:
                 return self._create_occurrence(next_occurrence)
 
@@ -129,7 +169,7 @@ class Event(models.Model):
             occurrences = []
             if self.end_recurring_period and self.end_recurring_period < end:
                 end = self.end_recurring_period
-            rule = self.get_rrule_object()
+            rule = self.get_rrule_object(start-difference)
             o_starts = rule.between(start-difference, end, inc=True)
             for o_start in o_starts:
                 o_end = o_start + difference
@@ -150,16 +190,16 @@ class Event(models.Model):
 
         if after is None:
             after = datetime.datetime.now()
-        rule = self.get_rrule_object()
+        difference = self.end - self.start
+        rule = self.get_rrule_object(after - difference)
         if rule is None:
             if self.end > after:
                 yield self._create_occurrence(self.start, self.end)
             raise StopIteration
         date_iter = iter(rule)
-        difference = self.end - self.start
         while True:
             o_start = date_iter.next()
-            if o_start > self.end_recurring_period:
+            if self.end_recurring_period is not None and o_start > self.end_recurring_period:
                 raise StopIteration
             o_end = o_start + difference
             if o_end > after:
@@ -170,7 +210,7 @@ class Event(models.Model):
         returns a generator that produces occurrences after the datetime
         ``after``.  Includes all of the persisted Occurrences.
         """
-        occ_replacer = OccurrenceReplacer(self.occurrence_set.all())
+        occ_replacer = OccurrenceReplacer(self.occurrence_set.with_events())
         generator = self._occurrences_after_generator(after)
         while True:
             next = generator.next()
@@ -342,28 +382,77 @@ class EventRelation(models.Model):
         return u'%s(%s)-%s' % (self.event.title, self.distinction, self.content_object)
 
 
+class OccurrenceManager(models.Manager):
+
+    def with_events(self):
+        """
+        Loads the events of the occurrences, with their rules and calendars,
+        in the same query.
+        """
+        return self.select_related('event', 'event__rule', 'event__calendar')
+
+
+class EventDefault(object):
+    """
+    A field of Occurrence which, when it is None, reads the one of the
+    event.  The event is only loaded when the value is read, rather than
+    when the occurrence is.
+    """
+    def __init__(self, name):
+        self.name = name
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        value = instance.__dict__.get(self.name)
+        if value is None:
+            return getattr(instance.event, self.name)
+        return value
+
+    def __set__(self, instance, value):
+        instance.__dict__[self.name] = value
+
+
+class EventDefaultMixin(object):
+    """
+    Installs an EventDefault for the field, and saves the value set on the
+    occurrence rather than the one read from the event, so that None is
+    stored and keeps following the event.
+    """
+    def contribute_to_class(self, cls, name):
+        super(EventDefaultMixin, self).contribute_to_class(cls, name)
+        setattr(cls, self.attname, EventDefault(self.attname))
+
+    def pre_save(self, model_instance, add):
+        return model_instance.__dict__.get(self.attname)
+
+
+class EventDefaultCharField(EventDefaultMixin, models.CharField):
+    pass
+
+
+class EventDefaultTextField(EventDefaultMixin, models.TextField):
+    pass
+
+
 class Occurrence(models.Model):
     event = models.ForeignKey(Event, verbose_name=_("event"))
-    title = models.CharField(_("title"), max_length=255, blank=True, null=True)
-    description = models.TextField(_("description"), blank=True, null=True)
-    start = models.DateTimeField(_("start"))
-    end = models.DateTimeField(_("end"))
+    title = EventDefaultCharField(_("title"), max_length=255, blank=True, null=True)
+    description = EventDefaultTextField(_("description"), blank=True, null=True)
+    start = models.DateTimeField(_("start"), db_index=True)
+    end = models.DateTimeField(_("end"), db_index=True)
     cancelled = models.BooleanField(_("cancelled"), default=False)
     original_start = models.DateTimeField(_("original start"))
     original_end = models.DateTimeField(_("original end"))
+    updated_on = models.DateTimeField(_("updated on"), auto_now=True, db_index=True)
+
+    objects = OccurrenceManager()
 
     class Meta:
         verbose_name = _("occurrence")
         verbose_name_plural = _("occurrences")
         app_label = 'schedule'
 
-    def __init__(self, *args, **kwargs):
-        super(Occurrence, self).__init__(*args, **kwargs)
-        if self.title is None:
-            self.title = self.event.title
-        if self.description is None:
-            self.description = self.event.description
-
     def moved(self):
         return self.original_start != self.start or self.original_end != self.end
     moved = property(moved)
@@ -399,29 +488,122 @@ class Occurrence(models.Model):
         if self.pk is not None:
             return reverse('cancel_occurrence', kwargs={'occurrence_id': self.pk,
                                                         'event_id': self.event.id})
-        return reverse('cancel_occurrence_by_date', kwargs={
-            'event_id': self.event.id,
-            'year': self.start.year,
-            'month': self.start.month,
-            'day': self.start.day,
-            'hour': self.start.hour,
-            'minute': self.start.minute,
-            'second': self.start.second,
-        })
+        return reverse('cancel_occurrence_by_date', kwargs=_date_url_kwargs(self))
 
     def get_edit_url(self):
         if self.pk is not None:
             return reverse('edit_occurrence', kwargs={'occurrence_id': self.pk,
                                                       'event_id': self.event.id})
-        return reverse('edit_occurrence_by_date', kwargs={
-            'event_id': self.event.id,
-            'year': self.start.year,
-            'month': self.start.month,
-            'day': self.start.day,
-            'hour': self.start.hour,
-            'minute': self.start.minute,
-            'second': self.start.second,
-        })
+        return reverse('edit_occurrence_by_date', kwargs=_date_url_kwargs(self))
+
+    def __unicode__(self):
+        return ugettext("%(start)s to %(end)s") % {
+            'start': self.start,
+            'end': self.end,
+        }
+
+    def __cmp__(self, other):
+        rank = cmp(self.start, other.start)
+        if rank == 0:
+            return cmp(self.end, other.end)
+        return rank
+
+    def __eq__(self, other):
+        return self.event == other.event and self.original_start == other.original_start and self.original_end == other.original_end
+
+
+class VirtualOccurrence(object):
+    '''
+    An occurrence generated from the rule of an Event which has not been
+    persisted.  Periods hold a great many of these, so this is a compact
+    value type instead of an Occurrence model: it has the same read API, and
+    title and description are read from the event rather than copied.
+
+    Saving, moving or cancelling it promotes it to an Occurrence (see
+    ``persist``), which it delegates to from then on.
+    '''
+    __slots__ = ('event', 'start', 'end', 'original_start', 'original_end',
+                 '_persisted')
+
+    def __init__(self, event, start, end):
+        self.event = event
+        self.start = self.original_start = start
+        self.end = self.original_end = end
+        self._persisted = None
+
+    # without a __dict__, pickle needs these below protocol 2 (the cache
+    # backends don't all use the highest one)
+    def __getstate__(self):
+        return dict([(name, getattr(self, name)) for name in self.__slots__])
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
+
+    def event_id(self):
+        return self.event.id
+    event_id = property(event_id)
+
+    def persist(self):
+        """
+        Returns the Occurrence model for this occurrence, creating it (without
+        saving it) the first time.
+        """
+        if self._persisted is None:
+            self._persisted = Occurrence(event=self.event,
+                start=self.start, end=self.end,
+                original_start=self.original_start, original_end=self.original_end)
+        return self._persisted
+
+    def pk(self):
+        if self._persisted is not None:
+            return self._persisted.pk
+    pk = property(pk)
+    id = pk
+
+    def title(self):
+        if self._persisted is not None:
+            return self._persisted.title
+        return self.event.title
+    title = property(title)
+
+    def description(self):
+        if self._persisted is not None:
+            return self._persisted.description
+        return self.event.description
+    description = property(description)
+
+    def cancelled(self):
+        return self._persisted is not None and self._persisted.cancelled
+    cancelled = property(cancelled)
+
+    def moved(self):
+        return self.original_start != self.start or self.original_end != self.end
+    moved = property(moved)
+
+    def save(self):
+        self.persist().save()
+
+    def move(self, new_start, new_end):
+        self.start = new_start
+        self.end = new_end
+        self.persist().move(new_start, new_end)
+
+    def cancel(self):
+        self.persist().cancel()
+
+    def uncancel(self):
+        self.persist().uncancel()
+
+    def get_cancel_url(self):
+        if self.pk is not None:
+            return self._persisted.get_cancel_url()
+        return reverse('cancel_occurrence_by_date', kwargs=_date_url_kwargs(self))
+
+    def get_edit_url(self):
+        if self.pk is not None:
+            return self._persisted.get_edit_url()
+        return reverse('edit_occurrence_by_date', kwargs=_date_url_kwargs(self))
 
     def __unicode__(self):
         return ugettext("%(start)s to %(end)s") % {
@@ -429,6 +611,9 @@ class Occurrence(models.Model):
             'end': self.end,
         }
 
+    def __repr__(self):
+        return '<VirtualOccurrence: %s>' % self.__unicode__()
+
     def __cmp__(self, other):
         rank = cmp(self.start, other.start)
         if rank == 0:
@@ -437,3 +622,24 @@ class Occurrence(models.Model):
 
     def __eq__(self, other):
         return self.event == other.event and self.original_start == other.original_start and self.original_end == other.original_end
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash((self.event.pk, self.original_start, self.original_end))
+
+
+def _date_url_kwargs(occurrence):
+    """
+    The url kwargs of an occurrence which is identified by its start.
+    """
+    return {
+        'event_id': occurrence.event.id,
+        'year': occurrence.start.year,
+        'month': occurrence.start.month,
+        'day': occurrence.start.day,
+        'hour': occurrence.start.hour,
+        'minute': occurrence.start.minute,
+        'second': occurrence.start.second,
+    }
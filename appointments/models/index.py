@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+import datetime
+
+from django.db import models
+from django.utils.translation import ugettext, ugettext_lazy as _
+
+from .calendars import Calendar
+from .events import Event, Occurrence
+from ..utils import OccurrenceReplacer, bulk_create
+
+
+class OccurrenceIndexHorizon(models.Model):
+    '''
+    The span of time covered by the OccurrenceIndex.  There is at most one
+    row, it is written by the ``rebuild_occurrence_index`` command.
+    '''
+    start = models.DateTimeField(_("start"))
+    end = models.DateTimeField(_("end"))
+
+    class Meta:
+        verbose_name = _('occurrence index horizon')
+        verbose_name_plural = _('occurrence index horizons')
+        app_label = 'schedule'
+
+    def __unicode__(self):
+        return ugettext("%(start)s to %(end)s") % {
+            'start': self.start,
+            'end': self.end,
+        }
+
+
+class OccurrenceIndexManager(models.Manager):
+
+    def get_horizon(self):
+        """
+        Returns the OccurrenceIndexHorizon, or None if the index was never
+        built.
+        """
+        try:
+            return OccurrenceIndexHorizon.objects.get(pk=1)
+        except OccurrenceIndexHorizon.DoesNotExist:
+            return None
+
+    def covers(self, start, end):
+        """
+        True if every occurrence between start and end is in the index.
+        """
+        horizon = self.get_horizon()
+        return horizon is not None and horizon.start <= start and end <= horizon.end
+
+    def index_event(self, event, start=None, end=None):
+        """
+        Replaces the index rows of ``event`` with its occurrences between
+        start and end, which default to the current horizon.
+        """
+        if start is None or end is None:
+            horizon = self.get_horizon()
+            if horizon is None:
+                return
+            start, end = horizon.start, horizon.end
+        self.filter(event=event).delete()
+        bulk_create(OccurrenceIndex, self._rows_for_event(event, start, end))
+
+    def index_rule(self, rule):
+        """
+        Replaces the index rows of the events of ``rule`` over the current
+        horizon, reading the horizon, the rows to delete and the persisted
+        occurrences once for all of them.
+        """
+        horizon = self.get_horizon()
+        if horizon is None:
+            return
+        self.filter(event__rule=rule).delete()
+        replacer = OccurrenceReplacer(Occurrence.objects.filter(event__rule=rule))
+        for event in Event.objects.filter(rule=rule).select_related('rule', 'calendar'):
+            bulk_create(OccurrenceIndex, self._rows_for_event(event,
+                horizon.start, horizon.end, replacer))
+
+    def extend_event(self, event, start, end):
+        """
+        Adds the occurrences of ``event`` starting after ``start`` (the end of
+        the previous horizon) and before ``end`` to the index.
+        """
+        bulk_create(OccurrenceIndex, [row for row in self._rows_for_event(event, start, end)
+                                      if row.start > start])
+
+    def _rows_for_event(self, event, start, end, persisted_occurrences=None):
+        rows = []
+        for occurrence in event.get_occurrences(start, end, persisted_occurrences):
+            rows.append(OccurrenceIndex(
+                event=event,
+                calendar_id=event.calendar_id,
+                start=occurrence.start,
+                end=occurrence.end,
+                cancelled=occurrence.cancelled,
+                persisted_occurrence_id=occurrence.pk,
+            ))
+        return rows
+
+    def in_range(self, start, end, events=None, calendars=None):
+        """
+        Returns the index rows of occurrences between start and end ordered
+        by start and end.  They can be restricted to a set of events or of
+        calendars.
+        """
+        rows = self.filter(start__lte=end, end__gte=start)
+        if events is not None:
+            rows = rows.filter(event__in=events)
+        if calendars is not None:
+            rows = rows.filter(calendar__in=calendars)
+        return rows.select_related('event', 'event__rule', 'persisted_occurrence').order_by('start', 'end')
+
+    def get_occurrences(self, events, start, end):
+        """
+        Returns the occurrences of ``events`` between start and end, the same
+        way Period expands them, from the index.
+        """
+        return [row.get_occurrence() for row in self.in_range(start, end, events=events)]
+
+    def occurrences_after(self, events, after, before=None):
+        """
+        Returns a generator of the indexed occurrences of ``events`` which
+        end after ``after``, and start before ``before`` if it is given,
+        ordered by start.
+        """
+        rows = self.filter(event__in=events, end__gt=after)
+        if before is not None:
+            rows = rows.filter(start__lt=before)
+        rows = rows.select_related('event', 'event__rule', 'persisted_occurrence').order_by('start', 'end')
+        return (row.get_occurrence() for row in rows.iterator())
+
+    def rebuild(self, start, end, events=None):
+        """
+        Drops the index and rebuilds it for the horizon start to end.
+        """
+        if events is None:
+            events = Event.objects.all()
+        self.all().delete()
+        for event in events.iterator():
+            bulk_create(OccurrenceIndex, self._rows_for_event(event, start, end))
+        OccurrenceIndexHorizon.objects.filter(pk=1).delete()
+        OccurrenceIndexHorizon.objects.create(pk=1, start=start, end=end)
+
+    def extend(self, start, end, events=None):
+        """
+        Moves the horizon to start and end without reindexing the part
+        already covered: rows which ended before start are dropped and the
+        occurrences after the previous horizon are added.  Falls back to a
+        rebuild if the new horizon does not overlap the current one.
+        """
+        horizon = self.get_horizon()
+        if horizon is None or start > horizon.end or start < horizon.start:
+            return self.rebuild(start, end, events)
+        if events is None:
+            events = Event.objects.all()
+        self.filter(end__lt=start).delete()
+        if end > horizon.end:
+            for event in events.iterator():
+                self.extend_event(event, horizon.end, end)
+        horizon.start = start
+        horizon.end = max(end, horizon.end)
+        horizon.save()
+
+
+class OccurrenceIndex(models.Model):
+    '''
+    A materialized occurrence of an Event within the OccurrenceIndexHorizon.
+    This table is only maintained when the OCCURRENCE_INDEX setting is
+    enabled, in which case Period and EventListManager read from it instead
+    of expanding the recurrence rules of every event.
+
+    persisted_occurrence is set when the occurrence has been stored as an
+    Occurrence (moved or cancelled for example).
+    '''
+    event = models.ForeignKey(Event, verbose_name=_("event"))
+    calendar = models.ForeignKey(Calendar, verbose_name=_("calendar"))
+    start = models.DateTimeField(_("start"), db_index=True)
+    end = models.DateTimeField(_("end"))
+    cancelled = models.BooleanField(_("cancelled"), default=False)
+    persisted_occurrence = models.ForeignKey(Occurrence, null=True, blank=True,
+        verbose_name=_("persisted occurrence"))
+
+    objects = OccurrenceIndexManager()
+
+    class Meta:
+        verbose_name = _('occurrence index')
+        verbose_name_plural = _('occurrence index')
+        app_label = 'schedule'
+
+    def __unicode__(self):
+        return ugettext("%(start)s to %(end)s") % {
+            'start': self.start,
+            'end': self.end,
+        }
+
+    def get_occurrence(self):
+        if self.persisted_occurrence_id is not None:
+            # the event was loaded with the row
+            self.persisted_occurrence.event = self.event
+            return self.persisted_occurrence
+        return self.event._create_occurrence(self.start, self.end)
@@ -0,0 +1 @@
+CREATE INDEX schedule_occurrenceindex_calendar_id_start ON schedule_occurrenceindex (calendar_id, start);
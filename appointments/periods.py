@@ -1,15 +1,32 @@
+import bisect
 import datetime
+import heapq
 
+from django.db.models import Q
 from django.db.models.query import QuerySet
 from django.template.defaultfilters import date
 from django.utils.translation import ugettext, ugettext_lazy as _
 from django.utils.dates import WEEKDAYS, WEEKDAYS_ABBR
 
-from .conf.settings import FIRST_DAY_OF_WEEK, SHOW_CANCELLED_OCCURRENCES
-from .models import Occurrence
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from . import cache
+from .conf.settings import FIRST_DAY_OF_WEEK, SHOW_CANCELLED_OCCURRENCES, OCCURRENCE_INDEX, CALENDAR_CACHE
+from .models import Event, Occurrence, OccurrenceIndex, Rule
 from .utils import OccurrenceReplacer
 
 
+# occurrence_counts uses numpy, when installed, from this many occurrences on
+NUMPY_THRESHOLD = 1000
+
+GRANULARITIES = {
+    'day': datetime.timedelta(days=1),
+    'hour': datetime.timedelta(hours=1),
+}
+
 weekday_names = []
 weekday_abbrs = []
 if FIRST_DAY_OF_WEEK == 1:
@@ -26,6 +43,82 @@ else:
         weekday_abbrs.append( WEEKDAYS_ABBR[i] )
 
 
+def _load_rules(events):
+    """
+    Loads the rules of the ``events`` which don't have theirs yet with a
+    single query, rather than one query per recurring event expanded.
+    """
+    cache_name = Event._meta.get_field('rule').get_cache_name()
+    missing = [event for event in events
+               if event.rule_id is not None and not hasattr(event, cache_name)]
+    if missing:
+        rules = Rule.objects.in_bulk(set([event.rule_id for event in missing]))
+        for event in missing:
+            if event.rule_id in rules:
+                event.rule = rules[event.rule_id]
+    return events
+
+
+def _decorated_run(index, occurrences):
+    # the persisted occurrences moved within the period, and the ones moved
+    # into it, are out of place in the run of an event: sort it, which is
+    # nearly free as the rest of it comes out of the rule in order
+    run = [(occ.start, occ.end, index, position, occ)
+           for position, occ in enumerate(occurrences)]
+    run.sort()
+    return run
+
+
+def merge_occurrences(runs):
+    """
+    Yields the occurrences of ``runs``, one list of occurrences per event,
+    sorted by start and end.
+
+    Each run is sorted on its own, then they are merged on precomputed keys
+    instead of sorting them all at once through Occurrence.__cmp__.  The
+    index of the run and the position in it break ties, so occurrences
+    starting and ending together keep the order of their events.
+    """
+    runs = [_decorated_run(index, run) for index, run in enumerate(runs)]
+    for key in heapq.merge(*runs):
+        yield key[-1]
+
+
+class OccurrencePool(object):
+    '''
+    The sorted occurrences of a period, shared by all of its sub periods,
+    which find theirs by bisection instead of scanning the whole list.
+
+    ``max_ends[i]`` is the latest end of the first i+1 occurrences, so the
+    first occurrence which may still be running at a given date can be
+    bisected too.
+    '''
+    def __init__(self, occurrences):
+        self.occurrences = sorted(occurrences, key=lambda occ: (occ.start, occ.end))
+        self.starts = [occ.start for occ in self.occurrences]
+        self.max_ends = []
+        max_end = None
+        for occurrence in self.occurrences:
+            if max_end is None or occurrence.end > max_end:
+                max_end = occurrence.end
+            self.max_ends.append(max_end)
+
+    def __iter__(self):
+        return iter(self.occurrences)
+
+    def __len__(self):
+        return len(self.occurrences)
+
+    def get_occurrences(self, start, end):
+        """
+        Returns the occurrences which start before (or at) end and end after
+        (or at) start, sorted.
+        """
+        low = bisect.bisect_left(self.max_ends, start)
+        high = bisect.bisect_right(self.starts, end)
+        return [occ for occ in self.occurrences[low:high] if occ.end >= start]
+
+
 class Period(object):
     '''
     This class represents a period of time. It can return a set of occurrences
@@ -34,7 +127,11 @@ class Period(object):
     def __init__(self, events, start, end, parent_persisted_occurrences=None, occurrence_pool=None):
         self.start = start
         self.end = end
+        if isinstance(events, (list, tuple)):
+            _load_rules(events)
         self.events = events
+        if occurrence_pool is not None and not isinstance(occurrence_pool, OccurrencePool):
+            occurrence_pool = OccurrencePool(occurrence_pool)
         self.occurrence_pool = occurrence_pool
         if parent_persisted_occurrences is not None:
             self._persisted_occurrences = parent_persisted_occurrences
@@ -46,16 +143,37 @@ class Period(object):
         return self.start != period.start or self.end != period.end or self.events != period.events
 
     def _get_sorted_occurrences(self):
-        occurrences = []
-        if hasattr(self, "occurrence_pool") and self.occurrence_pool is not None:
-            for occurrence in self.occurrence_pool:
-                if occurrence.start <= self.end and occurrence.end >= self.start:
-                    occurrences.append(occurrence)
-            return occurrences
-        for event in self.events:
-            event_occurrences = event.get_occurrences(self.start, self.end)
-            occurrences += event_occurrences
-        return sorted(occurrences)
+        if self.occurrence_pool is not None:
+            return self.occurrence_pool.get_occurrences(self.start, self.end)
+        if CALENDAR_CACHE:
+            events = list(self.events)
+            calendar_ids, event_ids = cache.events_parts(events)
+            if calendar_ids:
+                parts = ('occurrences', self.start.isoformat(), self.end.isoformat()) + event_ids
+                return cache.get_or_set(calendar_ids, parts, self._expand_occurrences)
+        return self._expand_occurrences()
+
+    def _expand_occurrences(self):
+        return list(self._iter_expanded_occurrences())
+
+    def _iter_expanded_occurrences(self):
+        if OCCURRENCE_INDEX and OccurrenceIndex.objects.covers(self.start, self.end):
+            return iter(OccurrenceIndex.objects.get_occurrences(self.events, self.start, self.end))
+        occ_replacer = self.get_occurrence_replacer()
+        return merge_occurrences([event.get_occurrences(self.start, self.end, occ_replacer)
+                                  for event in _load_rules(list(self.events))])
+
+    def iter_occurrences(self):
+        """
+        Returns an iterator over the sorted occurrences of this period.
+
+        Unless they were already computed, shared by a parent period or
+        cached, the occurrences are merged as they are iterated, so a caller
+        only looking for the first few of them can stop early.
+        """
+        if hasattr(self, '_occurrences') or self.occurrence_pool is not None or CALENDAR_CACHE:
+            return iter(self.occurrences)
+        return self._iter_expanded_occurrences()
 
     def cached_get_sorted_occurrences(self):
         if hasattr(self, '_occurrences'):
@@ -66,16 +184,33 @@ class Period(object):
     occurrences = property(cached_get_sorted_occurrences)
 
     def get_persisted_occurrences(self):
-        if hasattr(self, '_persisted_occurrenes'):
+        """
+        Returns the persisted Occurrences of this period's events which either
+        originated in this period or have been moved into it.
+        """
+        if hasattr(self, '_persisted_occurrences'):
             return self._persisted_occurrences
         else:
-            self._persisted_occurrences = Occurrence.objects.filter(event__in=self.events)
+            self._persisted_occurrences = Occurrence.objects.with_events().filter(
+                Q(start__lt=self.end, end__gte=self.start) |
+                Q(original_start__lte=self.end, original_end__gte=self.start),
+                event__in=self.events)
             return self._persisted_occurrences
 
+    def get_occurrence_replacer(self):
+        """
+        Loads the persisted occurrences with a single query, shared with the
+        sub periods, and returns an OccurrenceReplacer of them for all the
+        events of this period.
+        """
+        return OccurrenceReplacer(self.get_persisted_occurrences())
+
     def classify_occurrence(self, occurrence):
         if occurrence.cancelled and not SHOW_CANCELLED_OCCURRENCES:
             return
-        if occurrence.start > self.end or occurrence.end < self.start:
+        # an occurrence ending at the start of the period is in it ("Ends at
+        # 0:00"), one starting at its end is in the next one
+        if occurrence.start >= self.end or occurrence.end < self.start:
             return None
         started = False
         ended = False
@@ -105,20 +240,77 @@ class Period(object):
         return self.occurrences
 
     def has_occurrences(self):
-        for occurrence in self.occurrences:
+        for occurrence in self.iter_occurrences():
             occurrence = self.classify_occurrence(occurrence)
             if occurrence:
                 return True
         return False
 
+    def occurrence_counts(self, granularity='day'):
+        """
+        Returns the number of occurrences taking place during each day (or
+        hour, or datetime.timedelta given as ``granularity``) of this period,
+        as a list starting with the one beginning at the start of the period.
+
+        The counts are computed in one pass over the starts and ends of the
+        occurrences, without classifying them for every day, but they are in
+        the same days as with ``classify_occurrence``.  Cancelled occurrences
+        are counted only if SHOW_CANCELLED_OCCURRENCES is set.
+
+        >>> year.occurrence_counts()[:3]
+        [0, 2, 1]
+        """
+        step = GRANULARITIES.get(granularity, granularity)
+        step = step.days * 86400 + step.seconds
+        length = self.end - self.start
+        length = length.days * 86400 + length.seconds
+        size = -(-length // step)
+        spans = []
+        for occurrence in self.occurrences:
+            if occurrence.cancelled and not SHOW_CANCELLED_OCCURRENCES:
+                continue
+            start = occurrence.start - self.start
+            start = start.days * 86400 + start.seconds
+            if start >= length:
+                continue
+            end = occurrence.end - self.start
+            spans.append((start, end.days * 86400 + end.seconds))
+        if numpy is not None and len(spans) >= NUMPY_THRESHOLD:
+            return _numpy_counts(spans, step, size)
+        # difference array: +1 at the first bucket of an occurrence, -1 after
+        # its last one
+        deltas = [0] * (size + 1)
+        for start, end in spans:
+            first = max(start // step, 0)
+            # an occurrence ending at the start of a bucket is in it
+            last = min(max(end // step, start // step), size - 1)
+            if first <= last:
+                deltas[first] += 1
+                deltas[last + 1] -= 1
+        counts = []
+        count = 0
+        for delta in deltas[:size]:
+            count += delta
+            counts.append(count)
+        return counts
+
     def get_time_slot(self, start, end):
         if start >= self.start and end <= self.end:
             return Period(self.events, start, end)
         return None
 
+    def get_occurrence_pool(self):
+        """
+        Returns the OccurrencePool shared with the sub periods: the one this
+        period was created from, or one of its own occurrences.
+        """
+        if self.occurrence_pool is None:
+            self.occurrence_pool = OccurrencePool(self.occurrences)
+        return self.occurrence_pool
+
     def create_sub_period(self, cls, start=None):
         start = start or self.start
-        return cls(self.events, start, self.get_persisted_occurrences(), self.occurrences)
+        return cls(self.events, start, self.get_persisted_occurrences(), self.get_occurrence_pool())
 
     def get_periods(self, cls):
         period = self.create_sub_period(cls)
@@ -127,6 +319,19 @@ class Period(object):
             period = period.next()
 
 
+def _numpy_counts(spans, step, size):
+    spans = numpy.array(spans, dtype=numpy.int64).reshape(-1, 2)
+    first = spans[:, 0] // step
+    last = numpy.maximum(spans[:, 1] // step, first)
+    first = numpy.maximum(first, 0)
+    last = numpy.minimum(last, size - 1)
+    inside = first <= last
+    deltas = numpy.zeros(size + 1, dtype=numpy.int64)
+    numpy.add.at(deltas, first[inside], 1)
+    numpy.add.at(deltas, last[inside] + 1, -1)
+    return numpy.cumsum(deltas[:size]).tolist()
+
+
 class Year(Period):
     def __init__(self, events, date=None, parent_persisted_occurrences=None):
         if date is None:
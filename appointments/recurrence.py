@@ -0,0 +1,311 @@
+"""
+Compiled recurrence rules.
+
+Turning a ``Rule`` into a dateutil ``rrule`` means parsing ``Rule.params`` and
+looking up the frequency constant.  Calendars tend to share a handful of rules
+across a great many events, so the compiled form is kept in a process wide
+LRU cache keyed on the rule, its definition and the start of the event.
+
+dateutil always iterates a rule from its ``dtstart``, so this module can also
+return an equivalent rule which starts right before a given date ("seeking").
+Simple rules are moved forward arithmetically, the others restart from a
+cached checkpoint occurrence.
+
+``to_rrule_string`` writes a rule as an iCalendar RRULE for the exports, and
+``from_rrule_string`` reads one back for the imports.
+"""
+import bisect
+import datetime
+import threading
+
+from dateutil import rrule, tz
+
+from .conf.settings import RULE_CACHE_SIZE
+from .utils import LRUCache
+
+
+# number of occurrences between two checkpoints of a seekable rule
+CHECKPOINT_INTERVAL = 256
+
+# params rrule derives from dtstart when none of them is given
+_DTSTART_DERIVED = ('byweekno', 'byyearday', 'bymonthday', 'byweekday', 'byeaster')
+
+_FIXED_STEPS = {
+    'WEEKLY': datetime.timedelta(weeks=1),
+    'DAILY': datetime.timedelta(days=1),
+    'HOURLY': datetime.timedelta(hours=1),
+    'MINUTELY': datetime.timedelta(minutes=1),
+    'SECONDLY': datetime.timedelta(seconds=1),
+}
+
+# Rule.params names and their iCalendar (RFC 5545) RRULE counterparts
+_RRULE_PARTS = (
+    ('interval', 'INTERVAL'),
+    ('count', 'COUNT'),
+    ('bysetpos', 'BYSETPOS'),
+    ('bymonth', 'BYMONTH'),
+    ('byweekno', 'BYWEEKNO'),
+    ('byyearday', 'BYYEARDAY'),
+    ('bymonthday', 'BYMONTHDAY'),
+    ('byweekday', 'BYDAY'),
+    ('byhour', 'BYHOUR'),
+    ('byminute', 'BYMINUTE'),
+    ('bysecond', 'BYSECOND'),
+    ('wkst', 'WKST'),
+)
+_WEEKDAYS = ('MO', 'TU', 'WE', 'TH', 'FR', 'SA', 'SU')
+
+_params_cache = LRUCache(RULE_CACHE_SIZE)
+_rrule_cache = LRUCache(RULE_CACHE_SIZE)
+_checkpoint_cache = LRUCache(RULE_CACHE_SIZE)
+_checkpoint_lock = threading.Lock()
+
+
+def _rule_key(rule):
+    return (rule.pk, rule.frequency, rule.params)
+
+
+def get_params(rule):
+    """
+    Returns the parsed ``params`` of ``rule``, parsing them only once for
+    each rule definition.
+    """
+    key = _rule_key(rule)
+    params = _params_cache.get(key)
+    if params is None:
+        params = rule.get_params()
+        _params_cache.set(key, params)
+    # callers pass this straight to rrule() as keyword arguments, hand out a
+    # copy so the cached dict can't be modified
+    return dict(params)
+
+
+def get_rrule(rule, dtstart, seek=None):
+    """
+    Returns the dateutil ``rrule`` for ``rule`` starting at ``dtstart``.
+
+    rrule objects are immutable and can be iterated any number of times, so
+    the same instance is shared by every event using this rule and start.
+
+    If ``seek`` is given the returned rrule may start later than ``dtstart``,
+    but not later than ``seek``: it yields the same occurrences as the
+    original from its own start onwards, without iterating over the ones
+    before it.
+    """
+    key = _rule_key(rule) + (dtstart,)
+    compiled = _rrule_cache.get(key)
+    if compiled is None:
+        compiled = rrule.rrule(getattr(rrule, rule.frequency),
+                               dtstart=dtstart, **get_params(rule))
+        _rrule_cache.set(key, compiled)
+    if seek is None or seek <= dtstart:
+        return compiled
+    params = get_params(rule)
+    if set(params) <= set(['interval']):
+        return _seek_arithmetic(rule.frequency, params.get('interval', 1), dtstart, seek)
+    return _seek_checkpoint(key, compiled, rule.frequency, params, dtstart, seek)
+
+
+def _seek_arithmetic(frequency, interval, dtstart, seek):
+    """
+    Moves the start of a rule without BY* params or count forward by a whole
+    number of intervals.
+    """
+    freq = getattr(rrule, frequency)
+    if frequency in _FIXED_STEPS:
+        step = _FIXED_STEPS[frequency] * interval
+        steps = int(_total_seconds(seek - dtstart) // _total_seconds(step))
+        return rrule.rrule(freq, dtstart=dtstart + step * steps, interval=interval)
+    # restart at midnight on the first day of the aligned month or year, with
+    # the day and time of the occurrences taken from the original dtstart
+    params = _explicit_params(freq, {'interval': interval}, dtstart)
+    if frequency == 'MONTHLY':
+        months = (seek.year - dtstart.year) * 12 + seek.month - dtstart.month
+        months = months // interval * interval + dtstart.month - 1
+        start = datetime.datetime(dtstart.year + months // 12, months % 12 + 1, 1)
+    else:
+        years = (seek.year - dtstart.year) // interval * interval
+        start = datetime.datetime(dtstart.year + years, 1, 1)
+    return rrule.rrule(freq, dtstart=start, **params)
+
+
+def _seek_checkpoint(key, compiled, frequency, params, dtstart, seek):
+    """
+    Restarts the rule from the last checkpoint before ``seek``.  Checkpoints
+    are every CHECKPOINT_INTERVAL-th occurrence; they are found by iterating
+    the rule once and then cached.
+    """
+    freq = getattr(rrule, frequency)
+    params = _explicit_params(freq, params, dtstart)
+    with _checkpoint_lock:
+        checkpoints = _checkpoint_cache.get(key)
+        if checkpoints is None:
+            checkpoints = {'anchors': [dtstart], 'exhausted': False}
+            _checkpoint_cache.set(key, checkpoints)
+        anchors = checkpoints['anchors']
+        if anchors[-1] < seek and not checkpoints['exhausted']:
+            # extend the checkpoints from the last one up to seek
+            resumed = _resume(freq, params, anchors[-1], (len(anchors) - 1) * CHECKPOINT_INTERVAL)
+            position = 0
+            checkpoints['exhausted'] = True
+            for occurrence in resumed:
+                if position and position % CHECKPOINT_INTERVAL == 0:
+                    anchors.append(occurrence)
+                    if occurrence >= seek:
+                        checkpoints['exhausted'] = False
+                        break
+                position += 1
+        index = bisect.bisect_right(anchors, seek) - 1
+    if index <= 0:
+        return compiled
+    return _resume(freq, params, anchors[index], index * CHECKPOINT_INTERVAL)
+
+
+def _resume(freq, params, anchor, position):
+    """
+    Returns an rrule yielding the occurrences from the ``position``-th one,
+    which is ``anchor``.
+    """
+    params = dict(params)
+    if params.get('count') is not None:
+        params['count'] = max(params['count'] - position, 0)
+    return rrule.rrule(freq, dtstart=anchor, **params)
+
+
+def _explicit_params(freq, params, dtstart):
+    """
+    rrule fills the params which are not given from its dtstart (the day of
+    the month of a MONTHLY rule for example).  Sets them explicitly, as when
+    the rule is restarted from a checkpoint its dtstart is another date.
+    """
+    params = dict(params)
+    if all([params.get(name) is None for name in _DTSTART_DERIVED]):
+        if freq == rrule.YEARLY:
+            if params.get('bymonth') is None:
+                params['bymonth'] = dtstart.month
+            params['bymonthday'] = dtstart.day
+        elif freq == rrule.MONTHLY:
+            params['bymonthday'] = dtstart.day
+        elif freq == rrule.WEEKLY:
+            params['byweekday'] = dtstart.weekday()
+    if freq < rrule.HOURLY and params.get('byhour') is None:
+        params['byhour'] = dtstart.hour
+    if freq < rrule.MINUTELY and params.get('byminute') is None:
+        params['byminute'] = dtstart.minute
+    if freq < rrule.SECONDLY and params.get('bysecond') is None:
+        params['bysecond'] = dtstart.second
+    return params
+
+
+def to_rrule_string(rule, dtstart, until=None):
+    """
+    Returns the value of the iCalendar RRULE of ``rule`` starting at
+    ``dtstart`` and ending at ``until`` (included, as the
+    end_recurring_period of events), or None if the rule can't be written
+    as an RRULE (byeaster has no iCalendar equivalent), e.g.
+    'FREQ=WEEKLY;INTERVAL=2;BYDAY=MO,WE;UNTIL=20080630T120000'.
+    """
+    params = get_params(rule)
+    if set(params) - set([name for name, part in _RRULE_PARTS]):
+        return None
+    if until is not None and params.get('count') is not None:
+        # COUNT and UNTIL can't be combined, keep the one which ends first
+        occurrences = list(get_rrule(rule, dtstart))
+        if not occurrences or occurrences[-1] <= until:
+            until = None
+        else:
+            del params['count']
+    parts = ['FREQ=%s' % rule.frequency]
+    for name, part in _RRULE_PARTS:
+        values = params.get(name)
+        if values is None:
+            continue
+        if not isinstance(values, list):
+            values = [values]
+        if name in ('byweekday', 'wkst'):
+            values = [_WEEKDAYS[value] for value in values]
+        parts.append('%s=%s' % (part, ','.join([str(value) for value in values])))
+    if until is not None:
+        parts.append('UNTIL=%s' % until.strftime('%Y%m%dT%H%M%S'))
+    return ';'.join(parts)
+
+
+def from_rrule_string(value):
+    """
+    Parses the value of an iCalendar RRULE into the ``frequency`` and
+    ``params`` of a Rule and the end_recurring_period of its event (None
+    without UNTIL).  Raises ValueError if Rule can't express it, e.g. BYDAY
+    with an ordinal for several week days.
+    """
+    parts = {}
+    for part in value.upper().split(';'):
+        name, sep, part_value = part.partition('=')
+        if not sep:
+            raise ValueError("Invalid RRULE part %r" % part)
+        parts[name] = part_value
+    frequency = parts.pop('FREQ', None)
+    if frequency not in _FIXED_STEPS and frequency not in ('MONTHLY', 'YEARLY'):
+        raise ValueError("Unsupported RRULE frequency %r" % frequency)
+    until = parts.pop('UNTIL', None)
+    if until is not None:
+        until = _parse_until(until)
+    params = {}
+    for name, part in _RRULE_PARTS:
+        if part in parts:
+            params[name] = parts.pop(part).split(',')
+    if parts:
+        raise ValueError("Unsupported RRULE parts %s" % ', '.join(sorted(parts)))
+    if 'byweekday' in params:
+        _parse_byday(params)
+    if 'wkst' in params:
+        params['wkst'] = [_WEEKDAYS.index(day) for day in params['wkst']]
+    params = ';'.join(['%s:%s' % (name, ','.join([str(int(item)) for item in params[name]]))
+                       for name, part in _RRULE_PARTS if name in params])
+    return frequency, params or None, until
+
+
+def _parse_byday(params):
+    """
+    Replaces the BYDAY values of ``params`` by week day numbers.  An ordinal
+    (the last Friday is -1FR) is only supported for a single day, and becomes
+    a bysetpos.
+    """
+    days = []
+    ordinals = set()
+    for day in params['byweekday']:
+        if day[-2:] not in _WEEKDAYS:
+            raise ValueError("Invalid BYDAY %r" % day)
+        days.append(_WEEKDAYS.index(day[-2:]))
+        if day[:-2]:
+            ordinals.add(int(day[:-2]))
+    if ordinals:
+        # the other BY* params would expand or filter the set bysetpos picks
+        # from, where the ordinal applies to the week day alone
+        if len(days) > 1 or set(params) - set(['byweekday', 'bymonth', 'interval', 'count', 'wkst']):
+            raise ValueError("Unsupported BYDAY ordinals %s" % ','.join(params['byweekday']))
+        params['bysetpos'] = list(ordinals)
+    params['byweekday'] = days
+
+
+def _parse_until(value):
+    if 'T' not in value:
+        # the whole day is included
+        day = datetime.datetime.strptime(value, '%Y%m%d')
+        return day.replace(hour=23, minute=59, second=59)
+    until = datetime.datetime.strptime(value.rstrip('Z'), '%Y%m%dT%H%M%S')
+    if value.endswith('Z'):
+        until = until.replace(tzinfo=tz.tzutc()).astimezone(tz.tzlocal()).replace(tzinfo=None)
+    return until
+
+
+def _total_seconds(delta):
+    return delta.days * 86400 + delta.seconds + delta.microseconds / 1000000.0
+
+
+def invalidate_rule(rule_id):
+    """
+    Drops every compiled form of the rule with id ``rule_id``.
+    """
+    _params_cache.discard(lambda key: key[0] == rule_id)
+    _rrule_cache.discard(lambda key: key[0] == rule_id)
+    _checkpoint_cache.discard(lambda key: key[0] == rule_id)
@@ -1,6 +1,12 @@
-from django.db.models.signals import pre_save
+import threading
 
-from models import Event, Calendar
+from django.db.models.signals import pre_save, post_save, pre_delete, post_delete
+
+from cache import bump_calendar_version
+from conf.settings import OCCURRENCE_INDEX, PREVENT_DOUBLE_BOOKING
+from conflicts import check_event, check_occurrence
+from models import Event, EventRelation, Calendar, CalendarRelation, CalendarChange, Rule, Occurrence, OccurrenceIndex
+from recurrence import invalidate_rule
 
 def optionnal_calendar(sender, **kwargs):
     event = kwargs.pop('instance')
@@ -17,4 +23,156 @@ def optionnal_calendar(sender, **kwargs):
         event.calendar = calendar
     return True
 
+def invalidate_compiled_rule(sender, **kwargs):
+    invalidate_rule(kwargs['instance'].pk)
+
+def calendar_changed(calendar_id):
+    """
+    Invalidates what is cached for the calendar, and touches its updated_on
+    for conditional GETs.
+    """
+    bump_calendar_version(calendar_id)
+    Calendar.objects.touch(calendar_id)
+
+def remember_event_calendar(sender, **kwargs):
+    # the calendar an event is moved from changes too
+    event = kwargs['instance']
+    event._previous_calendar_id = None
+    if event.pk is not None:
+        previous = list(Event.objects.filter(pk=event.pk).values_list('calendar', flat=True))
+        if previous and previous[0] != event.calendar_id:
+            event._previous_calendar_id = previous[0]
+
+def _previous_calendar_id(event, signal):
+    if signal is post_save:
+        return getattr(event, '_previous_calendar_id', None)
+
+def invalidate_event_calendar(sender, **kwargs):
+    event = kwargs['instance']
+    calendar_changed(event.calendar_id)
+    previous_calendar_id = _previous_calendar_id(event, kwargs['signal'])
+    if previous_calendar_id is not None:
+        calendar_changed(previous_calendar_id)
+
+def invalidate_occurrence_calendar(sender, **kwargs):
+    occurrence = kwargs['instance']
+    if occurrence.event_id in _deleting_events():
+        # the event's own post_delete bumps the version
+        return
+    calendar_changed(occurrence.event.calendar_id)
+
+def invalidate_calendar(sender, **kwargs):
+    bump_calendar_version(kwargs['instance'].pk)
+
+def invalidate_relation_calendar(sender, **kwargs):
+    calendar_changed(kwargs['instance'].calendar_id)
+
+def invalidate_rule_calendars(sender, **kwargs):
+    calendar_ids = Event.objects.filter(rule=kwargs['instance']).values_list(
+        'calendar', flat=True).distinct()
+    for calendar_id in calendar_ids:
+        calendar_changed(calendar_id)
+        CalendarChange.objects.record(calendar_id, 'rule', kwargs['instance'].pk)
+
+def prevent_event_double_booking(sender, **kwargs):
+    event = kwargs['instance']
+    # forms already checked the instances they validated and save
+    if not getattr(event, '_conflicts_checked', False):
+        check_event(event)
+
+def prevent_occurrence_double_booking(sender, **kwargs):
+    occurrence = kwargs['instance']
+    if not getattr(occurrence, '_conflicts_checked', False):
+        check_occurrence(occurrence)
+
+# The change log of the calendars, for incremental synchronization
+def log_event_change(sender, **kwargs):
+    event = kwargs['instance']
+    CalendarChange.objects.record(event.calendar_id, 'event', event.pk,
+                                  deleted=kwargs['signal'] is post_delete)
+    previous_calendar_id = _previous_calendar_id(event, kwargs['signal'])
+    if previous_calendar_id is not None:
+        # it left the previous calendar
+        CalendarChange.objects.record(previous_calendar_id, 'event', event.pk, deleted=True)
+
+def log_occurrence_change(sender, **kwargs):
+    occurrence = kwargs['instance']
+    if occurrence.event_id in _deleting_events():
+        # deleted with its event
+        return
+    CalendarChange.objects.record(occurrence.event.calendar_id, 'occurrence',
+        occurrence.pk, deleted=kwargs['signal'] is post_delete)
+
+def log_relation_change(sender, **kwargs):
+    relation = kwargs['instance']
+    CalendarChange.objects.record(relation.calendar_id, 'relation', relation.pk,
+                                  deleted=kwargs['signal'] is post_delete)
+
+def log_event_relation_change(sender, **kwargs):
+    relation = kwargs['instance']
+    if relation.event_id in _deleting_events():
+        # deleted with its event
+        return
+    CalendarChange.objects.record(relation.event.calendar_id, 'event_relation',
+        relation.pk, deleted=kwargs['signal'] is post_delete)
+
 pre_save.connect(optionnal_calendar)
+if PREVENT_DOUBLE_BOOKING:
+    pre_save.connect(prevent_event_double_booking, sender=Event)
+    pre_save.connect(prevent_occurrence_double_booking, sender=Occurrence)
+post_save.connect(invalidate_compiled_rule, sender=Rule)
+post_delete.connect(invalidate_compiled_rule, sender=Rule)
+pre_save.connect(remember_event_calendar, sender=Event)
+post_save.connect(invalidate_event_calendar, sender=Event)
+post_delete.connect(invalidate_event_calendar, sender=Event)
+post_save.connect(invalidate_occurrence_calendar, sender=Occurrence)
+post_delete.connect(invalidate_occurrence_calendar, sender=Occurrence)
+post_save.connect(invalidate_rule_calendars, sender=Rule)
+post_save.connect(invalidate_calendar, sender=Calendar)
+post_save.connect(invalidate_relation_calendar, sender=CalendarRelation)
+post_delete.connect(invalidate_relation_calendar, sender=CalendarRelation)
+post_save.connect(log_event_change, sender=Event)
+post_delete.connect(log_event_change, sender=Event)
+post_save.connect(log_occurrence_change, sender=Occurrence)
+post_delete.connect(log_occurrence_change, sender=Occurrence)
+post_save.connect(log_relation_change, sender=CalendarRelation)
+post_delete.connect(log_relation_change, sender=CalendarRelation)
+post_save.connect(log_event_relation_change, sender=EventRelation)
+post_delete.connect(log_event_relation_change, sender=EventRelation)
+
+
+# Occurrence index maintenance.  Deleting an event cascades to its
+# occurrences, whose post_delete must not reindex the event being deleted.
+_deleting = threading.local()
+
+def _deleting_events():
+    if not hasattr(_deleting, 'events'):
+        _deleting.events = set()
+    return _deleting.events
+
+def index_event(sender, **kwargs):
+    OccurrenceIndex.objects.index_event(kwargs['instance'])
+
+def index_rule_events(sender, **kwargs):
+    OccurrenceIndex.objects.index_rule(kwargs['instance'])
+
+def index_occurrence_event(sender, **kwargs):
+    occurrence = kwargs['instance']
+    if occurrence.event_id in _deleting_events():
+        return
+    OccurrenceIndex.objects.index_event(occurrence.event)
+
+def start_event_deletion(sender, **kwargs):
+    _deleting_events().add(kwargs['instance'].pk)
+
+def end_event_deletion(sender, **kwargs):
+    _deleting_events().discard(kwargs['instance'].pk)
+
+if OCCURRENCE_INDEX:
+    post_save.connect(index_event, sender=Event)
+    post_save.connect(index_rule_events, sender=Rule)
+    post_save.connect(index_occurrence_event, sender=Occurrence)
+    post_delete.connect(index_occurrence_event, sender=Occurrence)
+
+pre_delete.connect(start_event_deletion, sender=Event)
+post_delete.connect(end_event_deletion, sender=Event)
@@ -1,11 +1,17 @@
 import datetime
 import os
+import pickle
 
+from dateutil import rrule
+
+from django.core.exceptions import ValidationError
 from django.test import TestCase
 from django.core.urlresolvers import reverse
 
-from appointments.models import Event, Rule, Occurrence, Calendar
+from appointments.conflicts import check_event, get_event_conflicts
+from appointments.models import Event, Rule, Occurrence, Calendar, VirtualOccurrence
 from appointments.periods import Period, Month, Day
+from appointments.recurrence import to_rrule_string
 from appointments.utils import EventListManager
 
 
@@ -48,6 +54,103 @@ class TestEvent(TestCase):
         occurrence2 = recurring_event.occurrences_after(datetime.datetime(2008,1,5)).next()
         self.assertEqual(occurrence, occurrence2)
 
+    def test_occurrences_after_without_end(self):
+        data = dict(self.recurring_data, end_recurring_period=None)
+        recurring_event = Event(**data)
+        recurring_event.save()
+        occurrence = recurring_event.occurrences_after(datetime.datetime(2010, 1, 1)).next()
+        self.assertEqual(occurrence.start, datetime.datetime(2010, 1, 2, 8, 0))
+
+    def test_get_for_range(self):
+        recurring_event = Event(**self.recurring_data)
+        recurring_event.save()
+        single_event = Event(**self.data)
+        single_event.save()
+        events = Event.objects.get_for_range(datetime.datetime(2008, 1, 5, 8, 30),
+                                             datetime.datetime(2008, 1, 6))
+        self.assertEqual(set(events), set([recurring_event, single_event]))
+        events = Event.objects.get_for_range(datetime.datetime(2008, 2, 1),
+                                             datetime.datetime(2008, 2, 2))
+        self.assertEqual(list(events), [recurring_event])
+        events = Event.objects.get_for_range(datetime.datetime(2008, 6, 1),
+                                             datetime.datetime(2008, 6, 2))
+        self.assertEqual(list(events), [])
+
+    def test_get_for_range_last_occurrence_running(self):
+        # its last occurrence starts on the 10th and ends on the 11th
+        data = dict(self.recurring_data, start=datetime.datetime(2008, 1, 3, 22, 0),
+                    end=datetime.datetime(2008, 1, 4, 2, 0),
+                    end_recurring_period=datetime.datetime(2008, 1, 10, 22, 0))
+        recurring_event = Event.objects.create(**data)
+        events = Event.objects.get_for_range(datetime.datetime(2008, 1, 11),
+                                             datetime.datetime(2008, 1, 12))
+        self.assertEqual(list(events), [recurring_event])
+        period = Period(events, datetime.datetime(2008, 1, 11), datetime.datetime(2008, 1, 12))
+        self.assertEqual([o.start for o in period.occurrences],
+                         [datetime.datetime(2008, 1, 10, 22, 0)])
+
+    def test_get_event_conflicts(self):
+        recurring_event = Event(**self.recurring_data)
+        recurring_event.save()
+        # a single event on a later saturday collides with the series
+        booking = Event(title='Booking', calendar=recurring_event.calendar,
+                        start=datetime.datetime(2008, 3, 1, 8, 30),
+                        end=datetime.datetime(2008, 3, 1, 9, 30))
+        conflicts = get_event_conflicts(booking)
+        self.assertEqual([(o.start, other.start) for o, other in conflicts],
+            [(datetime.datetime(2008, 3, 1, 8, 30), datetime.datetime(2008, 3, 1, 8, 0))])
+        self.assertRaises(ValidationError, check_event, booking)
+        booking.start = datetime.datetime(2008, 3, 1, 9, 0)
+        self.assertEqual(get_event_conflicts(booking), [])
+        occurrence = recurring_event.get_occurrences(datetime.datetime(2008, 3, 1),
+                                                     datetime.datetime(2008, 3, 2))[0]
+        occurrence.cancel()
+        booking.start = datetime.datetime(2008, 3, 1, 8, 30)
+        self.assertEqual(get_event_conflicts(booking), [])
+
+    def test_get_event_conflicts_recurring(self):
+        recurring_event = Event.objects.create(**self.recurring_data)
+        booking = Event(title='Booking', calendar=recurring_event.calendar,
+                        rule=recurring_event.rule,
+                        start=datetime.datetime(2008, 1, 5, 9, 0),
+                        end=datetime.datetime(2008, 1, 5, 9, 30),
+                        end_recurring_period=datetime.datetime(2008, 3, 1))
+        after = datetime.datetime(2008, 1, 1)
+        self.assertEqual(get_event_conflicts(booking, after=after), [])
+        booking.start = datetime.datetime(2008, 1, 5, 8, 30)
+        conflicts = get_event_conflicts(booking, after=after)
+        self.assertEqual(len(conflicts), 8)
+        self.assertEqual(conflicts[-1][1].start, datetime.datetime(2008, 2, 23, 8, 0))
+
+    def test_get_event_conflicts_old_series(self):
+        # a weekly series started long before the horizon, edited today
+        now = datetime.datetime.now().replace(hour=8, minute=0, second=0, microsecond=0)
+        start = now - datetime.timedelta(weeks=3 * 52)
+        series = Event.objects.create(title='Old series', calendar=self.recurring_data['calendar'],
+                                      rule=self.recurring_data['rule'], start=start,
+                                      end=start + datetime.timedelta(hours=1))
+        later = start + datetime.timedelta(weeks=3 * 52 + 4, minutes=30)
+        Event.objects.create(title='Booking', calendar=series.calendar, start=later,
+                             end=later + datetime.timedelta(hours=1))
+        conflicts = get_event_conflicts(series)
+        self.assertEqual([(o.start, other.start) for o, other in conflicts],
+                         [(later - datetime.timedelta(minutes=30), later)])
+
+    def test_form_conflict_check_only_spares_its_save(self):
+        from appointments.forms import EventForm
+        recurring_event = Event.objects.create(**self.recurring_data)
+        form = EventForm(data={'title': 'Booking',
+                               'start_0': '2008-03-01', 'start_1': '10:00',
+                               'end_0': '2008-03-01', 'end_1': '11:00'},
+                         calendar=recurring_event.calendar, check_conflicts=True)
+        self.assertTrue(form.is_valid())
+        # validated, but not saved by the form: saving it elsewhere checks
+        self.assertFalse(getattr(form.instance, '_conflicts_checked', False))
+        form.instance.calendar = recurring_event.calendar
+        event = form.save()
+        self.assertTrue(event.pk is not None)
+        self.assertFalse(event._conflicts_checked)
+
     def test_get_occurrence(self):
         event = Event(**self.recurring_data)
         event.save()
@@ -94,6 +197,60 @@ class TestOccurrence(TestCase):
         self.assertTrue(occurrences[0].pk)
         self.assertFalse(occurrences[1].pk)
 
+    def test_virtual_occurrences(self):
+        occurrences = self.recurring_event.get_occurrences(start=self.start,
+                                    end=self.end)
+        occurrence = occurrences[0]
+        self.assertTrue(isinstance(occurrence, VirtualOccurrence))
+        self.assertEqual(occurrence.title, self.recurring_event.title)
+        self.assertTrue(occurrence.pk is None)
+        persisted = occurrence.persist()
+        self.assertTrue(isinstance(persisted, Occurrence))
+        self.assertEqual((persisted.start, persisted.end),
+                         (occurrence.start, occurrence.end))
+        occurrence.save()
+        self.assertEqual(occurrence.pk, persisted.pk)
+        self.assertEqual(self.recurring_event.get_occurrences(start=self.start,
+                                    end=self.end)[0].pk, persisted.pk)
+
+    def test_virtual_occurrence_pickle(self):
+        occurrence = self.recurring_event.get_occurrences(start=self.start,
+                                    end=self.end)[1]
+        occurrence.move(occurrence.start + datetime.timedelta(hours=1),
+                        occurrence.end + datetime.timedelta(hours=1))
+        for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+            copy = pickle.loads(pickle.dumps(occurrence, protocol))
+            self.assertEqual(copy, occurrence)
+            self.assertEqual((copy.start, copy.end, copy.pk),
+                             (occurrence.start, occurrence.end, occurrence.pk))
+
+    def test_title_read_from_event(self):
+        for occurrence in self.recurring_event.get_occurrences(
+                datetime.datetime(2008, 1, 1), datetime.datetime(2008, 3, 1)):
+            occurrence.save()
+        Occurrence.objects.filter(start=datetime.datetime(2008, 1, 5, 8, 0)).update(title='Renamed')
+        period = Period([self.recurring_event], datetime.datetime(2008, 1, 1), datetime.datetime(2008, 3, 1))
+        # one query, however many occurrences are loaded
+        with self.assertNumQueries(1):
+            titles = [occurrence.title for occurrence in period.get_persisted_occurrences()]
+        self.assertEqual(len(titles), 8)
+        self.assertEqual(titles.count('Renamed'), 1)
+        self.assertEqual(titles.count(self.recurring_event.title), 7)
+        occurrence = Occurrence.objects.get(start=datetime.datetime(2008, 1, 12, 8, 0))
+        self.assertEqual(occurrence.description, self.recurring_event.description)
+        occurrence.title = 'Renamed'
+        self.assertEqual(occurrence.title, 'Renamed')
+
+    def test_title_saved_as_null(self):
+        occurrence = self.recurring_event.get_occurrences(self.start, self.end)[0].persist()
+        occurrence.save()
+        self.assertEqual(occurrence.title, self.recurring_event.title)
+        self.assertEqual(Occurrence.objects.filter(pk=occurrence.pk)
+                         .values_list('title', 'description')[0], (None, None))
+        self.recurring_event.title = 'Renamed'
+        self.recurring_event.save()
+        self.assertEqual(Occurrence.objects.get(pk=occurrence.pk).title, 'Renamed')
+
     def test_moved_occurrences(self):
         occurrences = self.recurring_event.get_occurrences(start=self.start,
                                     end=self.end)
@@ -130,3 +287,61 @@ class TestOccurrence(TestCase):
                                     end=self.end)
         self.assertFalse(occurrences[2].cancelled)
 
+
+
+class TestRule(TestCase):
+    def setUp(self):
+        self.rule = Rule(frequency = "WEEKLY", params = "interval:2")
+        self.rule.save()
+        cal = Calendar(name="MyCal")
+        cal.save()
+        self.event = Event(**{
+                'title': 'Fortnightly Event',
+                'start': datetime.datetime(2008, 1, 5, 8, 0),
+                'end': datetime.datetime(2008, 1, 5, 9, 0),
+                'rule': self.rule,
+                'calendar': cal
+               })
+        self.event.save()
+
+    def test_compiled_rule_is_shared(self):
+        other = Event.objects.get(pk=self.event.pk)
+        self.assertTrue(self.event.get_rrule_object() is other.get_rrule_object())
+
+    def test_compiled_rule_invalidated_on_save(self):
+        rrule_object = self.event.get_rrule_object()
+        self.assertEqual(rrule_object.after(datetime.datetime(2008, 1, 5, 8, 0)),
+                         datetime.datetime(2008, 1, 19, 8, 0))
+        self.rule.params = "interval:1"
+        self.rule.save()
+        rrule_object = Event.objects.get(pk=self.event.pk).get_rrule_object()
+        self.assertEqual(rrule_object.after(datetime.datetime(2008, 1, 5, 8, 0)),
+                         datetime.datetime(2008, 1, 12, 8, 0))
+
+    def test_seek(self):
+        start = datetime.datetime(2012, 3, 1)
+        end = datetime.datetime(2012, 4, 1)
+        for params in ("interval:2", "byweekday:0,3;interval:2", "count:300;byweekday:5"):
+            self.rule.params = params
+            self.rule.save()
+            event = Event.objects.get(pk=self.event.pk)
+            self.assertTrue(event.get_rrule_object(start)._dtstart <= start)
+            self.assertEqual(event.get_rrule_object(start).between(start, end, inc=True),
+                             event.get_rrule_object().between(start, end, inc=True))
+
+    def test_to_rrule_string(self):
+        until = datetime.datetime(2009, 1, 1)
+        for params in ("interval:2", "byweekday:0,3;interval:2", "count:10;byweekday:5",
+                       "count:300;byweekday:5"):
+            self.rule.params = params
+            self.rule.save()
+            event = Event.objects.get(pk=self.event.pk)
+            exported = rrule.rrulestr(to_rrule_string(self.rule, event.start, until),
+                                      dtstart=event.start)
+            self.assertEqual(list(exported),
+                             event.get_rrule_object().between(event.start, until, inc=True))
+        self.assertEqual(to_rrule_string(Rule(frequency="WEEKLY", params="byweekday:0,2;interval:2"),
+                                         event.start, datetime.datetime(2008, 6, 30, 12)),
+                         'FREQ=WEEKLY;INTERVAL=2;BYDAY=MO,WE;UNTIL=20080630T120000')
+        self.assertEqual(to_rrule_string(Rule(frequency="YEARLY", params="byeaster:0"),
+                                         event.start), None)
@@ -6,8 +6,9 @@ from django.conf import settings
 from django.core.urlresolvers import reverse
 
 from appointments.conf.settings import FIRST_DAY_OF_WEEK
-from appointments.models import Event, Rule, Occurrence, Calendar
+from appointments.models import Event, Rule, Occurrence, Calendar, OccurrenceIndex
 from appointments.periods import Period, Month, Day, Year
+from appointments.freebusy import FreeBusy, find_free_slots, merge_intervals
 from appointments.utils import EventListManager
 
 
@@ -64,6 +65,29 @@ class TestPeriod(TestCase):
                                           datetime.datetime(2008,1,4,7,12) )
         self.failIf( slot.has_occurrences() )
 
+    def test_persisted_occurrences_single_query(self):
+        events = list(Event.objects.all())
+        period = Period(events, self.period.start, self.period.end)
+        self.assertNumQueries(1, lambda: period.occurrences)
+
+    def test_iter_occurrences(self):
+        event = Event.objects.get()
+        other = Event.objects.create(title='Other Event', calendar=event.calendar,
+                                     start=datetime.datetime(2008, 1, 12, 8, 0),
+                                     end=datetime.datetime(2008, 1, 12, 8, 30))
+        occurrence = event.get_occurrence(datetime.datetime(2008, 1, 19, 8, 0))
+        occurrence.move(datetime.datetime(2008, 1, 5, 7, 0), datetime.datetime(2008, 1, 5, 7, 30))
+        period = Period(Event.objects.all(), self.period.start, self.period.end)
+        occurrences = period.iter_occurrences()
+        self.assertEqual(occurrences.next().start, datetime.datetime(2008, 1, 5, 7, 0))
+        self.failIf(hasattr(period, '_occurrences'))
+        self.assertEqual([(o.event, o.start) for o in period.occurrences], [
+            (event, datetime.datetime(2008, 1, 5, 7, 0)),
+            (event, datetime.datetime(2008, 1, 5, 8, 0)),
+            (other, datetime.datetime(2008, 1, 12, 8, 0)),
+            (event, datetime.datetime(2008, 1, 12, 8, 0)),
+        ])
+
 
 class TestYear(TestCase):
 
@@ -183,6 +207,29 @@ class TestMonth(TestCase):
         self.assertEqual( self.month.prev_year().start, datetime.datetime(2007, 1, 1, 0, 0))
         self.assertEqual( self.month.next_year().start, datetime.datetime(2009, 1, 1, 0, 0))
 
+    def test_occurrence_counts(self):
+        counts = self.month.occurrence_counts()
+        self.assertEqual(len(counts), 29)
+        self.assertEqual([day + 1 for day, count in enumerate(counts) if count],
+                         [2, 9, 16, 23])
+        day = self.month.get_day(2)
+        # like its partials, the occurrence is in the hour it ends at 9:00
+        self.assertEqual(day.occurrence_counts('hour')[7:11], [0, 1, 1, 0])
+
+    def test_occurrence_counts_ending_at_midnight(self):
+        Event(title='Late Event', calendar=Calendar.objects.get(),
+              start=datetime.datetime(2008, 2, 12, 22, 0),
+              end=datetime.datetime(2008, 2, 13, 0, 0)).save()
+        month = Month(Event.objects.all(), datetime.datetime(2008, 2, 7, 9, 0))
+        counts = month.occurrence_counts()
+        for number in (12, 13, 14):
+            day = month.get_day(number)
+            self.assertEqual(counts[number - 1], day.occurrence_counts()[0])
+            self.assertEqual(counts[number - 1], len(day.get_occurrence_partials()))
+            self.assertEqual(bool(counts[number - 1]), day.has_occurrences())
+        self.assertEqual(counts[11:14], [1, 1, 0])
+        self.assertEqual([o['class'] for o in month.get_day(13).get_occurrence_partials()], [3])
+
 
 class TestDay(TestCase):
     def setUp(self):
@@ -205,24 +252,31 @@ class TestDay(TestCase):
         self.assertEqual( period.end, slot_end )
 
 
-class TestOccurrencePool(TestCase):
-    
+class RecurringEventTestCase(TestCase):
+    """
+    A weekly event on Saturdays from 8 to 9, from January 5th to May 5th
+    2008, in ``self.cal``.
+    """
+
     def setUp(self):
         rule = Rule(frequency = "WEEKLY")
         rule.save()
-        cal = Calendar(name="MyCal")
-        cal.save()
+        self.cal = Calendar(name="MyCal")
+        self.cal.save()
         data = {
                 'title': 'Recent Event',
                 'start': datetime.datetime(2008, 1, 5, 8, 0),
                 'end': datetime.datetime(2008, 1, 5, 9, 0),
                 'end_recurring_period' : datetime.datetime(2008, 5, 5, 0, 0),
                 'rule': rule,
-                'calendar': cal
+                'calendar': self.cal
                }
         self.recurring_event = Event(**data)
         self.recurring_event.save()
 
+
+class TestOccurrencePool(RecurringEventTestCase):
+
     def testPeriodFromPool(self):
         """
             Test that period initiated with occurrence_pool returns the same occurrences as "straigh" period
@@ -234,3 +288,101 @@ class TestOccurrencePool(TestCase):
         period = Period(parent_period.events, start, end, parent_period.get_persisted_occurrences(), parent_period.occurrences)
         self.assertEquals(parent_period.occurrences, period.occurrences)
 
+
+
+class TestOccurrenceIndex(RecurringEventTestCase):
+
+    def setUp(self):
+        super(TestOccurrenceIndex, self).setUp()
+        OccurrenceIndex.objects.rebuild(datetime.datetime(2008, 1, 1),
+                                        datetime.datetime(2009, 1, 1))
+
+    def test_index_rule(self):
+        rule = self.recurring_event.rule
+        other = Event.objects.create(title='Other Event', rule=rule, calendar=self.cal,
+                                     start=datetime.datetime(2008, 1, 7, 8, 0),
+                                     end=datetime.datetime(2008, 1, 7, 9, 0))
+        other.get_occurrences(datetime.datetime(2008, 1, 14), datetime.datetime(2008, 1, 15))[0].cancel()
+        rule.params = 'interval:2'
+        rule.save()
+        OccurrenceIndex.objects.index_rule(rule)
+        start, end = datetime.datetime(2008, 1, 1), datetime.datetime(2009, 1, 1)
+        events = Event.objects.all()
+        self.assertEqual([(o.start, o.cancelled) for o in
+                          OccurrenceIndex.objects.get_occurrences(events, start, end)],
+                         [(o.start, o.cancelled) for o in Period(events, start, end).occurrences])
+
+    def test_index_matches_expansion(self):
+        start = datetime.datetime(2008, 2, 1)
+        end = datetime.datetime(2008, 3, 1)
+        period = Period(Event.objects.all(), start, end)
+        indexed = OccurrenceIndex.objects.get_occurrences(Event.objects.all(), start, end)
+        self.assertEqual([(o.start, o.end) for o in indexed],
+                         [(o.start, o.end) for o in period.occurrences])
+
+    def test_index_persisted_occurrence(self):
+        start = datetime.datetime(2008, 2, 1)
+        end = datetime.datetime(2008, 3, 1)
+        occurrence = self.recurring_event.get_occurrences(start, end)[0]
+        occurrence.cancel()
+        OccurrenceIndex.objects.index_event(self.recurring_event)
+        indexed = OccurrenceIndex.objects.get_occurrences(Event.objects.all(), start, end)
+        self.assertEqual(indexed[0].pk, occurrence.pk)
+        self.assertTrue(indexed[0].cancelled)
+
+    def testSubPeriodsSharePool(self):
+        year = Year(Event.objects.all(), datetime.datetime(2008, 1, 1))
+        month = list(year.get_months())[0]
+        week = list(month.get_weeks())[1]
+        self.assertTrue(month.occurrence_pool is year.get_occurrence_pool())
+        self.assertTrue(week.occurrence_pool is year.get_occurrence_pool())
+        self.assertEqual([(o.start, o.end) for o in week.occurrences],
+                         [(o.start, o.end) for o in
+                          Period(Event.objects.all(), week.start, week.end).occurrences])
+
+
+class TestFreeBusy(RecurringEventTestCase):
+
+    def setUp(self):
+        super(TestFreeBusy, self).setUp()
+        Event(title='Overlapping Event',
+              start=datetime.datetime(2008, 1, 5, 8, 30),
+              end=datetime.datetime(2008, 1, 5, 10, 0),
+              calendar=self.cal).save()
+
+    def test_merge_intervals(self):
+        self.assertEqual(merge_intervals([(3, 5), (1, 2), (2, 3), (7, 8), (7, 7)]),
+                         [(1, 5), (7, 8)])
+
+    def test_busy_and_free(self):
+        start = datetime.datetime(2008, 1, 5)
+        end = datetime.datetime(2008, 1, 13)
+        occurrence = self.recurring_event.get_occurrences(
+            datetime.datetime(2008, 1, 12), end)[0]
+        occurrence.move(datetime.datetime(2008, 1, 12, 10, 0),
+                        datetime.datetime(2008, 1, 12, 11, 0))
+        freebusy = FreeBusy.for_calendar(self.cal, start, end)
+        self.assertEqual(freebusy.busy, [
+            (datetime.datetime(2008, 1, 5, 8, 0), datetime.datetime(2008, 1, 5, 10, 0)),
+            (datetime.datetime(2008, 1, 12, 10, 0), datetime.datetime(2008, 1, 12, 11, 0)),
+        ])
+        self.assertEqual(freebusy.free[0],
+                         (start, datetime.datetime(2008, 1, 5, 8, 0)))
+        self.assertTrue(freebusy.is_free(datetime.datetime(2008, 1, 12, 8, 0),
+                                         datetime.datetime(2008, 1, 12, 9, 0)))
+        occurrence.cancel()
+        self.assertEqual(len(FreeBusy.for_calendar(self.cal, start, end).busy), 1)
+
+    def test_find_free_slots(self):
+        slots = find_free_slots([self.cal], datetime.timedelta(hours=1),
+            datetime.datetime(2008, 1, 5, 7, 0), datetime.datetime(2008, 1, 5, 13, 0),
+            buffer=datetime.timedelta(minutes=30))
+        self.assertEqual(list(slots), [
+            (datetime.datetime(2008, 1, 5, 11, 0), datetime.datetime(2008, 1, 5, 12, 0)),
+            (datetime.datetime(2008, 1, 5, 12, 0), datetime.datetime(2008, 1, 5, 13, 0)),
+        ])
+        slots = find_free_slots([self.cal], datetime.timedelta(hours=1),
+            datetime.datetime(2008, 1, 5), datetime.datetime(2008, 1, 8),
+            working_hours=(datetime.time(9), datetime.time(17)), weekdays=range(5))
+        self.assertEqual(slots.next(),
+            (datetime.datetime(2008, 1, 7, 9, 0), datetime.datetime(2008, 1, 7, 10, 0)))
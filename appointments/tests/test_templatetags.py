@@ -2,7 +2,8 @@ import datetime
 
 from django.test import TestCase
 
-from appointments.templatetags.scheduletags import querystring_for_date
+from appointments.layout import OccurrenceLayout, assign_columns
+from appointments.templatetags.scheduletags import querystring_for_date, _slot_geometry
 
 class TestTemplateTags(TestCase):
     
@@ -10,4 +11,21 @@ class TestTemplateTags(TestCase):
         date = datetime.datetime(2008,1,1,0,0,0)
         query_string=querystring_for_date(date)
         self.assertEqual("?year=2008&month=1&day=1&hour=0&minute=0&second=0",
-            query_string)
\ No newline at end of file
+            query_string)
+
+    def test_slot_geometry(self):
+        geometry = _slot_geometry(8, 10, 30, 600)
+        self.assertTrue(geometry is _slot_geometry(8, 10, 30, 600))
+        self.assertEqual(geometry[1],
+                         (datetime.timedelta(hours=8, minutes=30), 150, 150))
+        self.assertEqual(len(geometry), 4)
+
+class TestLayout(TestCase):
+
+    def test_assign_columns(self):
+        def layout(start, end):
+            return OccurrenceLayout(None, 1, start, end)
+        layouts = assign_columns([layout(0, 10), layout(2, 5), layout(5, 8),
+            layout(6, 12), layout(12, 13), layout(20, 21), layout(20, 22)])
+        self.assertEqual([(l.column, l.columns) for l in layouts],
+            [(0, 3), (1, 3), (1, 3), (2, 3), (0, 1), (0, 2), (1, 2)])
@@ -1,12 +1,15 @@
 import datetime
 import os
+import tempfile
 
+from django.core.management import call_command
 from django.test import TestCase
 from django.core.urlresolvers import reverse
 
+from appointments import cache
 from appointments.models import Event, Rule, Occurrence, Calendar
 from appointments.periods import Period, Month, Day
-from appointments.utils import EventListManager
+from appointments.utils import EventListManager, OccurrenceReplacer
 
 
 class TestEventListManager(TestCase):
@@ -49,3 +52,189 @@ class TestEventListManager(TestCase):
         self.assertEqual(occurrences.next().event, self.event2)
         self.assertEqual(occurrences.next().event, self.event2)
         self.assertEqual(occurrences.next().event, self.event1)
+
+    def test_occurrences_after_limit(self):
+        occurrence = self.event1.get_occurrence(datetime.datetime(2009, 7, 1, 8, 0))
+        occurrence.move(datetime.datetime(2009, 7, 2, 8, 0), datetime.datetime(2009, 7, 2, 9, 0))
+        eml = EventListManager(Event.objects.all())
+        # event2 ended before
+        self.assertEqual(list(eml._upcoming_events(datetime.datetime(2009, 6, 1))), [self.event1])
+        occurrences = list(eml.occurrences_after(datetime.datetime(2009, 6, 1), limit=6))
+        self.assertEqual(len(occurrences), 6)
+        self.assertEqual(occurrences[4].start, datetime.datetime(2009, 7, 2, 8, 0))
+        self.assertEqual(occurrences[4].original_start, datetime.datetime(2009, 7, 1, 8, 0))
+
+    def test_occurrences_after_index(self):
+        from appointments import utils
+        from appointments.models import OccurrenceIndex
+        # moved out of the index, and into it
+        self.event1.get_occurrence(datetime.datetime(2009, 4, 15, 8, 0)).move(
+            datetime.datetime(2009, 4, 24, 8, 0), datetime.datetime(2009, 4, 24, 9, 0))
+        self.event1.get_occurrence(datetime.datetime(2009, 4, 29, 8, 0)).move(
+            datetime.datetime(2009, 4, 17, 8, 0), datetime.datetime(2009, 4, 17, 9, 0))
+        # an occurrence starts at the end of the horizon
+        OccurrenceIndex.objects.rebuild(datetime.datetime(2009, 4, 1),
+                                        datetime.datetime(2009, 4, 22, 8, 0),
+                                        Event.objects.filter(pk=self.event1.pk))
+        eml = EventListManager(Event.objects.filter(pk=self.event1.pk))
+        utils.OCCURRENCE_INDEX = True
+        try:
+            occurrences = list(eml.occurrences_after(datetime.datetime(2009, 4, 10), limit=5))
+        finally:
+            utils.OCCURRENCE_INDEX = False
+        self.assertEqual([o.start for o in occurrences], [
+            datetime.datetime(2009, 4, 17, 8, 0),
+            datetime.datetime(2009, 4, 22, 8, 0),
+            datetime.datetime(2009, 4, 24, 8, 0),
+            datetime.datetime(2009, 5, 6, 8, 0),
+            datetime.datetime(2009, 5, 13, 8, 0),
+        ])
+
+
+class TestOccurrenceReplacer(TestCase):
+    def setUp(self):
+        daily = Rule.objects.create(frequency="DAILY")
+        cal = Calendar.objects.create(name="MyCal")
+        self.events = []
+        for hour in (8, 10):
+            self.events.append(Event.objects.create(title='Daily Event', rule=daily, calendar=cal,
+                start=datetime.datetime(2008, 1, 1, hour, 0),
+                end=datetime.datetime(2008, 1, 1, hour + 1, 0)))
+        # moved a week later, and a week earlier
+        self.events[0].get_occurrence(datetime.datetime(2008, 1, 2, 8, 0)).move(
+            datetime.datetime(2008, 1, 9, 8, 0), datetime.datetime(2008, 1, 9, 9, 0))
+        self.events[1].get_occurrence(datetime.datetime(2008, 1, 9, 10, 0)).move(
+            datetime.datetime(2008, 1, 2, 10, 0), datetime.datetime(2008, 1, 2, 11, 0))
+
+    def test_shared_by_events(self):
+        occurrences = list(Occurrence.objects.all())
+        start, end = datetime.datetime(2008, 1, 8), datetime.datetime(2008, 1, 10)
+        with self.assertNumQueries(0):
+            replacer = OccurrenceReplacer(occurrences)
+            self.assertEqual([occ.start for occ in replacer.get_additional_occurrences(start, end)],
+                             [datetime.datetime(2008, 1, 9, 8, 0)])
+            self.assertEqual(replacer.get_additional_occurrences(start, end, self.events[1].pk), [])
+            starts = []
+            for event in self.events:
+                starts += [occ.start for occ in event.get_occurrences(start, end, replacer)]
+        # the moved occurrence of the second event left the period
+        self.assertEqual(starts, [
+            datetime.datetime(2008, 1, 8, 8, 0),
+            datetime.datetime(2008, 1, 9, 8, 0),
+            datetime.datetime(2008, 1, 9, 8, 0),
+            datetime.datetime(2008, 1, 8, 10, 0),
+        ])
+
+
+class TestCalendarCache(TestCase):
+
+    def setUp(self):
+        self.calendar = Calendar(name="MyCal")
+        self.calendar.save()
+        self.event = Event(title='Event', calendar=self.calendar,
+                           start=datetime.datetime(2008, 1, 5, 8, 0),
+                           end=datetime.datetime(2008, 1, 5, 9, 0))
+        self.event.save()
+        cache.reset_stats()
+
+    def test_invalidated_by_event_save(self):
+        computed = []
+        def compute():
+            computed.append(1)
+            return len(computed)
+        self.assertEqual(cache.get_or_set(self.calendar.pk, ('test',), compute), 1)
+        self.assertEqual(cache.get_or_set(self.calendar.pk, ('test',), compute), 1)
+        self.event.title = 'Renamed'
+        self.event.save()
+        self.assertEqual(cache.get_or_set(self.calendar.pk, ('test',), compute), 2)
+        stats = cache.get_stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['sets']), (1, 2, 2))
+        self.assertTrue(stats['bytes'] > 0)
+
+    def test_local_copies(self):
+        value = cache.get_or_set(self.calendar.pk, ('test',), lambda: [1])
+        value.append(2)
+        self.assertEqual(cache.get_or_set(self.calendar.pk, ('test',), lambda: None), [1])
+        self.assertEqual(cache.get_stats()['local_hits'], 1)
+
+    def test_invalidated_by_event_move(self):
+        other = Calendar.objects.create(name="Other", slug="other")
+        self.assertEqual(cache.get_or_set(self.calendar.pk, ('test',), lambda: 1), 1)
+        self.assertEqual(cache.get_or_set(other.pk, ('test',), lambda: 1), 1)
+        self.event.calendar = other
+        self.event.save()
+        self.assertEqual(cache.get_or_set(self.calendar.pk, ('test',), lambda: 2), 2)
+        self.assertEqual(cache.get_or_set(other.pk, ('test',), lambda: 2), 2)
+
+
+ICS = """BEGIN:VCALENDAR\r
+VERSION:2.0\r
+BEGIN:VEVENT\r
+UID:standup@example.com\r
+SUMMARY:Standup\r
+DTSTART:20080107T090000\r
+DTEND:20080107T091500\r
+RRULE:FREQ=WEEKLY;BYDAY=MO,WE;UNTIL=20080331T000000\r
+EXDATE:20080109T090000\r
+END:VEVENT\r
+BEGIN:VEVENT\r
+UID:review@example.com\r
+SUMMARY:Review\r
+DTSTART:20080108T140000\r
+DTEND:20080108T150000\r
+RRULE:FREQ=WEEKLY;BYDAY=MO,WE\r
+END:VEVENT\r
+BEGIN:VEVENT\r
+UID:standup@example.com\r
+RECURRENCE-ID:20080114T090000\r
+DTSTART:20080114T100000\r
+DTEND:20080114T101500\r
+END:VEVENT\r
+BEGIN:VEVENT\r
+UID:holiday@example.com\r
+SUMMARY:Holiday\r
+DTSTART;VALUE=DATE:20080201\r
+END:VEVENT\r
+END:VCALENDAR\r
+"""
+
+class TestImportICS(TestCase):
+    def setUp(self):
+        self.calendar = Calendar.objects.create(name="Imported", slug="imported")
+        fd, self.filename = tempfile.mkstemp(suffix='.ics')
+        os.write(fd, ICS)
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.filename)
+
+    def test_import(self):
+        for i in range(2):
+            call_command('import_ics', 'imported', self.filename, batch_size=1,
+                         transaction_size=2, verbosity=0)
+            events = Event.objects.filter(calendar=self.calendar)
+            self.assertEqual(events.count(), 3)
+            self.assertEqual(Occurrence.objects.filter(event__calendar=self.calendar).count(), 2)
+        standup = events.get(uid='standup@example.com')
+        review = events.get(uid='review@example.com')
+        self.assertEqual(standup.rule, review.rule)
+        self.assertEqual(standup.end_recurring_period, datetime.datetime(2008, 3, 31))
+        holiday = events.get(uid='holiday@example.com')
+        self.assertEqual(holiday.end - holiday.start, datetime.timedelta(days=1))
+        occurrences = standup.get_occurrences(datetime.datetime(2008, 1, 7),
+                                              datetime.datetime(2008, 1, 15))
+        self.assertEqual([(o.start, o.cancelled) for o in occurrences], [
+            (datetime.datetime(2008, 1, 7, 9, 0), False),
+            (datetime.datetime(2008, 1, 9, 9, 0), True),
+            (datetime.datetime(2008, 1, 14, 10, 0), False),
+        ])
+        # the occurrences don't copy the title of their event
+        self.assertEqual(set(Occurrence.objects.filter(event=standup)
+                             .values_list('title', 'description')), set([(None, None)]))
+        self.assertEqual(occurrences[2].title, 'Standup')
+        standup.title = 'Daily standup'
+        standup.save()
+        self.assertEqual(set(Occurrence.objects.filter(event=standup)
+                             .values_list('title', flat=True)), set([None]))
+        self.assertEqual([o.title for o in Occurrence.objects.filter(event=standup)],
+                         ['Daily standup', 'Daily standup'])
@@ -1,4 +1,4 @@
-import os, datetime
+import os, datetime, functools, json
 
 from django.test import TestCase
 from django.core.urlresolvers import reverse
@@ -39,6 +39,18 @@ class TestViewUtils(TestCase):
             {'year': 2008, 'month': 4, 'day': 1, 'hour': 0, 'minute': 0, 'second': 0}
             )
 
+    def test_get_events_partial(self):
+        from appointments import views
+        def get_events(request, calendar, extra, start=None, end=None):
+            return (calendar, extra, start, end)
+        default = views.GET_EVENTS_FUNC
+        views.GET_EVENTS_FUNC = functools.partial(get_events, extra='extra')
+        try:
+            self.assertEqual(views.get_events(None, 'calendar', 1, 2),
+                             ('calendar', 'extra', 1, 2))
+        finally:
+            views.GET_EVENTS_FUNC = default
+
 
 c = Client()
 
@@ -120,3 +132,162 @@ class TestUrls(TestCase):
         self.assertEqual(self.response.status_code, 404)
         c.logout()
 
+
+    def test_calendar_view_anonymous_user(self):
+        c.logout()
+        self.response = c.get(reverse("month_calendar", kwargs={"calendar_slug":'example'}),
+                              {'year': 2008, 'month': 11})
+        self.assertEqual(self.response.status_code, 200)
+        self.assertTrue(self.response['ETag'])
+
+    def test_calendar_view_not_modified(self):
+        url = reverse("month_calendar", kwargs={"calendar_slug":'example'})
+        self.response = c.get(url, {'year': 2000, 'month': 11})
+        etag = self.response['ETag']
+        self.response = c.get(url, {'year': 2000, 'month': 11},
+                              HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(self.response.status_code, 304)
+        self.response = c.get(url, {'year': 2000, 'month': 12},
+                              HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(self.response.status_code, 200)
+
+    def test_calendar_view_modified_by_event_move(self):
+        from appointments.models import Calendar, Event
+        url = reverse("month_calendar", kwargs={"calendar_slug":'example'})
+        etag = c.get(url, {'year': 2008, 'month': 11})['ETag']
+        event = Event.objects.get(pk=1)
+        event.calendar = Calendar.objects.create(name="Other", slug="other")
+        event.save()
+        self.response = c.get(url, {'year': 2008, 'month': 11},
+                              HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(self.response.status_code, 200)
+
+    def test_calendar_occurrences(self):
+        c.logout()
+        url = reverse("calendar_occurrences", kwargs={"calendar_slug":'example'})
+        query = {'start': '2008-11-01', 'end': '2008-12-01', 'fields': 'event,start'}
+        self.response = c.get(url, query)
+        self.assertEqual(self.response.status_code, 200)
+        everything = json.loads(self.response.content)
+        self.assertEqual(everything['next'], None)
+        self.assertEqual(everything['fields'], ['event', 'start'])
+        starts = everything['occurrences']['start']
+        self.assertEqual(starts, sorted(starts))
+        paged = []
+        cursor = ''
+        while cursor is not None:
+            self.response = c.get(url, dict(query, limit=3, cursor=cursor))
+            page = json.loads(self.response.content)
+            self.assertTrue(page['count'] <= 3)
+            paged += page['occurrences']['start']
+            cursor = page['next']
+        self.assertEqual(paged, starts)
+        self.response = c.get(url, dict(query, format='ndjson', limit=2))
+        lines = self.response.content.splitlines()
+        self.assertEqual([json.loads(line)['start'] for line in lines], starts[:2])
+        self.assertTrue(self.response['X-Next-Cursor'])
+        self.response = c.get(url, {'start': '2008-11-01'})
+        self.assertEqual(self.response.status_code, 400)
+
+    def test_calendar_occurrences_windows(self):
+        from appointments._views import _occurrence_key, _occurrences_page
+        from appointments.models import Event
+        from appointments.periods import Period
+        events = Event.objects.filter(calendar__slug='example')
+        start, end = datetime.datetime(2008, 1, 1), datetime.datetime(2009, 6, 1)
+        expected = sorted(Period(events, start, end).occurrences, key=_occurrence_key)
+        self.assertTrue(len(expected) > 4)
+        paged = []
+        cursor = None
+        while True:
+            page = _occurrences_page(events, start, end, cursor, 4)
+            paged += page
+            if len(page) < 4:
+                break
+            cursor = _occurrence_key(page[-1])
+        self.assertEqual([_occurrence_key(o) for o in paged],
+                         [_occurrence_key(o) for o in expected])
+
+    def test_calendar_changes(self):
+        from django.contrib.auth.models import User
+        from appointments.models import Calendar, Event
+        url = reverse("calendar_changes", kwargs={"calendar_slug":'example'})
+        full = json.loads(c.get(url).content)
+        self.assertTrue(full['full'])
+        self.assertEqual(len(full['events']), Event.objects.filter(calendar__slug='example').count())
+        event = Event.objects.get(pk=1)
+        event.title = 'Running'
+        event.save()
+        occurrence = event.get_occurrence(datetime.datetime(2008, 11, 10, 8, 0))
+        occurrence.cancel()
+        Event.objects.get(pk=2).delete()
+        changes = json.loads(c.get(url, {'since': full['token']}).content)
+        self.assertFalse(changes['full'])
+        self.assertEqual([e['title'] for e in changes['events']], ['Running'])
+        self.assertEqual([o['cancelled'] for o in changes['occurrences']], [True])
+        self.assertEqual(changes['deleted']['events'], [2])
+        unchanged = json.loads(c.get(url, {'since': changes['token']}).content)
+        self.assertEqual(unchanged['token'], changes['token'])
+        self.assertEqual(unchanged['events'], [])
+        moved = Event.objects.get(pk=3)
+        moved.calendar = Calendar.objects.create(name="Other", slug="other")
+        moved.save()
+        event.create_relation(User.objects.create(username='owner'), 'owner')
+        changes = json.loads(c.get(url, {'since': unchanged['token']}).content)
+        self.assertEqual(changes['deleted']['events'], [3])
+        self.assertEqual([r['distinction'] for r in changes['event_relations']], ['owner'])
+
+
+class TestICalendarFeed(TestCase):
+
+    fixtures = ['schedule.json']
+
+    def _strip_dtstamp(self, content):
+        # DTSTAMP is the time of the serialization
+        return [line for line in content.split('\r\n')
+                if not line.startswith('DTSTAMP')]
+
+    def test_streaming_matches_serialize(self):
+        from appointments.feeds import CalendarICalendar
+        from appointments.models import Calendar
+        calendar = Calendar.objects.get(slug='example')
+        feed = CalendarICalendar()
+        feed.chunk_size = 1
+        streamed = ''.join(feed.serialize_items(feed.items(calendar.pk)))
+        feed.streaming = False
+        serialized = feed.render(calendar.pk).content
+        self.assertEqual(self._strip_dtstamp(streamed),
+                         self._strip_dtstamp(serialized))
+        self.assertEqual(streamed.count('BEGIN:VEVENT'),
+                         calendar.events.count())
+
+    def test_last_modified(self):
+        from appointments.feeds.icalendar import ICalendarFeed
+        class Feed(ICalendarFeed):
+            def items(self, obj):
+                return ['item']
+            def item_last_modified(self, item):
+                return datetime.datetime(2008, 11, 3, 8, 0)
+        lines = Feed().render(None).content.split('\r\n')
+        self.assertTrue('LAST-MODIFIED:20081103T080000' in lines)
+
+    def test_recurring_events(self):
+        from appointments.feeds import CalendarICalendar
+        from appointments.models import Calendar, Event
+        event = Event.objects.get(pk=1)
+        event.get_occurrence(datetime.datetime(2008, 11, 10, 8, 0)).cancel()
+        event.get_occurrence(datetime.datetime(2008, 11, 17, 8, 0)).move(
+            datetime.datetime(2008, 11, 18, 10, 0),
+            datetime.datetime(2008, 11, 18, 11, 0))
+        feed = CalendarICalendar()
+        items = feed.items(event.calendar_id)
+        # another export meanwhile doesn't change this one
+        other = Calendar.objects.create(name="Other", slug="other")
+        list(feed.items(other.pk))
+        lines = ''.join(feed.serialize_items(items)).split('\r\n')
+        self.assertTrue('RRULE:FREQ=WEEKLY;UNTIL=20090601T000000' in lines)
+        self.assertTrue('EXDATE:20081110T080000' in lines)
+        self.assertTrue('RECURRENCE-ID:20081117T080000' in lines)
+        self.assertTrue('DTSTART:20081118T100000' in lines)
+        self.assertEqual(lines.count('BEGIN:VEVENT'),
+                         Event.objects.filter(calendar=event.calendar).count() + 1)
@@ -1,11 +1,22 @@
+import bisect
 import datetime
 import heapq
+import itertools
+import threading
+from collections import OrderedDict
+from hashlib import md5
 
 from django.contrib.contenttypes.models import ContentType
+from django.db.models.query import QuerySet
 from django.http import HttpResponseRedirect
 from django.conf import settings
 
-from .conf.settings import CHECK_PERMISSION_FUNC
+from .conf.settings import CHECK_PERMISSION_FUNC, OCCURRENCE_INDEX
+
+# the first window of original starts for which EventListManager loads the
+# persisted occurrences, and the size windows stop doubling at
+UPCOMING_WINDOW = datetime.timedelta(days=7)
+UPCOMING_WINDOW_MAX = datetime.timedelta(days=365)
 
 
 class EventListManager(object):
@@ -17,19 +28,54 @@ class EventListManager(object):
     def __init__(self, events):
         self.events = events
 
-    def occurrences_after(self, after=None):
+    def occurrences_after(self, after=None, limit=None):
         """
         It is often useful to know what the next occurrence is given a list of
         events.  This function produces a generator that yields the
         the most recent occurrence after the date ``after`` from any of the
-        events in ``self.events``
+        events in ``self.events``, and stops after ``limit`` occurrences if
+        it is given.
+
+        When the events are a queryset, the events which can't occur after
+        ``after`` any more are left out by the database.
         """
-        from appointments.models import Occurrence
+        occurrences = self._occurrences_after(after)
+        if limit is not None:
+            occurrences = itertools.islice(occurrences, limit)
+        return occurrences
+
+    def _upcoming_events(self, after):
+        from appointments.models.events import range_q
+        if isinstance(self.events, QuerySet):
+            return self.events.filter(range_q(after)).select_related('rule')
+        return self.events
+
+    def _occurrences_after(self, after):
+        from appointments.models import Occurrence, OccurrenceIndex
         if after is None:
             after = datetime.datetime.now()
-        occ_replacer = OccurrenceReplacer(
-            Occurrence.objects.filter(event__in = self.events))
-        generators = [event._occurrences_after_generator(after) for event in self.events]
+        events = self._upcoming_events(after)
+        horizon = OCCURRENCE_INDEX and OccurrenceIndex.objects.get_horizon()
+        if not horizon or not (horizon.start <= after < horizon.end):
+            for occurrence in self._expand_occurrences_after(events, after):
+                yield occurrence
+            raise StopIteration
+        # the index stores the occurrences at their current start: read those
+        # starting before the end of the horizon, then expand those starting
+        # after it, including the persisted occurrences moved past it
+        for occurrence in OccurrenceIndex.objects.occurrences_after(events, after, horizon.end):
+            yield occurrence
+        expanded = (occurrence for occurrence in
+                    self._expand_occurrences_after(events, horizon.end)
+                    if occurrence.start >= horizon.end)
+        moved = Occurrence.objects.with_events().filter(event__in=events,
+            original_start__lt=horizon.end, start__gte=horizon.end).order_by('start', 'end')
+        for key, occurrence in heapq.merge(_keyed(expanded, 0), _keyed(moved.iterator(), 1)):
+            yield occurrence
+
+    def _expand_occurrences_after(self, events, after):
+        from appointments.models import Occurrence
+        generators = [event._occurrences_after_generator(after) for event in events]
         occurrences = []
 
         for generator in generators:
@@ -38,6 +84,12 @@ class EventListManager(object):
             except StopIteration:
                 pass
 
+        # the persisted occurrences replacing the generated ones are loaded
+        # for a window of original starts at a time, the windows growing as
+        # the iteration goes on
+        occ_replacer = None
+        window_end = None
+        window = UPCOMING_WINDOW
         while True:
             if len(occurrences) == 0: raise StopIteration
 
@@ -47,38 +99,156 @@ class EventListManager(object):
                 next = heapq.heapreplace(occurrences, (generator.next(), generator))[0]
             except StopIteration:
                 next = heapq.heappop(occurrences)[0]
+            if window_end is None or next.original_start >= window_end:
+                window_end = next.original_start + window
+                occ_replacer = OccurrenceReplacer(
+                    Occurrence.objects.with_events().filter(event__in=events,
+                                              original_start__gte=next.original_start,
+                                              original_start__lt=window_end))
+                window = min(window * 2, UPCOMING_WINDOW_MAX)
             yield occ_replacer.get_occurrence(next)
 
 
+def _keyed(occurrences, index):
+    # (start, end) keys for heapq.merge, unique so occurrences are never compared
+    for position, occurrence in enumerate(occurrences):
+        yield (occurrence.start, occurrence.end, index, position), occurrence
+
+
 class OccurrenceReplacer(object):
     """
     When getting a list of occurrences, the last thing that needs to be done
     before passing it forward is to make sure all of the occurrences that
     have been stored in the datebase replace, in the list you are returning,
     the generated ones that are equivalent.  This class makes this easier.
+
+    The persisted occurrences are keyed by the id of their event, so no event
+    is loaded to look them up, and each event's are kept sorted by start, so
+    those moved into a period are found by bisection.  A single replacer can
+    be built from the persisted occurrences of all the events of a period,
+    and used for each of them.
     """
     def __init__(self, persisted_occurrences):
-        lookup = [((occ.event, occ.original_start, occ.original_end), occ) for
-            occ in persisted_occurrences]
-        self.lookup = dict(lookup)
+        self.lookup = {}
+        self.occurrences = {}
+        for occ in persisted_occurrences:
+            self.lookup[self._key(occ)] = occ
+            self.occurrences.setdefault(occ.event_id, []).append(occ)
+        self.starts = {}
+        self.max_ends = {}
+        for event_id, occurrences in self.occurrences.items():
+            occurrences.sort(key=lambda occ: (occ.start, occ.end))
+            self.starts[event_id] = [occ.start for occ in occurrences]
+            # max_ends[i] is the latest end of the first i+1 occurrences
+            max_ends = self.max_ends[event_id] = []
+            max_end = None
+            for occ in occurrences:
+                if max_end is None or occ.end > max_end:
+                    max_end = occ.end
+                max_ends.append(max_end)
+
+    def _key(self, occ):
+        return (occ.event_id, occ.original_start, occ.original_end)
 
     def get_occurrence(self, occ):
         """
         Return a persisted occurrences matching the occ and remove it from lookup since it
         has already been matched
         """
-        return self.lookup.pop(
-            (occ.event, occ.original_start, occ.original_end),
-            occ)
+        return self.lookup.pop(self._key(occ), occ)
 
     def has_occurrence(self, occ):
-        return (occ.event, occ.original_start, occ.original_end) in self.lookup
+        return self._key(occ) in self.lookup
+
+    def get_additional_occurrences(self, start, end, event_id=None):
+        """
+        Return persisted occurrences which are now in the period, of the event
+        whose id is ``event_id`` or of all of them
+        """
+        if event_id is None:
+            event_ids = self.occurrences.keys()
+        else:
+            event_ids = [event_id]
+        additional = []
+        for event_id in event_ids:
+            if event_id not in self.occurrences:
+                continue
+            low = bisect.bisect_left(self.max_ends[event_id], start)
+            high = bisect.bisect_left(self.starts[event_id], end)
+            for occ in self.occurrences[event_id][low:high]:
+                # the ones already matched were replaced where they originated
+                if occ.end >= start and not occ.cancelled and self.lookup.get(self._key(occ)) is occ:
+                    additional.append(occ)
+        return additional
+
+
+def bulk_create(model, objects):
+    """
+    Inserts ``objects`` with bulk_create where Django has it (1.4 and later),
+    or saves them one by one, sending the signals of each, otherwise.
+    """
+    manager = model._default_manager
+    if hasattr(manager, 'bulk_create'):
+        manager.bulk_create(objects)
+    else:
+        for obj in objects:
+            obj.save()
+
+
+def calendar_etag(updated_on, *parts):
+    """
+    Returns an ETag for a response built from a calendar whose ``updated_on``
+    is given, and which also depends on ``parts`` (the user, the query
+    string...).
+    """
+    parts = (updated_on.strftime('%Y-%m-%dT%H:%M:%S.%f'),) + parts
+    return md5(':'.join([unicode(part) for part in parts]).encode('utf-8')).hexdigest()
+
+
+class LRUCache(object):
+    """
+    A small, process local, least recently used mapping.  Once ``maxsize``
+    entries are stored, adding a new one evicts the entry that was read or
+    written the longest time ago.
+    """
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.lock = threading.RLock()
+
+    def __len__(self):
+        return len(self.data)
+
+    def __contains__(self, key):
+        return key in self.data
 
-    def get_additional_occurrences(self, start, end):
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value = self.data.pop(key)
+            except KeyError:
+                return default
+            self.data[key] = value
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.data.pop(key, None)
+            self.data[key] = value
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def discard(self, predicate):
         """
-        Return persisted occurrences which are now in the period
+        Remove every entry whose key satisfies ``predicate``.
         """
-        return [occ for key,occ in self.lookup.items() if (occ.start < end and occ.end >= start and not occ.cancelled)]
+        with self.lock:
+            for key in [key for key in self.data if predicate(key)]:
+                del self.data[key]
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
 
 
 class check_event_permissions(object):